@@ -1,38 +1,163 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file
+from flask import Flask, Request, Response, abort, current_app, render_template, request, redirect, url_for, flash, jsonify, session, send_file, stream_with_context
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from datetime import datetime, timedelta
-from PIL import Image
+from werkzeug.datastructures import FileStorage
+from datetime import datetime, timedelta, timezone
 import os
-import sqlite3
 import base64
+import csv
+import itertools
+import json
+import math
+import re
+import tempfile
 from functools import wraps
 import io
-import pytz
+import click
 
-# Set timezone to IST
-IST = pytz.timezone('Asia/Kolkata')
+import bootstrap
+import db
+import geocoding
+import geofence
+import group_commit
+import image_queue
+import metrics
+import payroll
+import photo_hash
+import presence
+import retention
+import rollup
+import user_import
+from image_policy import RENDITIONS, create_policy, format_for_key
+from image_store import create_store, thumbnail_key
+from db import get_db
+from migrations import apply_migrations, pending_versions
+from user_cache import UserCache
+
+# Set timezone to IST (a fixed +05:30, India has no daylight saving)
+IST = timezone(timedelta(hours=5, minutes=30), 'IST')
+
+class UploadRequest(Request):
+    """Request that spools multipart file parts straight into the upload folder.
+
+    Werkzeug writes each part to the stream returned here chunk by chunk while
+    parsing, so a photo is never held in memory and saving it is just a rename.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile(
+            'wb+', dir=current_app.config['UPLOAD_FOLDER'],
+            prefix='.upload-', suffix='.part', delete=False
+        )
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'static/uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['DATABASE'] = os.environ.get('DATABASE_PATH', 'attendance.db')
+app.config['DATABASE_URL'] = os.environ.get('DATABASE_URL')  # PostgreSQL instead of the SQLite file
+# Idle connections each worker keeps: one per gunicorn thread plus the background threads
+app.config['DB_POOL_MAX_IDLE'] = int(os.environ.get('DB_POOL_MAX_IDLE', int(os.environ.get('GUNICORN_THREADS', 32)) + 4))
+# Connections requests may hold at once (0: no limit). Threads bound it
+# already; under gevent on PostgreSQL, hundreds of greenlets would go past
+# the server's max_connections, so they share what a threaded worker uses
+GEVENT_ON_POSTGRES = os.environ.get('GUNICORN_WORKER_CLASS') == 'gevent' and bool(app.config['DATABASE_URL'])
+app.config['DB_POOL_MAX_OPEN'] = int(os.environ.get(
+    'DB_POOL_MAX_OPEN', app.config['DB_POOL_MAX_IDLE'] if GEVENT_ON_POSTGRES else 0))
+app.config['IMAGE_STORE'] = os.environ.get('IMAGE_STORE', 'local')  # 'local' or 's3'
+app.config['IMAGE_QUALITY_TIER'] = os.environ.get('IMAGE_QUALITY_TIER', 'standard')  # 'high', 'standard' or 'low'
+app.config['IMAGE_FORMATS'] = os.environ.get('IMAGE_FORMATS', 'webp,jpeg')  # upload formats, preferred first
+app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET')
+app.config['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL')
+app.config['GEOCODER'] = os.environ.get('GEOCODER', 'nominatim')  # 'nominatim' or 'stub'
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')  # bearer token for Prometheus scrapes
+app.config['PROFILE_EVERY_N'] = int(os.environ.get('PROFILE_EVERY_N', 0))  # 0 = only on X-Profile: 1
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+app.config['PUNCH_GROUP_COMMIT'] = os.environ.get('PUNCH_GROUP_COMMIT', '1') != '0'  # 0 = commit each punch inline
+# Live dashboard streams per worker. Under gthread each holds a thread, so default
+# to a quarter of them; under gevent only a greenlet, so half the connections
+if os.environ.get('GUNICORN_WORKER_CLASS') == 'gevent':
+    PRESENCE_DEFAULT_CAP = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000)) // 2
+else:
+    PRESENCE_DEFAULT_CAP = max(1, int(os.environ.get('GUNICORN_THREADS', 32)) // 4)
+app.config['PRESENCE_MAX_SUBSCRIBERS'] = int(os.environ.get('PRESENCE_MAX_SUBSCRIBERS', PRESENCE_DEFAULT_CAP))
+# Retention windows in days (0 keeps forever); see retention.py
+app.config['RETAIN_ORIGINALS_DAYS'] = int(os.environ.get('RETAIN_ORIGINALS_DAYS', 90))
+app.config['RETAIN_RENDITIONS_DAYS'] = int(os.environ.get('RETAIN_RENDITIONS_DAYS', 730))
+app.config['RETAIN_HOT_ROWS_DAYS'] = int(os.environ.get('RETAIN_HOT_ROWS_DAYS', 0))  # opt-in: reports only read live rows
+app.config['IMAGE_JOBS_KEEP_DAYS'] = int(os.environ.get('IMAGE_JOBS_KEEP_DAYS', 30))
+app.config['RETAIN_RECEIPTS_DAYS'] = int(os.environ.get('RETAIN_RECEIPTS_DAYS', 30))
+app.config['RETENTION_BATCH'] = int(os.environ.get('RETENTION_BATCH', 500))
+app.config['ARCHIVE_FOLDER'] = os.environ.get('ARCHIVE_FOLDER', 'archive')
+# Most bits (of 64) a photo may differ from an earlier one and still count as a replay
+app.config['PHOTO_MATCH_PHASH_BITS'] = int(os.environ.get('PHOTO_MATCH_PHASH_BITS', 6))
+app.config['PHOTO_MATCH_DHASH_BITS'] = int(os.environ.get('PHOTO_MATCH_DHASH_BITS', 10))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 0))  # 0 = one per CPU
+# Payroll report: overtime past PAYROLL_WEEKLY_HOURS, night hours between
+# PAYROLL_NIGHT_START and PAYROLL_NIGHT_END (IST hours), and shifts open longer
+# than PAYROLL_STALE_SHIFT_HOURS credited by policy: 'standard' (a standard
+# shift), 'cap' (PAYROLL_STALE_SHIFT_HOURS) or 'unpaid'
+app.config['PAYROLL_WEEKLY_HOURS'] = int(os.environ.get('PAYROLL_WEEKLY_HOURS', 48))
+app.config['PAYROLL_STANDARD_SHIFT_HOURS'] = int(os.environ.get('PAYROLL_STANDARD_SHIFT_HOURS', 8))
+app.config['PAYROLL_STALE_SHIFT_HOURS'] = int(os.environ.get('PAYROLL_STALE_SHIFT_HOURS', 16))
+app.config['PAYROLL_STALE_SHIFT_POLICY'] = os.environ.get('PAYROLL_STALE_SHIFT_POLICY', 'standard')
+app.config['PAYROLL_NIGHT_START'] = int(os.environ.get('PAYROLL_NIGHT_START', 22))
+app.config['PAYROLL_NIGHT_END'] = int(os.environ.get('PAYROLL_NIGHT_END', 6))
+
+# Photos are stored by content hash; the attendance *_image_path columns hold keys
+image_store = create_store(app.config)
+# Size/quality limits for photos, applied by the capture pages and the image worker
+image_policy = create_policy(app.config)
 
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+@app.teardown_request
+def remove_unsaved_uploads(exc=None):
+    # Parts that were never moved into place by save_image (failed or
+    # rejected punches) are still sitting in their temp files. Every part
+    # counts, including repeats of a field name that values() would skip.
+    if 'files' not in request.__dict__:
+        return
+    for _, part in request.files.items(multi=True):
+        name = getattr(part.stream, 'name', None)
+        if isinstance(name, str) and os.path.basename(name).startswith('.upload-'):
+            part.stream.close()
+            if os.path.exists(name):
+                os.remove(name)
 
 # Flask-Login setup
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Database setup
-def get_db():
-    conn = sqlite3.connect('attendance.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+# Database setup - connections are pooled per worker and shared through g
+db.init_app(app)
+
+# Schema, migrations and the default admin, set up once before the first
+# request (the upload folder too: multipart uploads are spooled into it)
+app_bootstrap = bootstrap.Bootstrap(app, folders=[app.config['UPLOAD_FOLDER']])
 
+# Request/span histograms for /metrics; admins can profile one request with X-Profile: 1
+request_metrics = metrics.Metrics(
+    app, can_profile=lambda: current_user.is_authenticated and current_user.role == 'admin'
+)
+
+# Reverse geocoding shared by every worker on a site (cached per ~150m cell)
+geocoder = geocoding.create_service(app.config)
+
+# Work sites punches are checked against, indexed per worker
+geofences = geofence.GeofenceEngine()
+
+# Thumbnails are made by a background worker after the punch is committed
+image_worker = image_queue.init_app(app)
+
+# Open shifts pushed live to admin dashboards (server-sent events)
+presence_board = presence.PresenceBoard(app)
+
+# Check-in/check-out writes are committed in groups by one thread per worker
+punch_writer = group_commit.GroupCommitWriter(app)
+
+@app_bootstrap.setup
 def init_db():
     conn = get_db()
     conn.execute('''
@@ -68,6 +193,10 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
+    for statement in image_queue.SCHEMA:
+        conn.execute(statement)
+    apply_migrations(conn)
+    retention_engine.ensure_scheduled(conn)
     
     # Create default admin if not exists
     cursor = conn.cursor()
@@ -79,7 +208,13 @@ def init_db():
             ('admin', 'admin@attendance.com', admin_hash, 'admin')
         )
         conn.commit()
-    conn.close()
+
+@app_bootstrap.ready
+def schema_ready():
+    conn = get_db()
+    if pending_versions(conn):
+        return False
+    return conn.execute("SELECT 1 FROM users WHERE username = 'admin'").fetchone() is not None
 
 # User class for Flask-Login
 class User(UserMixin):
@@ -90,11 +225,31 @@ class User(UserMixin):
         self.role = role
         self.location_enabled = location_enabled
 
+# Logged-in users are looked up on every request, so keep them in memory
+user_cache = UserCache()
+
+# Bulk imports hash passwords in a pool of processes (started on first import)
+password_hasher = user_import.PasswordHasher(app.config['PASSWORD_HASH_WORKERS'] or None)
+
+# Regular/overtime/night hours per worker-week and per site (/admin/payroll)
+payroll_engine = payroll.PayrollEngine(
+    weekly_hours=app.config['PAYROLL_WEEKLY_HOURS'],
+    stale_after_hours=app.config['PAYROLL_STALE_SHIFT_HOURS'],
+    stale_policy=app.config['PAYROLL_STALE_SHIFT_POLICY'],
+    standard_shift_hours=app.config['PAYROLL_STANDARD_SHIFT_HOURS'],
+    night_start=app.config['PAYROLL_NIGHT_START'],
+    night_end=app.config['PAYROLL_NIGHT_END'],
+)
+
+def fetch_user(user_id):
+    row = get_db().execute(
+        'SELECT id, username, email, role, location_enabled FROM users WHERE id = ?', (user_id,)
+    ).fetchone()
+    return dict(row) if row else None
+
 @login_manager.user_loader
 def load_user(user_id):
-    conn = get_db()
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
+    user = user_cache.get(int(user_id), fetch_user)
 
     if user:
         return User(
@@ -137,7 +292,6 @@ def login():
         
         conn = get_db()
         user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
         
         if user and check_password_hash(user['password_hash'], password):
             user_obj = User(user['id'], user['username'], user['email'], user['role'])
@@ -160,17 +314,133 @@ def logout():
 @login_required
 @admin_required
 def admin_dashboard():
+    # Users and attendance are paged in by the page itself from the
+    # /api/admin/* endpoints below
+    return render_template('admin_dashboard.html')
+
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 200
+
+def page_size():
+    return max(1, min(request.args.get('limit', PAGE_SIZE_DEFAULT, type=int), PAGE_SIZE_MAX))
+
+# Attendance pages are keyed on (check_in_time, id) of the last row seen, so
+# fetching page N costs the same as page 1. The cursor is opaque to clients.
+def encode_cursor(check_in_time, record_id):
+    return base64.urlsafe_b64encode(f'{check_in_time}|{record_id}'.encode()).decode()
+
+def decode_cursor(cursor):
+    check_in_time, record_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+    return check_in_time, int(record_id)
+
+# Photo columns of an attendance row and the time each was taken
+PHOTO_COLUMNS = (('front_image_path', 'check_in_time'), ('rear_image_path', 'check_in_time'),
+                 ('checkout_front_image_path', 'check_out_time'), ('checkout_rear_image_path', 'check_out_time'))
+
+def punch_photos(row):
+    """(column, (key, user_id, captured_at)) for each photo on an attendance row."""
+    for column, time_column in PHOTO_COLUMNS:
+        if row[column] and row[time_column]:
+            yield column, (row[column], row['user_id'], str(row[time_column]))
+
+@app.route('/api/admin/attendance')
+@login_required
+@admin_required
+def api_admin_attendance():
+    limit = page_size()
+    conditions = []
+    params = []
+    
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            conditions.append('(a.check_in_time, a.id) < (?, ?)')
+            params.extend(decode_cursor(cursor))
+        except (ValueError, UnicodeDecodeError):
+            return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+    
+    user_id = request.args.get('user_id', type=int)
+    if user_id:
+        conditions.append('a.user_id = ?')
+        params.append(user_id)
+    
+    status = request.args.get('status')
+    if status in ('checked_in', 'checked_out'):
+        conditions.append('a.status = ?')
+        params.append(status)
+    
+    city = request.args.get('city', '').strip()
+    if city:
+        conditions.append("(a.city LIKE ? ESCAPE '\\' OR a.checkout_city LIKE ? ESCAPE '\\')")
+        pattern = city.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        params.extend([pattern, pattern])
+    
+    try:
+        start_date = request.args.get('start_date')
+        if start_date:
+            conditions.append('a.check_in_time >= ?')
+            params.append(datetime.strptime(start_date, '%Y-%m-%d').strftime('%Y-%m-%d'))
+        end_date = request.args.get('end_date')
+        if end_date:
+            conditions.append('a.check_in_time < ?')
+            params.append((datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Dates must be YYYY-MM-DD'}), 400
+    
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    conn = get_db()
+    rows = conn.execute(f'''
+        SELECT a.id, a.user_id, u.username, a.check_in_time, a.check_out_time, a.status,
+               a.front_image_path, a.rear_image_path,
+               a.checkout_front_image_path, a.checkout_rear_image_path,
+               a.checkin_latitude, a.checkin_longitude, a.checkout_latitude, a.checkout_longitude,
+               a.city, a.checkout_city, a.checkin_off_site, a.checkout_off_site
+        FROM attendance a
+        JOIN users u ON a.user_id = u.id
+        {where}
+        ORDER BY a.check_in_time DESC, a.id DESC
+        LIMIT ?
+    ''', params + [limit + 1]).fetchall()
+    
+    # One extra row tells us whether there is another page
+    records = [dict(row) for row in rows[:limit]]
+    # Punch photos that repeat an earlier photo
+    matches = photo_fingerprints.matches_for(conn, [photo for record in records for _, photo in punch_photos(record)])
+    for record in records:
+        for column, _ in PHOTO_COLUMNS:
+            name = column[:-len('_path')]
+            record[name + '_url'] = image_url(record[column])
+            record[name + '_thumb_url'] = image_url(record[column], thumbnail=True)
+            record[name + '_medium_url'] = image_url(record[column], rendition='medium')
+            record[name + '_match'] = None
+        for column, photo in punch_photos(record):
+            match = matches.get(photo)
+            if match:
+                record[column[:-len('_path')] + '_match'] = {
+                    'captured_at': match['matched_captured_at'], 'bits': match['phash_distance'],
+                    'identical': match['matched_key'] == match['key'],
+                    'thumb_url': image_url(match['matched_key'], thumbnail=True),
+                }
+    next_cursor = None
+    if len(rows) > limit:
+        last = records[-1]
+        next_cursor = encode_cursor(last['check_in_time'], last['id'])
+    return jsonify({'success': True, 'records': records, 'next_cursor': next_cursor})
+
+@app.route('/api/admin/users')
+@login_required
+@admin_required
+def api_admin_users():
+    limit = page_size()
+    after_id = request.args.get('after_id', 0, type=int)
     conn = get_db()
-    users = conn.execute('SELECT id, username, email, role, location_enabled, created_at FROM users').fetchall()
-    attendance = conn.execute('''
-        SELECT a.*, u.username 
-        FROM attendance a 
-        JOIN users u ON a.user_id = u.id 
-        ORDER BY a.check_in_time DESC 
-        LIMIT 50
-    ''').fetchall()
-    conn.close()
-    return render_template('admin_dashboard.html', users=users, attendance=attendance)
+    rows = conn.execute(
+        'SELECT id, username, email, role, location_enabled, created_at FROM users WHERE id > ? ORDER BY id LIMIT ?',
+        (after_id, limit + 1)
+    ).fetchall()
+    users = [dict(row) for row in rows[:limit]]
+    next_after_id = users[-1]['id'] if len(rows) > limit else None
+    return jsonify({'success': True, 'users': users, 'next_after_id': next_after_id})
 
 @app.route('/admin/add_user', methods=['POST'])
 @login_required
@@ -189,20 +459,62 @@ def add_user():
     conn = get_db()
     try:
         password_hash = generate_password_hash(password)
-        conn.execute(
+        cursor = conn.execute(
             'INSERT INTO users (username, email, password_hash, role, location_enabled) VALUES (?, ?, ?, ?, ?)',
             (username, email, password_hash, role, location_enabled)
         )
+        user_cache.invalidate(conn, cursor.lastrowid)
         conn.commit()
         location_status = "with" if location_enabled else "without"
         flash(f'User {username} added successfully {location_status} location tracking', 'success')
-    except sqlite3.IntegrityError:
+    except db.IntegrityError:
         flash('Username or email already exists', 'danger')
-    finally:
-        conn.close()
     
     return redirect(url_for('admin_dashboard'))
 
+@app.route('/api/admin/users/import', methods=['POST'])
+@login_required
+@admin_required
+def api_import_users():
+    # A CSV file upload, a text/csv body or JSON {"users": [...]}; ?dry_run=1 only validates
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('file')
+        rows = user_import.parse_csv(upload.read().decode('utf-8', 'replace')) if upload else None
+    elif request.mimetype == 'text/csv':
+        rows = user_import.parse_csv(request.get_data(as_text=True))
+    else:
+        rows = (request.get_json(silent=True) or {}).get('users')
+    if not isinstance(rows, list) or not rows:
+        return jsonify({'success': False, 'message': 'No users to import'}), 400
+    if len(rows) > user_import.MAX_ROWS:
+        return jsonify({'success': False, 'message': f'At most {user_import.MAX_ROWS} users per import'}), 413
+    
+    conn = get_db()
+    created, results = user_import.import_users(conn, rows, password_hasher,
+                                                dry_run=request.args.get('dry_run') == '1')
+    conn.commit()
+    rejected = sum(1 for result in results if result['status'] == 'rejected')
+    return jsonify({'success': True, 'created': created, 'rejected': rejected, 'results': results})
+
+@app.route('/api/admin/users/bulk', methods=['POST'])
+@login_required
+@admin_required
+def api_bulk_update_users():
+    # JSON {"updates": [{"id" or "username", "role", "location_enabled"}, ...]}
+    updates = (request.get_json(silent=True) or {}).get('updates')
+    if not isinstance(updates, list) or not updates:
+        return jsonify({'success': False, 'message': 'No updates given'}), 400
+    if len(updates) > user_import.MAX_ROWS:
+        return jsonify({'success': False, 'message': f'At most {user_import.MAX_ROWS} updates per request'}), 413
+    
+    conn = get_db()
+    updated, results = user_import.bulk_update(conn, updates, current_user.id)
+    if updated:
+        user_cache.invalidate(conn)
+    conn.commit()
+    rejected = sum(1 for result in results if result['status'] == 'rejected')
+    return jsonify({'success': True, 'updated': updated, 'rejected': rejected, 'results': results})
+
 @app.route('/admin/toggle_location/<int:user_id>', methods=['POST'])
 @login_required
 @admin_required
@@ -213,13 +525,13 @@ def toggle_location(user_id):
     if user:
         new_status = 0 if user['location_enabled'] else 1
         conn.execute('UPDATE users SET location_enabled = ? WHERE id = ?', (new_status, user_id))
+        user_cache.invalidate(conn, user_id)
         conn.commit()
         status_text = "enabled" if new_status else "disabled"
         flash(f'Location tracking {status_text} for {user["username"]}', 'success')
     else:
         flash('User not found', 'danger')
     
-    conn.close()
     return redirect(url_for('admin_dashboard'))
 
 @app.route('/user/dashboard')
@@ -233,10 +545,9 @@ def user_dashboard():
     
     # Check if user is currently checked in
     current_checkin = conn.execute(
-        'SELECT * FROM attendance WHERE user_id = ? AND status = "checked_in" ORDER BY check_in_time DESC LIMIT 1',
+        "SELECT * FROM attendance WHERE user_id = ? AND status = 'checked_in' ORDER BY check_in_time DESC LIMIT 1",
         (current_user.id,)
     ).fetchone()
-    conn.close()
     
     return render_template('user_dashboard.html', attendance=attendance, current_checkin=current_checkin)
 
@@ -246,17 +557,17 @@ def checkin_page():
     # Check if already checked in
     conn = get_db()
     current_checkin = conn.execute(
-        'SELECT * FROM attendance WHERE user_id = ? AND status = "checked_in"',
+        "SELECT * FROM attendance WHERE user_id = ? AND status = 'checked_in'",
         (current_user.id,)
     ).fetchone()
-    conn.close()
     
     if current_checkin:
         flash('You are already checked in. Please check out first.', 'warning')
         return redirect(url_for('user_dashboard'))
     
     # Pass location permission to template
-    return render_template('checkin.html', location_allowed=current_user.location_enabled)
+    return render_template('checkin.html', location_allowed=current_user.location_enabled,
+                           image_policy=image_policy.client_config())
 
 @app.route('/user/checkout')
 @login_required
@@ -264,136 +575,728 @@ def checkout_page():
     # Check if user is checked in
     conn = get_db()
     current_checkin = conn.execute(
-        'SELECT * FROM attendance WHERE user_id = ? AND status = "checked_in"',
+        "SELECT * FROM attendance WHERE user_id = ? AND status = 'checked_in'",
         (current_user.id,)
     ).fetchone()
-    conn.close()
     
     if not current_checkin:
         flash('You need to check in first.', 'warning')
         return redirect(url_for('user_dashboard'))
     
     # Pass location permission to template
-    return render_template('checkout.html', location_allowed=current_user.location_enabled)
+    return render_template('checkout.html', location_allowed=current_user.location_enabled,
+                           image_policy=image_policy.client_config())
+
+@app.route('/api/reverse_geocode')
+@login_required
+def api_reverse_geocode():
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    if latitude is None or longitude is None or not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return jsonify({'success': False, 'message': 'lat and lon are required'}), 400
+    
+    result = geocoder.lookup(latitude, longitude)
+    if not result:
+        return jsonify({'success': False, 'message': 'Location could not be resolved'}), 502
+    return jsonify(dict(result, success=True))
+
+@app.errorhandler(TimeoutError)
+def server_busy(error):
+    # The punch writer (or, under gevent on PostgreSQL, the connection pool)
+    # didn't get to the request in time. Nothing was written, so sending the
+    # punch again is safe; a queued sync batch stays queued and is retried.
+    return jsonify({'success': False, 'message': 'Server is busy, please try again in a few seconds'}), \
+        503, {'Retry-After': '5'}
 
 @app.route('/api/checkin', methods=['POST'])
 @login_required
 def api_checkin():
-    data = request.json
+    data, images = read_punch_request()
     
     # Save images
-    front_image = data.get('front_image')
-    rear_image = data.get('rear_image')
-    latitude = data.get('latitude')
-    longitude = data.get('longitude')
-    city = data.get('city', 'Location not captured')
-    full_address = data.get('full_address', 'Location not captured')
+    front_image = images.get('front_image')
+    rear_image = images.get('rear_image')
+    latitude = parse_coordinate(data.get('latitude'))
+    longitude = parse_coordinate(data.get('longitude'))
+    city, full_address = resolve_address(
+        latitude, longitude,
+        data.get('city', 'Location not captured'),
+        data.get('full_address', 'Location not captured')
+    )
+    site_id, off_site = geofences.check(latitude, longitude)
     
     # Use IST timezone
-    timestamp = datetime.now(IST).strftime('%Y%m%d_%H%M%S')
     checkin_time = datetime.now(IST).strftime('%Y-%m-%d %H:%M:%S')
     
-    front_filename = f"checkin_front_{current_user.id}_{timestamp}.jpg"
-    rear_filename = f"checkin_rear_{current_user.id}_{timestamp}.jpg"
+    user_id = current_user.id
     
-    # Save and create thumbnails for front image
-    if front_image:
-        front_image_data = front_image.split(',')[1]
-        front_path = os.path.join(app.config['UPLOAD_FOLDER'], front_filename)
-        with open(front_path, 'wb') as f:
-            f.write(base64.b64decode(front_image_data))
-        
-        # Create thumbnail
-        create_thumbnail(front_path, f"thumb_{front_filename}")
-    
-    # Save and create thumbnails for rear image
-    if rear_image:
-        rear_image_data = rear_image.split(',')[1]
-        rear_path = os.path.join(app.config['UPLOAD_FOLDER'], rear_filename)
-        with open(rear_path, 'wb') as f:
-            f.write(base64.b64decode(rear_image_data))
-        
-        # Create thumbnail
-        create_thumbnail(rear_path, f"thumb_{rear_filename}")
+    # Save images (outside the write lock, in parallel with other punches)
+    try:
+        front_key = save_image(front_image) if front_image else None
+        rear_key = save_image(rear_image) if rear_image else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Photo is not a valid data URL'}), 400
     
-    # Save to database
-    conn = get_db()
-    conn.execute('''
-        INSERT INTO attendance (user_id, front_image_path, rear_image_path, checkin_latitude, checkin_longitude, city, full_address, check_in_time)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (current_user.id, front_filename, rear_filename, latitude, longitude, city, full_address, checkin_time))
-    conn.commit()
-    conn.close()
+    def record(conn):
+        for key in (front_key, rear_key):
+            if key:
+                queue_photo_jobs(conn, key, user_id, checkin_time)
+        conn.execute('''
+            INSERT INTO attendance (user_id, front_image_path, rear_image_path, checkin_latitude, checkin_longitude, city, full_address, check_in_time,
+                                    checkin_site_id, checkin_off_site)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, front_key, rear_key, latitude, longitude, city, full_address, checkin_time,
+              site_id, off_site))
+        rollup.refresh_days(conn, user_id, [checkin_time[:10]])
+        presence_board.changed(conn)
+    
+    punch_writer.run(record)
+    image_worker.notify()
+    presence_board.notify()
     
-    return jsonify({'success': True, 'message': 'Check-in successful!'})
+    return jsonify({'success': True, 'message': 'Check-in successful!', 'off_site': bool(off_site)})
 
 @app.route('/api/checkout', methods=['POST'])
 @login_required
 def api_checkout():
-    data = request.json
+    data, images = read_punch_request()
     
     # Get checkout images and location
-    checkout_front_image = data.get('checkout_front_image')
-    checkout_rear_image = data.get('checkout_rear_image')
-    checkout_latitude = data.get('checkout_latitude')
-    checkout_longitude = data.get('checkout_longitude')
-    checkout_city = data.get('checkout_city', 'Location not captured')
-    checkout_full_address = data.get('checkout_full_address', 'Location not captured')
+    checkout_front_image = images.get('checkout_front_image')
+    checkout_rear_image = images.get('checkout_rear_image')
+    checkout_latitude = parse_coordinate(data.get('checkout_latitude'))
+    checkout_longitude = parse_coordinate(data.get('checkout_longitude'))
+    checkout_city, checkout_full_address = resolve_address(
+        checkout_latitude, checkout_longitude,
+        data.get('checkout_city', 'Location not captured'),
+        data.get('checkout_full_address', 'Location not captured')
+    )
+    checkout_site_id, checkout_off_site = geofences.check(checkout_latitude, checkout_longitude)
     
     # Use IST timezone
-    timestamp = datetime.now(IST).strftime('%Y%m%d_%H%M%S')
     checkout_time = datetime.now(IST).strftime('%Y-%m-%d %H:%M:%S')
-    checkout_front_filename = None
-    checkout_rear_filename = None
-    
-    # Save checkout front image
-    if checkout_front_image:
-        checkout_front_filename = f"checkout_front_{current_user.id}_{timestamp}.jpg"
-        checkout_front_image_data = checkout_front_image.split(',')[1]
-        checkout_front_path = os.path.join(app.config['UPLOAD_FOLDER'], checkout_front_filename)
-        with open(checkout_front_path, 'wb') as f:
-            f.write(base64.b64decode(checkout_front_image_data))
-        create_thumbnail(checkout_front_path, f"thumb_{checkout_front_filename}")
-    
-    # Save checkout rear image
-    if checkout_rear_image:
-        checkout_rear_filename = f"checkout_rear_{current_user.id}_{timestamp}.jpg"
-        checkout_rear_image_data = checkout_rear_image.split(',')[1]
-        checkout_rear_path = os.path.join(app.config['UPLOAD_FOLDER'], checkout_rear_filename)
-        with open(checkout_rear_path, 'wb') as f:
-            f.write(base64.b64decode(checkout_rear_image_data))
-        create_thumbnail(checkout_rear_path, f"thumb_{checkout_rear_filename}")
+    user_id = current_user.id
+    
+    # Save checkout images (outside the write lock)
+    try:
+        checkout_front_key = save_image(checkout_front_image) if checkout_front_image else None
+        checkout_rear_key = save_image(checkout_rear_image) if checkout_rear_image else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Photo is not a valid data URL'}), 400
     
+    def record(conn):
+        for key in (checkout_front_key, checkout_rear_key):
+            if key:
+                queue_photo_jobs(conn, key, user_id, checkout_time)
+        # Days whose summary changes once the open shift is closed
+        open_shift_days = [row['check_in_time'][:10] for row in conn.execute(
+            "SELECT check_in_time FROM attendance WHERE user_id = ? AND status = 'checked_in'",
+            (user_id,)
+        )]
+        conn.execute('''
+            UPDATE attendance 
+            SET check_out_time = ?, 
+                status = 'checked_out',
+                checkout_front_image_path = ?,
+                checkout_rear_image_path = ?,
+                checkout_latitude = ?,
+                checkout_longitude = ?,
+                checkout_city = ?,
+                checkout_full_address = ?,
+                checkout_site_id = ?,
+                checkout_off_site = ?
+            WHERE user_id = ? AND status = 'checked_in'
+        ''', (checkout_time, checkout_front_key, checkout_rear_key, checkout_latitude, checkout_longitude, 
+              checkout_city, checkout_full_address, checkout_site_id, checkout_off_site, user_id))
+        rollup.refresh_days(conn, user_id, open_shift_days)
+        presence_board.changed(conn)
+    
+    punch_writer.run(record)
+    image_worker.notify()
+    presence_board.notify()
+    
+    return jsonify({'success': True, 'message': 'Check-out successful!', 'off_site': bool(checkout_off_site)})
+
+# Offline punch sync. The capture pages queue punches in IndexedDB and the
+# service worker uploads them here in batches once the phone is back online.
+# Multipart batches carry a 'punches' JSON manifest and each photo as a file
+# part named '<key>:<field>'; JSON batches inline the photos as data URLs.
+SYNC_BATCH_LIMIT = 50
+SYNC_MAX_CLOCK_SKEW = timedelta(minutes=5)
+SYNC_MAX_BACKDATE = timedelta(days=7)  # oldest captured_at a queued punch may carry
+IDEMPOTENCY_KEY_PATTERN = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+PUNCH_FIELDS = {
+    'checkin': ('', ('front_image', 'rear_image')),
+    'checkout': ('checkout_', ('checkout_front_image', 'checkout_rear_image')),
+}
+
+def read_sync_request():
+    if request.mimetype == 'multipart/form-data':
+        try:
+            punches = json.loads(request.form.get('punches', ''))
+        except ValueError:
+            return None, None
+        return punches, request.files
+    punches = (request.get_json(silent=True) or {}).get('punches')
+    return punches, None
+
+def parse_sync_punch(punch, files, now):
+    """Validate one queued punch; returns (punch, error message)."""
+    if not isinstance(punch, dict):
+        return None, 'Punch must be an object'
+    key = punch.get('key')
+    kind = punch.get('kind')
+    # Keys must be strings: outcomes are looked up by the key as sent
+    if not isinstance(key, str) or not IDEMPOTENCY_KEY_PATTERN.match(key) or kind not in PUNCH_FIELDS:
+        return None, 'Punch needs a valid key and kind'
+    if punch.get('user_id') is not None and str(punch['user_id']) != str(current_user.id):
+        # Queued by someone else on a shared phone; it stays queued for them
+        return None, 'deferred'
+    try:
+        captured = datetime.fromtimestamp(int(punch['captured_at']) / 1000, IST)
+    except (KeyError, TypeError, ValueError, OverflowError, OSError):
+        return None, 'captured_at must be epoch milliseconds'
+    if captured > now + SYNC_MAX_CLOCK_SKEW:
+        return None, 'captured_at is in the future'
+    if captured < now - SYNC_MAX_BACKDATE:
+        return None, f'captured_at is more than {SYNC_MAX_BACKDATE.days} days old'
+    
+    prefix, image_fields = PUNCH_FIELDS[kind]
+    latitude = parse_coordinate(punch.get(prefix + 'latitude'))
+    longitude = parse_coordinate(punch.get(prefix + 'longitude'))
+    city, full_address = resolve_address(
+        latitude, longitude,
+        punch.get(prefix + 'city', 'Location not captured'),
+        punch.get(prefix + 'full_address', 'Location not captured')
+    )
+    images = {}
+    for field in image_fields:
+        image = files.get(f'{key}:{field}') if files is not None else punch.get(field)
+        if image:
+            images[field] = image
+    return {
+        'key': key, 'kind': kind, 'time': captured.strftime('%Y-%m-%d %H:%M:%S'),
+        'latitude': latitude, 'longitude': longitude, 'city': city, 'full_address': full_address,
+        'site': geofences.check(latitude, longitude), 'images': images,
+    }, None
+
+@app.route('/api/sync', methods=['POST'])
+@login_required
+def api_sync():
+    punches, files = read_sync_request()
+    if not isinstance(punches, list) or not punches:
+        return jsonify({'success': False, 'message': 'No punches to sync'}), 400
+    if len(punches) > SYNC_BATCH_LIMIT:
+        return jsonify({'success': False, 'message': f'At most {SYNC_BATCH_LIMIT} punches per batch'}), 413
+    
+    now = datetime.now(IST)
+    received_at = now.strftime('%Y-%m-%d %H:%M:%S')
+    results = [None] * len(punches)
+    valid = {}
+    for index, punch in enumerate(punches):
+        parsed, error = parse_sync_punch(punch, files, now)
+        if error == 'deferred':
+            results[index] = {'key': punch['key'], 'status': 'deferred', 'message': 'Queued by another user'}
+        elif error:
+            key = punch.get('key') if isinstance(punch, dict) else None
+            results[index] = {'key': key, 'status': 'rejected', 'message': error}
+        else:
+            # A key repeated within the batch gets the first copy's outcome
+            valid.setdefault(parsed['key'], parsed)
+    
+    user_id = current_user.id
     conn = get_db()
-    conn.execute('''
-        UPDATE attendance 
-        SET check_out_time = ?, 
-            status = 'checked_out',
-            checkout_front_image_path = ?,
-            checkout_rear_image_path = ?,
-            checkout_latitude = ?,
-            checkout_longitude = ?,
-            checkout_city = ?,
-            checkout_full_address = ?
-        WHERE user_id = ? AND status = 'checked_in'
-    ''', (checkout_time, checkout_front_filename, checkout_rear_filename, checkout_latitude, checkout_longitude, 
-          checkout_city, checkout_full_address, current_user.id))
-    conn.commit()
-    conn.close()
+    # Punches this user already uploaded need no photos stored; the writer
+    # checks again under the write lock, which is what makes retries safe
+    known = set()
+    if valid:
+        placeholders = ','.join('?' * len(valid))
+        known = {row['idempotency_key'] for row in conn.execute(
+            f'SELECT idempotency_key FROM punch_receipts WHERE user_id = ? AND idempotency_key IN ({placeholders})',
+            [user_id] + list(valid)
+        )}
+    
+    # Store the photos before any lock is taken; a bad photo rejects only its punch
+    bad_photos = {}
+    for key, punch in list(valid.items()):
+        if key in known:
+            continue
+        try:
+            punch['image_keys'] = {field: save_image(image) for field, image in punch['images'].items()}
+        except ValueError:
+            del valid[key]
+            bad_photos[key] = {'key': key, 'status': 'rejected', 'message': 'Photo is not a valid data URL'}
     
-    return jsonify({'success': True, 'message': 'Check-out successful!'})
+    def record(conn):
+        seen = {}
+        if valid:
+            placeholders = ','.join('?' * len(valid))
+            seen = {row['idempotency_key']: row for row in conn.execute(
+                f'SELECT idempotency_key, result, message FROM punch_receipts WHERE user_id = ? AND idempotency_key IN ({placeholders})',
+                [user_id] + list(valid)
+            )}
+        
+        # Replay the new punches in capture order against the user's open shifts
+        open_shifts = [dict(row, new=False) for row in conn.execute(
+            "SELECT id, check_in_time FROM attendance WHERE user_id = ? AND status = 'checked_in'",
+            (user_id,)
+        )]
+        new_shifts = []
+        closed_shifts = []
+        touched_days = []
+        receipts = []
+        outcomes = {}
+        for punch in sorted(valid.values(), key=lambda p: p['time']):
+            if punch['key'] in seen:
+                receipt = seen[punch['key']]
+                outcomes[punch['key']] = {'key': punch['key'], 'status': 'duplicate',
+                                          'original': receipt['result'], 'message': receipt['message']}
+                continue
+            if 'image_keys' not in punch:
+                # Its receipt was deleted since the check above; it stays
+                # queued on the phone and the next upload applies it
+                outcomes[punch['key']] = {'key': punch['key'], 'status': 'deferred', 'message': 'Upload again'}
+                continue
+            
+            # A queued checkout only closes shifts that began before it was captured
+            closable = [shift for shift in open_shifts if shift['check_in_time'] <= punch['time']]
+            if punch['kind'] == 'checkout' and not open_shifts:
+                status, message = 'rejected', 'No open shift to check out of'
+            elif punch['kind'] == 'checkout' and not closable:
+                status, message = 'rejected', 'Checkout is older than the open shift'
+            else:
+                status, message = 'applied', None
+                image_keys = punch['image_keys']
+                for key in image_keys.values():
+                    queue_photo_jobs(conn, key, user_id, punch['time'])
+                site_id, off_site = punch['site']
+                if punch['kind'] == 'checkin':
+                    shift = {'new': True, 'check_in_time': punch['time'], 'checkout': None, 'values': (
+                        user_id, image_keys.get('front_image'), image_keys.get('rear_image'),
+                        punch['latitude'], punch['longitude'], punch['city'], punch['full_address'],
+                        punch['time'], site_id, off_site
+                    )}
+                    new_shifts.append(shift)
+                    open_shifts.append(shift)
+                else:
+                    checkout = (
+                        punch['time'], image_keys.get('checkout_front_image'), image_keys.get('checkout_rear_image'),
+                        punch['latitude'], punch['longitude'], punch['city'], punch['full_address'],
+                        site_id, off_site
+                    )
+                    # Same as /api/checkout: every open shift it can close is closed
+                    for shift in closable:
+                        if shift['new']:
+                            shift['checkout'] = checkout
+                        else:
+                            closed_shifts.append(checkout + (shift['id'],))
+                            touched_days.append(shift['check_in_time'][:10])
+                    open_shifts = [shift for shift in open_shifts if shift['check_in_time'] > punch['time']]
+            receipts.append((user_id, punch['key'], punch['kind'], punch['time'], status, message, received_at))
+            outcomes[punch['key']] = {'key': punch['key'], 'status': status, 'message': message}
+        
+        conn.executemany('''
+            INSERT INTO attendance (user_id, front_image_path, rear_image_path, checkin_latitude, checkin_longitude, city, full_address, check_in_time,
+                                    checkin_site_id, checkin_off_site, status,
+                                    check_out_time, checkout_front_image_path, checkout_rear_image_path,
+                                    checkout_latitude, checkout_longitude, checkout_city, checkout_full_address,
+                                    checkout_site_id, checkout_off_site)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            shift['values'] + (('checked_out',) + shift['checkout'] if shift['checkout'] else ('checked_in',) + (None,) * 9)
+            for shift in new_shifts
+        ])
+        conn.executemany('''
+            UPDATE attendance 
+            SET check_out_time = ?, 
+                status = 'checked_out',
+                checkout_front_image_path = ?,
+                checkout_rear_image_path = ?,
+                checkout_latitude = ?,
+                checkout_longitude = ?,
+                checkout_city = ?,
+                checkout_full_address = ?,
+                checkout_site_id = ?,
+                checkout_off_site = ?
+            WHERE id = ? AND status = 'checked_in'
+        ''', closed_shifts)
+        conn.executemany('''
+            INSERT INTO punch_receipts (user_id, idempotency_key, kind, captured_at, result, message, received_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', receipts)
+        touched_days += [shift['check_in_time'][:10] for shift in new_shifts]
+        rollup.refresh_days(conn, user_id, touched_days)
+        presence_board.changed(conn)
+        return outcomes
+    
+    outcomes = punch_writer.run(record)
+    outcomes.update(bad_photos)
+    image_worker.notify()
+    presence_board.notify()
+    
+    for index, punch in enumerate(punches):
+        if results[index] is None:
+            results[index] = outcomes[punch['key']]
+    return jsonify({'success': True, 'results': results})
+
+# Punch uploads arrive either as multipart/form-data with binary image parts
+# (current capture pages) or as the older JSON body with base64 data URLs.
+def read_punch_request():
+    if request.mimetype == 'multipart/form-data':
+        return request.form, request.files
+    data = request.get_json(silent=True) or {}
+    return data, data
 
-# Helper function to create thumbnails
-def create_thumbnail(image_path, thumb_filename, size=(150, 150)):
+def parse_coordinate(value):
     try:
-        with Image.open(image_path) as img:
-            img.thumbnail(size, Image.Resampling.LANCZOS)
-            thumb_path = os.path.join(app.config['UPLOAD_FOLDER'], thumb_filename)
-            img.save(thumb_path, 'JPEG', quality=85)
-    except Exception as e:
-        print(f"Error creating thumbnail: {e}")
+        return float(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+# Placeholders the capture pages send when they could not name the place
+UNRESOLVED_CITIES = ('', 'Location not captured', 'Location captured', 'Location captured (coordinates only)')
+
+def resolve_address(latitude, longitude, city, full_address):
+    # Prefer the cached address for the site over whatever the phone could
+    # (not) resolve; user-typed corrections are kept as they are. Only the
+    # cache is consulted so a punch never waits on the geocoding provider.
+    if latitude is None or longitude is None or (latitude == 0 and longitude == 0):
+        return city, full_address
+    if city and city not in UNRESOLVED_CITIES:
+        return city, full_address
+    cached = geocoder.lookup(latitude, longitude, remote=False)
+    if cached:
+        return cached['city'], cached['full_address']
+    return city, full_address
+
+def decode_data_url(value):
+    """Bytes of a base64 data URL; ValueError if it isn't one."""
+    if not isinstance(value, str) or ',' not in value:
+        raise ValueError('Not a data URL')
+    return base64.b64decode(value.split(',', 1)[1], validate=True)  # binascii.Error is a ValueError
+
+# Helper function to store an uploaded photo, returns its image store key.
+# Raises ValueError for a malformed data URL.
+def save_image(image):
+    if isinstance(image, FileStorage):
+        temp_path = getattr(image.stream, 'name', None)
+        if isinstance(temp_path, str) and os.path.basename(temp_path).startswith('.upload-'):
+            # Already streamed to a temp file in the upload folder
+            image.stream.close()
+            with open(temp_path, 'rb') as f:
+                suffix = image_policy.suffix_for(f.read(16))
+            with metrics.span('image.write'):
+                return image_store.put_file(temp_path, suffix)
+        data = image.read()
+    else:
+        with metrics.span('image.decode'):
+            data = decode_data_url(image)
+    with metrics.span('image.write'):
+        return image_store.put_bytes(data, image_policy.suffix_for(data[:16]))
+
+def rendition_key(key, name):
+    return thumbnail_key(key, prefix=f'{name}_')
+
+# Image worker jobs. Errors are left to propagate so the job is retried and
+# then recorded as failed.
+def create_rendition(image_key, name):
+    """Render and store the `name` rendition of a photo unless it exists."""
+    target = rendition_key(image_key, name)
+    if image_store.exists(target):
+        return target  # Same photo was uploaded before
+    from PIL import Image
+    with metrics.span('rendition'):
+        with image_store.open(image_key) as f, Image.open(f) as img:
+            data = image_policy.rendition(img, name, format_for_key(image_key))
+        image_store.write(target, data)
+    return target
+
+def create_thumbnail(image_key, thumb_key):
+    create_rendition(image_key, 'thumb')
+
+def optimize_image(image_key, thumb_key):
+    """Bring an upload within the image policy, then make its thumbnail.
+
+    Oversize photos are re-encoded in place under the same key; the result
+    is only kept if it is actually smaller.
+    """
+    from PIL import Image
+    with metrics.span('optimize'):
+        with image_store.open(image_key) as f:
+            original = f.read()
+        with Image.open(io.BytesIO(original)) as img:
+            if image_policy.needs_reencode(img, len(original)):
+                data = image_policy.reencode(img, format_for_key(image_key))
+                if len(data) < len(original):
+                    image_store.write(image_key, data)
+    create_rendition(image_key, 'thumb')
+
+image_worker.register('thumbnail', create_thumbnail)
+image_worker.register('optimize', optimize_image)
+
+# Ages photos down to renditions, then out, moves old months of attendance
+# into compressed archives and trims receipts, finished image jobs and the
+# ledger of purged photos, in background passes
+retention_engine = retention.RetentionEngine(
+    image_store, image_worker,
+    rendition_keys=lambda key: [rendition_key(key, name) for name in RENDITIONS],
+    ensure_renditions=lambda key: [create_rendition(key, name) for name in RENDITIONS],
+    archive_folder=app.config['ARCHIVE_FOLDER'],
+    originals_days=app.config['RETAIN_ORIGINALS_DAYS'],
+    renditions_days=app.config['RETAIN_RENDITIONS_DAYS'],
+    hot_rows_days=app.config['RETAIN_HOT_ROWS_DAYS'],
+    jobs_days=app.config['IMAGE_JOBS_KEEP_DAYS'],
+    receipts_days=app.config['RETAIN_RECEIPTS_DAYS'],
+    batch_size=app.config['RETENTION_BATCH'],
+)
+image_worker.register(retention.JOB_KIND, retention_engine.run_job)
+
+# Perceptual hashes of punch photos, compared against the worker's earlier
+# photos to flag replays from the gallery
+photo_fingerprints = photo_hash.PhotoFingerprints(
+    image_store,
+    sources=lambda key: [key, rendition_key(key, 'medium'), rendition_key(key, 'thumb')],
+    phash_distance=app.config['PHOTO_MATCH_PHASH_BITS'],
+    dhash_distance=app.config['PHOTO_MATCH_DHASH_BITS'],
+)
+image_worker.register(photo_hash.JOB_KIND, photo_fingerprints.run_job)
+
+def queue_photo_jobs(conn, key, user_id, captured_at):
+    """Queue the background work for a newly stored punch photo."""
+    retention_engine.track(conn, [(key, captured_at)])
+    image_worker.enqueue(conn, 'optimize', key, thumbnail_key(key))
+    image_worker.enqueue(conn, photo_hash.JOB_KIND, key, photo_hash.job_target(user_id, captured_at))
+
+@app.route('/media/<path:key>')
+@login_required
+def media(key):
+    return image_store.send(key)
+
+@app.route('/rendition/<any(thumb, medium):name>/<path:key>')
+@login_required
+def rendition(name, key):
+    # Rendered on first request and kept in the image store after that
+    try:
+        target = create_rendition(key, name)
+    except (ValueError, OSError):
+        abort(404)
+    return image_store.send(target)
+
+@app.route('/sw.js')
+def service_worker():
+    # Served from the root so the worker's scope covers every page
+    response = app.send_static_file('sw.js')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.template_global()
+def image_url(key, thumbnail=False, rendition=None):
+    if not key:
+        return None
+    if thumbnail:
+        rendition = 'thumb'
+    if rendition:
+        return url_for('rendition', name=rendition, key=key)
+    return url_for('media', key=key)
 
 # Admin routes
+@app.route('/admin/image_queue')
+@login_required
+@admin_required
+def image_queue_status():
+    stats = image_worker.stats()
+    stats['failed_jobs'] = image_worker.failed_jobs()
+    return jsonify(stats)
+
+@app.route('/admin/monthly_summary')
+@login_required
+@admin_required
+def monthly_summary():
+    month = request.args.get('month') or datetime.now(IST).strftime('%Y-%m')
+    try:
+        rows = rollup.monthly_summary(get_db(), month)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Month must be YYYY-MM'}), 400
+    return jsonify({'success': True, 'month': month, 'users': rows})
+
+PAYROLL_CSV_COLUMNS = ('username', 'week_start', 'hours', 'regular_hours', 'overtime_hours', 'night_hours',
+                       'shifts', 'stale_shifts', 'open_shifts')
+
+@app.route('/admin/payroll')
+@login_required
+@admin_required
+def payroll_report():
+    # Whole IST weeks (Monday to Sunday) covering start..end; defaults to this month so far
+    today = datetime.now(IST)
+    start_date = request.args.get('start') or today.strftime('%Y-%m-01')
+    end_date = request.args.get('end') or today.strftime('%Y-%m-%d')
+    try:
+        report = payroll_engine.report(get_db(), start_date, end_date, today.replace(tzinfo=None))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    if request.args.get('format') == 'csv':
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(PAYROLL_CSV_COLUMNS)
+        writer.writerows([row[column] for column in PAYROLL_CSV_COLUMNS] for row in report['weeks'])
+        return Response(buf.getvalue(), mimetype='text/csv', headers={
+            'Content-Disposition': f"attachment; filename=payroll_{report['start']}_to_{report['end']}.csv"
+        })
+    return jsonify(dict(report, success=True))
+
+@app.route('/api/admin/stats')
+@login_required
+@admin_required
+def api_admin_stats():
+    work_date = request.args.get('date') or datetime.now(IST).strftime('%Y-%m-%d')
+    return jsonify({'success': True, 'stats': rollup.day_stats(get_db(), work_date)})
+
+def valid_point(lat, lon):
+    return math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180
+
+@app.route('/admin/sites', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def sites():
+    conn = get_db()
+    if request.method == 'GET':
+        rows = conn.execute('SELECT * FROM sites ORDER BY name').fetchall()
+        return jsonify({'success': True, 'sites': [
+            dict(row, polygon=json.loads(row['polygon']) if row['polygon'] else None) for row in rows
+        ]})
+    
+    data = request.get_json(silent=True) or {}
+    name = (data.get('name') or '').strip()
+    polygon = data.get('polygon')
+    try:
+        if polygon:
+            polygon = [[float(lat), float(lon)] for lat, lon in polygon]
+            if len(polygon) < 3 or not all(valid_point(lat, lon) for lat, lon in polygon):
+                raise ValueError
+            kind = 'polygon'
+            center_lat = sum(p[0] for p in polygon) / len(polygon)
+            center_lon = sum(p[1] for p in polygon) / len(polygon)
+            radius_m = None
+        else:
+            kind = 'radius'
+            center_lat = float(data['latitude'])
+            center_lon = float(data['longitude'])
+            radius_m = float(data.get('radius_m', 200))
+            if not valid_point(center_lat, center_lon) or not (math.isfinite(radius_m) and radius_m > 0):
+                raise ValueError
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Give latitude (-90 to 90), longitude (-180 to 180) and a positive radius_m, '
+                                                     'or a polygon of at least 3 such [lat, lon] points'}), 400
+    if not name:
+        return jsonify({'success': False, 'message': 'Site name is required'}), 400
+    
+    cursor = conn.execute('''
+        INSERT INTO sites (name, kind, center_lat, center_lon, radius_m, polygon)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (name, kind, center_lat, center_lon, radius_m, json.dumps(polygon) if polygon else None))
+    geofences.sites_changed(conn)
+    conn.commit()
+    return jsonify({'success': True, 'id': cursor.lastrowid}), 201
+
+@app.route('/admin/sites/<int:site_id>/toggle', methods=['POST'])
+@login_required
+@admin_required
+def toggle_site(site_id):
+    conn = get_db()
+    conn.execute('UPDATE sites SET active = 1 - active WHERE id = ?', (site_id,))
+    geofences.sites_changed(conn)
+    conn.commit()
+    return jsonify({'success': True})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus scrapes with the bearer token; without one set, admins only
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    elif not (current_user.is_authenticated and current_user.role == 'admin'):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@metrics.gauge('image_jobs_pending', 'Thumbnail jobs waiting or running.')
+def image_jobs_pending():
+    return image_worker.depth()
+
+@metrics.gauge('user_cache_hit_ratio', 'Hit ratio of the in-process user cache.')
+def user_cache_hit_ratio():
+    return user_cache.stats()['hit_ratio']
+
+@app.route('/admin/cache_stats')
+@login_required
+@admin_required
+def cache_stats():
+    return jsonify({'users': user_cache.stats(), 'geocoding': geocoder.stats(), 'punch_writer': punch_writer.stats(),
+                    'photo_fingerprints': photo_fingerprints.stats()})
+
+@app.route('/admin/photo_matches')
+@login_required
+@admin_required
+def photo_matches():
+    # Newest flagged photos first, for review
+    limit = page_size()
+    rows = get_db().execute('''
+        SELECT m.*, u.username, mu.username AS matched_username
+        FROM photo_matches m
+        JOIN users u ON m.user_id = u.id
+        LEFT JOIN users mu ON m.matched_user_id = mu.id
+        ORDER BY m.captured_at DESC
+        LIMIT ?
+    ''', (limit,)).fetchall()
+    return jsonify({'success': True, 'matches': [
+        dict(row, thumb_url=image_url(row['key'], thumbnail=True),
+             matched_thumb_url=image_url(row['matched_key'], thumbnail=True))
+        for row in rows
+    ]})
+
+@app.route('/admin/retention', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def retention_status():
+    conn = get_db()
+    if request.method == 'POST':
+        # Run a pass now instead of waiting for the daily one
+        retention_engine.schedule(conn)
+        conn.commit()
+        image_worker.notify()
+    return jsonify(retention_engine.status(conn))
+
+@app.route('/admin/presence')
+@login_required
+@admin_required
+def presence_snapshot():
+    seq, workers = presence_board.snapshot()
+    return jsonify({'success': True, 'seq': seq, 'workers': workers, 'stats': presence_board.stats()})
+
+@app.route('/admin/presence/stream')
+@login_required
+@admin_required
+def presence_stream():
+    subscriber = presence_board.subscribe()
+    if subscriber is None:
+        # Every stream this worker allows is open; the dashboard polls instead
+        return jsonify({'success': False, 'message': 'Too many live dashboards open'}), 503, {'Retry-After': '30'}
+    try:
+        snapshot = presence_board.snapshot()
+    except BaseException:
+        presence_board.unsubscribe(subscriber)
+        raise
+    # Not stream_with_context: the stream must not keep the request's
+    # database connection checked out while it waits
+    response = Response(presence_board.stream(subscriber, snapshot), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # nginx/Render: flush each event
+    })
+    # Frees the slot even if the stream is closed before it starts
+    response.call_on_close(lambda: presence_board.unsubscribe(subscriber))
+    return response
+
 @app.route('/admin/delete_all_records', methods=['POST'])
 @login_required
 @admin_required
@@ -405,133 +1308,187 @@ def delete_all_records():
     admin = conn.execute('SELECT * FROM users WHERE id = ?', (current_user.id,)).fetchone()
     
     if not admin or not check_password_hash(admin['password_hash'], admin_password):
-        conn.close()
         flash('Invalid password. Delete operation cancelled.', 'danger')
         return redirect(url_for('admin_dashboard'))
     
     try:
+        # Hand the photos to the retention job in the same transaction as
+        # the delete; it removes them (and their renditions) in batches
+        image_keys = {}
+        for row in conn.execute(f'''
+            SELECT check_in_time, {', '.join(retention.IMAGE_COLUMNS)} FROM attendance
+        '''):
+            for key in tuple(row)[1:]:
+                if key:
+                    image_keys[key] = max(image_keys.get(key, ''), row['check_in_time'] or '')
+        retention.enroll_keys(conn, image_keys.items(), orphaned=1)
+        
         # Delete all attendance records
         conn.execute('DELETE FROM attendance')
+        conn.execute('DELETE FROM daily_attendance_summary')
+        photo_fingerprints.reset(conn)
+        retention_engine.schedule(conn)
+        presence_board.changed(conn)
         conn.commit()
-        conn.close()
-        
-        # Delete all uploaded images
-        upload_folder = app.config['UPLOAD_FOLDER']
-        for filename in os.listdir(upload_folder):
-            if filename.endswith(('.jpg', '.jpeg', '.png')):
-                file_path = os.path.join(upload_folder, filename)
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
+        image_worker.notify()
+        presence_board.notify()
         
-        flash('All attendance records deleted successfully', 'success')
+        flash('All attendance records deleted successfully; their photos are removed in the background', 'success')
     except Exception as e:
         flash(f'Error deleting records: {str(e)}', 'danger')
     
     return redirect(url_for('admin_dashboard'))
 
+REPORT_HEADERS = ['User', 'Check In', 'Check Out', 'Duration (hrs)', 'Check-in Location',
+                  'Check-out Location', 'Status']
+REPORT_MIMETYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+REPORT_WIDTH_SAMPLE = 200  # rows used to size the Excel columns
+REPORT_STREAM_BATCH = 500  # rows per chunk of a streamed CSV/NDJSON response
+
+def report_rows(cursor):
+    """Turn report query rows into output rows, one at a time."""
+    for record in cursor:
+        duration = 'N/A'
+        if record['check_out_time']:
+            try:
+                checkin = datetime.strptime(record['check_in_time'], '%Y-%m-%d %H:%M:%S')
+                checkout = datetime.strptime(record['check_out_time'], '%Y-%m-%d %H:%M:%S')
+                duration_hours = (checkout - checkin).total_seconds() / 3600
+                duration = f"{duration_hours:.2f}"
+            except:
+                pass
+        
+        checkin_loc = record['city'] or 'Not captured'
+        if record['checkin_latitude'] and record['checkin_longitude'] and record['checkin_latitude'] != 0:
+            checkin_loc += f" ({record['checkin_latitude']:.4f}, {record['checkin_longitude']:.4f})"
+        
+        checkout_loc = record['checkout_city'] or 'Not captured'
+        if record['checkout_latitude'] and record['checkout_longitude'] and record['checkout_latitude'] != 0:
+            checkout_loc += f" ({record['checkout_latitude']:.4f}, {record['checkout_longitude']:.4f})"
+        
+        yield [
+            record['username'],
+            record['check_in_time'],
+            record['check_out_time'] or 'N/A',
+            duration,
+            checkin_loc,
+            checkout_loc,
+            record['status']
+        ]
+
+def stream_csv(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(REPORT_HEADERS)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % REPORT_STREAM_BATCH == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def stream_ndjson(rows):
+    batch = []
+    for row in rows:
+        batch.append(json.dumps(dict(zip(REPORT_HEADERS, row))))
+        if len(batch) == REPORT_STREAM_BATCH:
+            yield '\n'.join(batch) + '\n'
+            batch = []
+    if batch:
+        yield '\n'.join(batch) + '\n'
+
+def write_xlsx_report(rows, output):
+    """Write the report with openpyxl's write-only mode, which streams rows to
+    disk instead of keeping every cell in memory."""
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Alignment, PatternFill
+    from openpyxl.utils import get_column_letter
+    
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Attendance Report")
+    
+    # Column widths have to be set before any row is written, so size them
+    # from the first rows rather than a second pass over the whole report.
+    sample = list(itertools.islice(rows, REPORT_WIDTH_SAMPLE))
+    for index, header in enumerate(REPORT_HEADERS):
+        max_length = max([len(header)] + [len(str(row[index])) for row in sample])
+        ws.column_dimensions[get_column_letter(index + 1)].width = min(max_length + 2, 50)
+    
+    # Style headers
+    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+    header_font = Font(bold=True, color="FFFFFF")
+    header_cells = []
+    for header in REPORT_HEADERS:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.fill = header_fill
+        cell.font = header_font
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        header_cells.append(cell)
+    ws.append(header_cells)
+    
+    for row in itertools.chain(sample, rows):
+        ws.append(row)
+    wb.save(output)
+
 @app.route('/admin/export_report')
 @login_required
 @admin_required
 def export_report():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    report_format = request.args.get('format', 'xlsx')
     
     if not start_date or not end_date:
         flash('Please provide start and end dates', 'danger')
         return redirect(url_for('admin_dashboard'))
     
+    if report_format not in REPORT_MIMETYPES:
+        flash(f'Unknown report format: {report_format}', 'danger')
+        return redirect(url_for('admin_dashboard'))
+    
     try:
-        import openpyxl
-        from openpyxl.styles import Font, Alignment, PatternFill
-        
-        # Create workbook
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Attendance Report"
-        
-        # Headers
-        headers = ['User', 'Check In', 'Check Out', 'Duration (hrs)', 'Check-in Location', 
-                   'Check-out Location', 'Status']
-        ws.append(headers)
-        
-        # Style headers
-        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF")
-        for cell in ws[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-        
-        # Get data with date filter
+        # Get data with date filter. Compare the raw column against a
+        # half-open range so the check_in_time index can be used.
+        range_end = (datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
         conn = get_db()
-        records = conn.execute('''
+        cursor = conn.execute('''
             SELECT u.username, a.check_in_time, a.check_out_time, a.city, 
                    a.checkout_city, a.status, a.checkin_latitude, a.checkin_longitude,
                    a.checkout_latitude, a.checkout_longitude
             FROM attendance a
             JOIN users u ON a.user_id = u.id
-            WHERE DATE(a.check_in_time) BETWEEN ? AND ?
+            WHERE a.check_in_time >= ? AND a.check_in_time < ?
             ORDER BY a.check_in_time DESC
-        ''', (start_date, end_date)).fetchall()
-        conn.close()
-        
-        # Add data
-        for record in records:
-            duration = 'N/A'
-            if record['check_out_time']:
-                try:
-                    checkin = datetime.strptime(record['check_in_time'], '%Y-%m-%d %H:%M:%S')
-                    checkout = datetime.strptime(record['check_out_time'], '%Y-%m-%d %H:%M:%S')
-                    duration_hours = (checkout - checkin).total_seconds() / 3600
-                    duration = f"{duration_hours:.2f}"
-                except:
-                    pass
-            
-            checkin_loc = record['city'] or 'Not captured'
-            if record['checkin_latitude'] and record['checkin_longitude'] and record['checkin_latitude'] != 0:
-                checkin_loc += f" ({record['checkin_latitude']:.4f}, {record['checkin_longitude']:.4f})"
-            
-            checkout_loc = record['checkout_city'] or 'Not captured'
-            if record['checkout_latitude'] and record['checkout_longitude'] and record['checkout_latitude'] != 0:
-                checkout_loc += f" ({record['checkout_latitude']:.4f}, {record['checkout_longitude']:.4f})"
-            
-            ws.append([
-                record['username'],
-                record['check_in_time'],
-                record['check_out_time'] or 'N/A',
-                duration,
-                checkin_loc,
-                checkout_loc,
-                record['status']
-            ])
-        
-        # Adjust column widths
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(cell.value)
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws.column_dimensions[column_letter].width = adjusted_width
+        ''', (start_date, range_end))
+        rows = report_rows(cursor)
         
-        # Save to BytesIO
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
+        filename = f'attendance_report_{start_date}_to_{end_date}.{report_format}'
         
-        filename = f'attendance_report_{start_date}_to_{end_date}.xlsx'
+        if report_format == 'xlsx':
+            # An xlsx file is a zip archive and can't be sent until it is
+            # finished, so build it in an anonymous temp file and stream that.
+            output = tempfile.TemporaryFile()
+            write_xlsx_report(rows, output)
+            output.seek(0)
+            return send_file(
+                output,
+                mimetype=REPORT_MIMETYPES['xlsx'],
+                as_attachment=True,
+                download_name=filename
+            )
         
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
+        # CSV and NDJSON rows go out in chunks as the cursor is read
+        generate = stream_csv if report_format == 'csv' else stream_ndjson
+        return Response(
+            stream_with_context(generate(rows)),
+            mimetype=REPORT_MIMETYPES[report_format],
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
         )
     except ImportError:
         flash('openpyxl library not installed. Run: pip install openpyxl', 'danger')
@@ -540,6 +1497,155 @@ def export_report():
         flash(f'Error generating report: {str(e)}', 'danger')
         return redirect(url_for('admin_dashboard'))
 
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the tables and apply pending schema migrations."""
+    app_bootstrap.ensure(force=True)
+    print('Database is up to date')
+
+@app.cli.command('import-users')
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--dry-run', is_flag=True, help='Only validate the rows')
+def import_users_command(csv_file, dry_run):
+    """Create users from a CSV (username,email,password[,role,location_enabled])."""
+    rows = user_import.parse_csv(csv_file.read())
+    app_bootstrap.ensure()  # Onboarding a new deployment may start here
+    conn = get_db()
+    accepted = 0
+    for start in range(0, len(rows), user_import.MAX_ROWS):
+        _, results = user_import.import_users(conn, rows[start:start + user_import.MAX_ROWS],
+                                              password_hasher, dry_run=dry_run)
+        conn.commit()
+        for result in results:
+            if result['status'] == 'rejected':
+                print(f"row {start + result['row']}: {result['username'] or '-'}: {result['message']}")
+            else:
+                accepted += 1
+    password_hasher.shutdown()
+    print(f'{accepted} of {len(rows)} users {"valid" if dry_run else "created"}')
+
+@app.cli.command('backfill-summary')
+@click.option('--start', 'start_date', help='First work date to rebuild (YYYY-MM-DD)')
+@click.option('--end', 'end_date', help='Last work date to rebuild (YYYY-MM-DD)')
+def backfill_summary_command(start_date, end_date):
+    """Rebuild daily_attendance_summary from attendance history."""
+    conn = get_db()
+    # Archived months keep the summaries they had; their rows are gone
+    archived_before = retention.get_state(conn, 'archived_before')
+    if archived_before and (start_date or '') < archived_before:
+        print(f'Keeping summaries before {archived_before} (archived months)')
+        start_date = archived_before
+    written = rollup.backfill(conn, start_date, end_date)
+    print(f'Wrote {written} daily summary rows')
+
+@app.cli.command('optimize-images')
+def optimize_images_command():
+    """Queue every stored photo for re-encoding to the current image policy."""
+    conn = get_db()
+    keys = set()
+    for row in conn.execute('''
+        SELECT front_image_path, rear_image_path, checkout_front_image_path, checkout_rear_image_path
+        FROM attendance
+    '''):
+        keys.update(key for key in row if key)
+    for key in keys:
+        image_worker.enqueue(conn, 'optimize', key, thumbnail_key(key))
+    conn.commit()
+    print(f'Queued {len(keys)} photos; the image worker re-encodes them in the background')
+
+@app.cli.command('fingerprint-photos')
+@click.option('--workers', type=int, default=os.cpu_count() or 1, show_default=True,
+              help='Processes hashing photos in parallel')
+@click.option('--batch', type=int, default=500, show_default=True, help='Attendance rows per transaction')
+def fingerprint_photos_command(workers, batch):
+    """Fingerprint stored punch photos and flag replays, oldest punch first."""
+    from concurrent.futures import ProcessPoolExecutor
+    conn = get_db()
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    hash_many = pool.map if pool else map
+    after = ('', 0)
+    rows = hashed = flagged = 0
+    try:
+        while True:
+            page = conn.execute('''
+                SELECT id, user_id, check_in_time, check_out_time, front_image_path, rear_image_path,
+                       checkout_front_image_path, checkout_rear_image_path
+                FROM attendance
+                WHERE (check_in_time, id) > (?, ?)
+                ORDER BY check_in_time, id
+                LIMIT ?
+            ''', after + (batch,)).fetchall()
+            if not page:
+                break
+            after = (page[-1]['check_in_time'], page[-1]['id'])
+            photos = [photo for row in page for _, photo in punch_photos(row)]
+            new_keys = list({key for key, _, _ in photos if not photo_fingerprints.known(conn, key)})
+            # Decoding dominates, so it runs in the pool (a few photos' bytes
+            # in flight at a time); matching stays here, in punch order
+            hashes = {}
+            for start in range(0, len(new_keys), 32):
+                chunk = new_keys[start:start + 32]
+                hashes.update(zip(chunk, hash_many(photo_hash.fingerprint_bytes,
+                                                   [photo_fingerprints.read(key) or b'' for key in chunk])))
+            for key, user_id, captured_at in photos:
+                if hashes.get(key, True) is None:
+                    continue  # Unreadable or already purged
+                if photo_fingerprints.record(conn, key, user_id, captured_at, hashes.get(key)):
+                    flagged += 1
+            conn.commit()
+            rows += len(page)
+            hashed += sum(1 for value in hashes.values() if value)
+            print(f'{rows} punches, {hashed} photos hashed, {flagged} repeats found')
+    finally:
+        if pool:
+            pool.shutdown()
+    print(f'Done: {hashed} photos hashed, {flagged} repeats found')
+
+@app.cli.command('retention')
+@click.option('--run-now', is_flag=True, help='Run every pending pass in this process instead of the worker')
+def retention_command(run_now):
+    """Show the retention policy and progress, optionally catching up now."""
+    conn = get_db()
+    if run_now:
+        passes = 1
+        while retention_engine.run_pass(conn):
+            passes += 1
+        print(f'Ran {passes} retention passes')
+    print(json.dumps(retention_engine.status(conn), indent=2))
+
+@app.cli.command('archive-export')
+@click.option('--month', required=True, help='Archived month to export (YYYY-MM)')
+def archive_export_command(month):
+    """Write an archived month of attendance to stdout as CSV."""
+    rows = retention.archived_rows(app.config['ARCHIVE_FOLDER'], month)
+    first = next(rows, None)
+    if first is None:
+        raise click.ClickException(f'No archive for {month}')
+    writer = csv.DictWriter(click.get_text_stream('stdout'), fieldnames=list(first))
+    writer.writeheader()
+    writer.writerow(first)
+    writer.writerows(rows)
+
+@app.cli.command('revalidate-geofences')
+@click.option('--start', 'start_date', help='First check-in date to re-check (YYYY-MM-DD)')
+@click.option('--end', 'end_date', help='Last check-in date to re-check (YYYY-MM-DD)')
+def revalidate_geofences_command(start_date, end_date):
+    """Re-check stored punches against the current site geofences."""
+    checked, off_site = geofence.revalidate(get_db(), start_date, end_date and rollup.next_day(end_date))
+    print(f'Checked {checked} punches, {off_site} off site')
+
+def create_app():
+    """Return the app with its upload folder and database ready to serve.
+
+    Routes and extensions are registered on the module-level `app` when this
+    module is imported; this does the one-time setup up front instead of on
+    the first request. gunicorn.conf.py preloads it, so the master does the
+    setup once before forking the workers.
+    """
+    app_bootstrap.ensure()
+    # Workers open their own connections; don't keep the master's around
+    app.extensions['db_pool'].close_all()
+    return app
+
 if __name__ == '__main__':
-    init_db()
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,489 @@
+"""Load benchmark for the punch and report paths.
+
+Seeds a throwaway database with N workers and M days of shift history
+(real JPEG photos in the image store), then drives the real routes the way
+a site looks at shift change: everyone logs in, checks in, opens their
+dashboard and checks out, while admins load the dashboard and pull the
+report export; then every phone uploads a shift it queued offline through
+/api/sync, and uploads it again as a retry would. Runs under gunicorn or in-process through the Flask test
+client.
+
+    python benchmark.py --users 200 --days 30 --server gunicorn --workers 4
+    python benchmark.py --server testclient --save baseline.json
+    python benchmark.py --compare baseline.json --tolerance 0.2
+
+Each phase reports p50/p95/p99 latency, throughput and failures. Peak RSS is
+the high-water mark of the gunicorn workers (or of this process for the
+test client). Lock waits come from a probe that tries BEGIN IMMEDIATE with
+no busy timeout every few milliseconds during the run: lock_busy counts the
+probes that found the write lock already held, i.e. a writer would have had
+to wait.
+"""
+import argparse
+import base64
+import http.cookiejar
+import io
+import json
+import os
+import random
+import resource
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from PIL import Image
+from werkzeug.security import generate_password_hash
+
+from image_store import LocalImageStore
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'bench123'
+ADMIN = ('admin', 'admin123')
+SITE = {'latitude': 13.11, 'longitude': 80.10, 'city': 'Avadi', 'full_address': 'Avadi, Chennai'}
+
+
+def make_jpeg(size=(640, 480), rng=random):
+    """A noisy photo-sized JPEG (solid colours compress to almost nothing)."""
+    noise = bytes(rng.getrandbits(8) for _ in range(size[0] * size[1] // 64 * 3))
+    img = Image.frombytes('RGB', (size[0] // 8, size[1] // 8), noise).resize(size)
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=80)
+    return buf.getvalue()
+
+
+def unique_jpeg(base, tag):
+    """`base` with a comment segment after SOI, so every upload hashes differently."""
+    comment = tag.encode()
+    return base[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + base[2:]
+
+
+def data_url(data):
+    return 'data:image/jpeg;base64,' + base64.b64encode(data).decode()
+
+
+def encode_json(fields, images):
+    payload = dict(fields)
+    for name, data in images.items():
+        payload[name] = data_url(data)
+    return json.dumps(payload).encode(), 'application/json'
+
+
+def encode_multipart(fields, images):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, data in images.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{name}.jpg"\r\n'
+            f'Content-Type: image/jpeg\r\n\r\n'.encode() + data + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+ENCODERS = {'json': encode_json, 'multipart': encode_multipart}
+
+
+def seed_database(env, users, days, rng, photo_pool=16):
+    """Create the schema, `users` workers and `days` days of finished shifts
+    ending yesterday, with photos from a pool stored in the image store."""
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'],
+                   cwd=HERE, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    store = LocalImageStore(env['UPLOAD_FOLDER'])
+    keys = [store.put_bytes(make_jpeg(rng=rng)) for _ in range(photo_pool)]
+
+    conn = sqlite3.connect(env['DATABASE_PATH'])
+    pw = generate_password_hash(PASSWORD)
+    conn.executemany(
+        'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+        [(f'worker{i}', f'worker{i}@bench.local', pw) for i in range(users)]
+    )
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users WHERE role = 'user'")]
+    today = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0)
+    for day in range(days, 0, -1):
+        rows = []
+        for user_id in user_ids:
+            check_in = today - timedelta(days=day) + timedelta(minutes=rng.randint(0, 90))
+            check_out = check_in + timedelta(hours=8, minutes=rng.randint(0, 120))
+            lat = SITE['latitude'] + rng.uniform(-0.001, 0.001)
+            lon = SITE['longitude'] + rng.uniform(-0.001, 0.001)
+            rows.append((
+                user_id, check_in.strftime('%Y-%m-%d %H:%M:%S'), check_out.strftime('%Y-%m-%d %H:%M:%S'),
+                rng.choice(keys), rng.choice(keys), rng.choice(keys), rng.choice(keys),
+                lat, lon, lat, lon, SITE['city'], SITE['full_address'], SITE['city'], SITE['full_address'],
+            ))
+        conn.executemany('''
+            INSERT INTO attendance (user_id, check_in_time, check_out_time, status,
+                front_image_path, rear_image_path, checkout_front_image_path, checkout_rear_image_path,
+                checkin_latitude, checkin_longitude, checkout_latitude, checkout_longitude,
+                city, full_address, checkout_city, checkout_full_address)
+            VALUES (?, ?, ?, 'checked_out', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'backfill-summary'],
+                   cwd=HERE, env=env, check=True, stdout=subprocess.DEVNULL)
+    return len(user_ids) * days
+
+
+class HttpClient:
+    """One logged-in browser session against a running server."""
+
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self._NoRedirect()
+        )
+
+    def request(self, method, path, body=None, content_type=None):
+        headers = {'Content-Type': content_type} if content_type else {}
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(req) as resp:
+                return resp.status, resp.read(), resp.headers.get('Location')
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.headers.get('Location')
+
+
+class TestClient:
+    """Same interface over the Flask test client, in this process."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, content_type=None):
+        resp = self.client.open(path, method=method, data=body, content_type=content_type)
+        return resp.status_code, resp.get_data(), resp.headers.get('Location')
+
+
+def login_ok(status, body, location):
+    return status == 302 and bool(location) and '/login' not in location
+
+
+def page_ok(status, body, location):
+    return status == 200
+
+
+def api_ok(status, body, location):
+    try:
+        return status == 200 and json.loads(body).get('success', False)
+    except ValueError:
+        return False
+
+
+def sync_ok(status, body, location):
+    """Every punch in the batch was applied, or answered from its receipt on a retry."""
+    try:
+        results = json.loads(body)['results'] if status == 200 else []
+    except (ValueError, KeyError):
+        return False
+    return bool(results) and all(r['status'] in ('applied', 'duplicate') for r in results)
+
+
+class LockProbe(threading.Thread):
+    """Samples whether the SQLite write lock is held, without waiting for it."""
+
+    def __init__(self, database, interval=0.005):
+        super().__init__(daemon=True)
+        self.database = database
+        self.interval = interval
+        self.probes = 0
+        self.busy = 0
+        self._done = threading.Event()
+
+    def run(self):
+        conn = sqlite3.connect(self.database, timeout=0, isolation_level=None)
+        while not self._done.wait(self.interval):
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('ROLLBACK')
+            except sqlite3.OperationalError:
+                self.busy += 1
+            self.probes += 1
+        conn.close()
+
+    def snapshot(self):
+        return self.probes, self.busy
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_phase(probe, clients, requests, check, concurrency):
+    """Send requests[i] = (method, path, body, content_type) from clients[i]."""
+    def send(pair):
+        client, (method, path, body, content_type) = pair
+        start = time.perf_counter()
+        try:
+            status, payload, location = client.request(method, path, body, content_type)
+            ok = check(status, payload, location)
+        except OSError:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    probes_before, busy_before = probe.snapshot()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(min(concurrency, len(requests))) as pool:
+        samples = list(pool.map(send, zip(clients, requests)))
+    elapsed = time.perf_counter() - start
+    probes_after, busy_after = probe.snapshot()
+
+    latencies = [s[0] * 1000 for s in samples]
+    return {
+        'requests': len(samples),
+        'failures': sum(1 for s in samples if not s[1]),
+        'throughput_rps': round(len(samples) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 1),
+        'p95_ms': round(percentile(latencies, 95), 1),
+        'p99_ms': round(percentile(latencies, 99), 1),
+        'max_ms': round(max(latencies), 1),
+        'lock_probes': probes_after - probes_before,
+        'lock_busy': busy_after - busy_before,
+    }
+
+
+def drive(args, make_client, probe, rng):
+    workers = [make_client() for _ in range(args.users)]
+    admins = [make_client() for _ in range(args.admins)]
+    base = make_jpeg(rng=rng)
+    encode = ENCODERS[args.upload]
+
+    def login_body(username, password):
+        return ('POST', '/login', urllib.parse.urlencode({'username': username, 'password': password}).encode(),
+                'application/x-www-form-urlencoded')
+
+    def punch(path, prefix, i):
+        fields = {f'{prefix}{name}': value for name, value in SITE.items()}
+        images = {f'{prefix}front_image': unique_jpeg(base, f'{path}-{i}-front'),
+                  f'{prefix}rear_image': unique_jpeg(base, f'{path}-{i}-rear')}
+        return ('POST', path) + encode(fields, images)
+
+    def sync_batch(i):
+        """A shift punched offline earlier today, uploaded by the phone's queue."""
+        punches, images = [], {}
+        for kind, prefix, hours_ago in (('checkin', '', 2), ('checkout', 'checkout_', 1)):
+            punch = {'key': f'bench-{i}-{kind}', 'kind': kind,
+                     'captured_at': int((time.time() - hours_ago * 3600) * 1000)}
+            punch.update({f'{prefix}{name}': value for name, value in SITE.items()})
+            for side in ('front', 'rear'):
+                images[punch['key'], f'{prefix}{side}_image'] = unique_jpeg(base, f'sync-{i}-{kind}-{side}')
+            punches.append(punch)
+        if args.upload == 'multipart':
+            return ('POST', '/api/sync') + encode_multipart(
+                {'punches': json.dumps(punches)},
+                {f'{key}:{field}': data for (key, field), data in images.items()}
+            )
+        by_key = {punch['key']: punch for punch in punches}
+        for (key, field), data in images.items():
+            by_key[key][field] = data_url(data)
+        return 'POST', '/api/sync', json.dumps({'punches': punches}).encode(), 'application/json'
+
+    export_start = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
+    export_end = datetime.now().strftime('%Y-%m-%d')
+    # Bodies are built up front so encoding doesn't count against the server
+    syncs = [sync_batch(i) for i in range(args.users)]
+    phases = [
+        ('login', workers, [login_body(f'worker{i}', PASSWORD) for i in range(args.users)], login_ok),
+        ('admin_login', admins, [login_body(*ADMIN)] * args.admins, login_ok),
+        ('checkin', workers, [punch('/api/checkin', '', i) for i in range(args.users)], api_ok),
+        ('user_dashboard', workers, [('GET', '/user/dashboard', None, None)] * args.users, page_ok),
+        ('admin_dashboard', admins, [('GET', '/admin/dashboard', None, None)] * args.admins, page_ok),
+        ('admin_attendance_api', admins, [('GET', '/api/admin/attendance?limit=50', None, None)] * args.admins, api_ok),
+        ('checkout', workers, [punch('/api/checkout', 'checkout_', i) for i in range(args.users)], api_ok),
+        ('export_report', admins,
+         [('GET', f'/admin/export_report?start_date={export_start}&end_date={export_end}&format={args.export_format}',
+           None, None)] * args.admins, page_ok),
+        ('sync', workers, syncs, sync_ok),
+        # The same batches again, as a phone retries after a dropped response
+        ('sync_retry', workers, syncs, sync_ok),
+    ]
+    results = {}
+    for name, clients, requests, check in phases:
+        results[name] = run_phase(probe, clients, requests, check, args.concurrency)
+        if name in ('checkin', 'checkout', 'sync'):
+            results[name]['request_bytes'] = sum(len(r[2]) for r in requests) // len(requests)
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'gunicorn did not start on port {port}')
+
+
+def peak_rss_kb(pid):
+    """VmHWM of `pid` (Linux only), or None."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def child_pids(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def run_gunicorn(args, env, probe, rng):
+    port = free_port()
+    server = subprocess.Popen(
+        ['gunicorn', '-b', f'127.0.0.1:{port}', '--log-level', 'warning'],
+        # Worker settings go through gunicorn.conf.py, which has to know
+        # the worker class before the app is imported (gevent patching)
+        cwd=HERE, env=dict(env, WEB_CONCURRENCY=str(args.workers), GUNICORN_WORKER_CLASS=args.worker_class),
+    )
+    try:
+        wait_for_port(port)
+        results = drive(args, lambda: HttpClient(f'http://127.0.0.1:{port}'), probe, rng)
+        rss = [peak_rss_kb(pid) for pid in child_pids(server.pid)]
+        rss = [kb for kb in rss if kb is not None]
+        memory = {'peak_rss_kb_max_worker': max(rss, default=None), 'peak_rss_kb_total': sum(rss) or None}
+    finally:
+        server.terminate()
+        server.wait()
+    return results, memory
+
+
+def run_testclient(args, env, probe, rng):
+    os.environ.update(DATABASE_PATH=env['DATABASE_PATH'], UPLOAD_FOLDER=env['UPLOAD_FOLDER'])
+    # Imported late so the app picks up the throwaway paths above
+    import app as attendance_app
+    results = drive(args, lambda: TestClient(attendance_app.app), probe, rng)
+    return results, {'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def compare(report, baseline, tolerance):
+    """Print per-phase changes against `baseline`; returns the regressed phases."""
+    regressions = []
+    print(f"{'phase':<22}{'p95 ms':>18}{'throughput rps':>22}{'failures':>12}")
+    for phase, current in report['results'].items():
+        before = baseline['results'].get(phase)
+        if not before:
+            continue
+        slower = current['p95_ms'] > before['p95_ms'] * (1 + tolerance)
+        fewer = current['throughput_rps'] < before['throughput_rps'] * (1 - tolerance)
+        broken = current['failures'] > before['failures']
+        flag = '  REGRESSION' if slower or fewer or broken else ''
+        print(f"{phase:<22}{before['p95_ms']:>8} -> {current['p95_ms']:<8}"
+              f"{before['throughput_rps']:>10} -> {current['throughput_rps']:<8}"
+              f"{before['failures']:>5} -> {current['failures']:<4}{flag}")
+        if flag:
+            regressions.append(phase)
+    return regressions
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    tmp = tempfile.mkdtemp(prefix='attendance-bench-')
+    env = dict(os.environ)
+    env['DATABASE_PATH'] = os.path.join(tmp, 'attendance.db')
+    env['UPLOAD_FOLDER'] = os.path.join(tmp, 'uploads')
+    env['PUNCH_GROUP_COMMIT'] = '1' if args.group_commit == 'on' else '0'
+    env['GUNICORN_THREADS'] = str(args.threads)  # Sizes the app's connection pool to match
+
+    seeded = seed_database(env, args.users, args.days, rng)
+
+    probe = LockProbe(env['DATABASE_PATH'])
+    probe.start()
+    try:
+        runner = run_gunicorn if args.server == 'gunicorn' else run_testclient
+        results, memory = runner(args, env, probe, rng)
+    finally:
+        probe.stop()
+
+    report = {
+        'server': args.server,
+        'workers': args.workers if args.server == 'gunicorn' else None,
+        'worker_class': f'{args.worker_class}x{args.threads}' if args.server == 'gunicorn' else None,
+        'group_commit': args.group_commit,
+        'users': args.users,
+        'days': args.days,
+        'history_rows': seeded,
+        'admins': args.admins,
+        'upload': args.upload,
+        'concurrency': args.concurrency,
+        'memory': memory,
+        'lock_busy_ratio': round(probe.busy / probe.probes, 4) if probe.probes else None,
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=('gunicorn', 'testclient'), default='gunicorn')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--worker-class', choices=('sync', 'gthread', 'gevent'), default='gthread')
+    parser.add_argument('--threads', type=int, default=32, help='threads per gthread worker')
+    parser.add_argument('--group-commit', choices=('on', 'off'), default='on',
+                        help='commit punches in groups (on) or each in its own transaction (off)')
+    parser.add_argument('--users', type=int, default=200, help='workers punching at shift change')
+    parser.add_argument('--days', type=int, default=30, help='days of shift history to seed')
+    parser.add_argument('--admins', type=int, default=5, help='admin sessions loading the dashboard and export')
+    parser.add_argument('--concurrency', type=int, default=50, help='simultaneous client connections')
+    parser.add_argument('--upload', choices=sorted(ENCODERS), default='multipart',
+                        help='punch body encoding (multipart photos or legacy base64 JSON)')
+    parser.add_argument('--export-format', choices=('xlsx', 'csv', 'ndjson'), default='xlsx')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the seeded history and photos')
+    parser.add_argument('--save', metavar='FILE', help='write the report as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare against a saved baseline; exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown before a phase counts as regressed')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
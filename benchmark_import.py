@@ -0,0 +1,123 @@
+"""Bulk user import benchmark: users per minute through the admin API.
+
+Creates --users accounts through POST /api/admin/users/import (CSV bodies
+of up to user_import.MAX_ROWS rows) once per password-hasher pool size,
+then flips location tracking for all of them through
+POST /api/admin/users/bulk. For comparison, --baseline users are added one
+at a time through the admin form (POST /admin/add_user), which is how
+accounts were created before. Runs in-process through the Flask test
+client against a throwaway database.
+
+    python benchmark_import.py --users 2000 --workers 1,4
+    python benchmark_import.py --save import.json
+
+Password hashing dominates (werkzeug's scrypt is ~150ms of CPU per
+password), so throughput scales with the cores the pool can use: expect
+roughly 400 users/minute per core.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+
+from benchmark import ADMIN, PASSWORD, TestClient, login_ok
+
+
+def users_csv(prefix, start, count):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['username', 'email', 'password', 'role', 'location_enabled'])
+    for i in range(start, start + count):
+        writer.writerow([f'{prefix}{i:06d}', f'{prefix}{i:06d}@example.com', PASSWORD, 'user', 'yes'])
+    return out.getvalue().encode()
+
+
+def rate(count, seconds):
+    return {'users': count, 'seconds': round(seconds, 2), 'users_per_minute': round(count / seconds * 60)}
+
+
+def run_import(client, prefix, users, batch):
+    created = 0
+    started = time.perf_counter()
+    for start in range(0, users, batch):
+        status, body, _ = client.request('POST', '/api/admin/users/import',
+                                         users_csv(prefix, start, min(batch, users - start)), 'text/csv')
+        if status != 200:
+            raise RuntimeError(f'import failed: {status} {body[:200]!r}')
+        created += json.loads(body)['created']
+    return rate(created, time.perf_counter() - started)
+
+
+def run_bulk_update(client, prefix, users, batch):
+    updated = 0
+    started = time.perf_counter()
+    for start in range(0, users, batch):
+        updates = [{'username': f'{prefix}{i:06d}', 'location_enabled': False}
+                   for i in range(start, min(start + batch, users))]
+        status, body, _ = client.request('POST', '/api/admin/users/bulk', json.dumps({'updates': updates}),
+                                         'application/json')
+        if status != 200:
+            raise RuntimeError(f'bulk update failed: {status} {body[:200]!r}')
+        updated += json.loads(body)['updated']
+    return rate(updated, time.perf_counter() - started)
+
+
+def run_one_at_a_time(client, users):
+    started = time.perf_counter()
+    for i in range(users):
+        client.request('POST', '/admin/add_user', (
+            f'username=single{i:06d}&email=single{i:06d}@example.com&password={PASSWORD}&location_enabled=on'
+        ).encode(), 'application/x-www-form-urlencoded')
+    return rate(users, time.perf_counter() - started)
+
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix='attendance-import-')
+    os.environ.update(DATABASE_PATH=os.path.join(tmp, 'import.db'), UPLOAD_FOLDER=os.path.join(tmp, 'uploads'),
+                      DATABASE_URL='', GEOCODER='stub')
+    # Imported late so the app picks up the throwaway paths above
+    import app as attendance_app
+    import user_import
+
+    attendance_app.create_app()
+    client = TestClient(attendance_app.app)
+    status, body, location = client.request('POST', '/login', f'username={ADMIN[0]}&password={ADMIN[1]}'.encode(),
+                                            'application/x-www-form-urlencoded')
+    if not login_ok(status, body, location):
+        raise RuntimeError('admin login failed')
+
+    report = {'cpu_count': os.cpu_count(), 'batch': user_import.MAX_ROWS, 'import': {}}
+    for workers in args.workers:
+        attendance_app.password_hasher = user_import.PasswordHasher(workers)
+        # Start the pool outside the timed run, as a long-lived worker would have it
+        attendance_app.password_hasher.hash_all(['warm-up'] * workers * 2)
+        prefix = f'w{workers}u'
+        report['import'][f'workers_{workers}'] = run_import(client, prefix, args.users, user_import.MAX_ROWS)
+        attendance_app.password_hasher.shutdown()
+    report['bulk_update'] = run_bulk_update(client, prefix, args.users, user_import.MAX_ROWS)
+    if args.baseline:
+        report['one_at_a_time'] = run_one_at_a_time(client, args.baseline)
+
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000, help='users to import per run')
+    parser.add_argument('--workers', default=f'1,{os.cpu_count() or 1}',
+                        type=lambda value: sorted({int(n) for n in value.split(',')}),
+                        help='comma-separated password-hasher pool sizes to try')
+    parser.add_argument('--baseline', type=int, default=50,
+                        help='users to add one at a time through the admin form (0 to skip)')
+    parser.add_argument('--save', metavar='FILE', help='write the report as JSON')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
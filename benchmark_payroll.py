@@ -0,0 +1,136 @@
+"""Payroll report benchmark: a year of attendance for a thousand workers.
+
+Seeds a throwaway SQLite database with --users workers punching six days a
+week for --days days across a few sites (a share of them on night shifts
+that cross midnight, and the odd forgotten checkout), then times the
+payroll engine over the whole period: loading the shifts, the vectorized
+computation, and the full GET /admin/payroll request through the Flask
+test client. Medians over --runs are reported.
+
+    python benchmark_payroll.py --users 1000 --days 365
+    python benchmark_payroll.py --save payroll.json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmark import ADMIN, TestClient, login_ok
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def seed(conn, users, days, sites, rng):
+    conn.executemany(
+        'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+        [(f'worker{i}', f'worker{i}@bench.local', 'x') for i in range(users)]
+    )
+    conn.executemany(
+        'INSERT INTO sites (name, center_lat, center_lon, radius_m) VALUES (?, ?, ?, ?)',
+        [(f'Site {i}', 13.0 + i / 100, 80.0, 300) for i in range(sites)]
+    )
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users WHERE role = 'user'")]
+    site_ids = [row[0] for row in conn.execute('SELECT id FROM sites')] + [None]
+    first_day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+    rows = []
+    for user_id in user_ids:
+        night_shift = rng.random() < 0.2
+        site_id = rng.choice(site_ids)
+        for day in range(days):
+            if day % 7 == 6:
+                continue  # A day off a week
+            start = first_day + timedelta(days=day, hours=21 if night_shift else 8, minutes=rng.randint(0, 60))
+            end = start + timedelta(hours=8, minutes=rng.randint(0, 180))
+            forgot = rng.random() < 0.005
+            rows.append((user_id, start.strftime(TIME_FORMAT), None if forgot else end.strftime(TIME_FORMAT),
+                         'checked_in' if forgot else 'checked_out', site_id))
+        if len(rows) >= 50000:
+            conn.executemany('INSERT INTO attendance (user_id, check_in_time, check_out_time, status, '
+                             'checkin_site_id) VALUES (?, ?, ?, ?, ?)', rows)
+            rows = []
+    conn.executemany('INSERT INTO attendance (user_id, check_in_time, check_out_time, status, '
+                     'checkin_site_id) VALUES (?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    return conn.execute('SELECT COUNT(*) FROM attendance').fetchone()[0], first_day
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - started, result
+
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix='attendance-payroll-')
+    os.environ.update(DATABASE_PATH=os.path.join(tmp, 'payroll.db'), UPLOAD_FOLDER=os.path.join(tmp, 'uploads'),
+                      DATABASE_URL='', GEOCODER='stub')
+    # Imported late so the app picks up the throwaway paths above
+    import app as attendance_app
+    from db import get_db
+
+    app = attendance_app.create_app()
+    engine = attendance_app.payroll_engine
+    with app.app_context():
+        seconds, (shifts, first_day) = timed(lambda: seed(get_db(), args.users, args.days, args.sites,
+                                                          random.Random(args.seed)))
+    print(f'Seeded {shifts} shifts in {seconds:.1f}s')
+    start_date = first_day.strftime('%Y-%m-%d')
+    end_date = datetime.now().strftime('%Y-%m-%d')
+
+    client = TestClient(app)
+    status, body, location = client.request('POST', '/login', f'username={ADMIN[0]}&password={ADMIN[1]}'.encode(),
+                                            'application/x-www-form-urlencoded')
+    if not login_ok(status, body, location):
+        raise RuntimeError('admin login failed')
+
+    samples = {'load': [], 'compute': [], 'report': [], 'request': []}
+    with app.app_context():
+        conn = get_db()
+        period_start, period_end = attendance_app.payroll.week_bounds(start_date, end_date)
+        for _ in range(args.runs):
+            took, loaded = timed(lambda: engine.load(conn, period_start, period_end))
+            samples['load'].append(took)
+            took, _ = timed(lambda: engine.compute(loaded, period_start, period_end, datetime.now()))
+            samples['compute'].append(took)
+            took, report = timed(lambda: engine.report(conn, start_date, end_date, datetime.now()))
+            samples['report'].append(took)
+    for _ in range(args.runs):
+        took, (status, body, _) = timed(lambda: client.request(
+            'GET', f'/admin/payroll?start={start_date}&end={end_date}'))
+        if status != 200:
+            raise RuntimeError(f'payroll request failed: {status} {body[:200]!r}')
+        samples['request'].append(took)
+
+    result = {
+        'users': args.users,
+        'days': args.days,
+        'shifts': shifts,
+        'weeks': len({row['week_start'] for row in report['weeks']}),
+        'user_weeks': len(report['weeks']),
+        'stale_shifts': len(report['stale_shifts']),
+        'results': {name: {'median_ms': round(statistics.median(values) * 1000, 1),
+                           'max_ms': round(max(values) * 1000, 1)} for name, values in samples.items()},
+    }
+    print(json.dumps(result, indent=2))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000, help='workers to seed')
+    parser.add_argument('--days', type=int, default=365, help='days of history')
+    parser.add_argument('--sites', type=int, default=20, help='work sites')
+    parser.add_argument('--runs', type=int, default=5, help='timed runs per measurement')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the generated history')
+    parser.add_argument('--save', metavar='FILE', help='write the report as JSON')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
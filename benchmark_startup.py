@@ -0,0 +1,131 @@
+"""Cold-start benchmark: time from launching gunicorn to the first served request.
+
+Each run starts gunicorn the way Render does (gunicorn.conf.py, the
+create_app() factory) and records, from the moment the process is spawned:
+
+    listening   the port accepts connections
+    first_page  GET /login has been served
+    login       the default admin can log in, i.e. the schema is in place
+
+Runs alternate between an empty database (a first deploy) and one that is
+already set up (a restart or a new instance), and `import app` is timed on
+its own in a fresh interpreter. Medians over --runs are reported.
+
+    python benchmark_startup.py --runs 5 --workers 2
+    python benchmark_startup.py --preload off --save startup-nopreload.json
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from benchmark import ADMIN, HERE, HttpClient, free_port, login_ok
+
+IMPORT_PROBE = 'import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)'
+
+
+def time_import(env):
+    """(seconds to import app, seconds for the whole interpreter) in a fresh process."""
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', IMPORT_PROBE], cwd=HERE, env=env,
+                         check=True, capture_output=True, text=True).stdout
+    return float(out.strip().splitlines()[-1]), time.perf_counter() - started
+
+
+def listening(port):
+    socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+    return True
+
+
+def wait_until(check, started, timeout):
+    while time.perf_counter() - started < timeout:
+        try:
+            if check():
+                return time.perf_counter() - started
+        except OSError:
+            pass
+        time.sleep(0.005)
+    raise RuntimeError('gunicorn did not serve in time')
+
+
+def start_once(args, env):
+    """Seconds from spawn to listening, first page and admin login."""
+    port = free_port()
+    client = HttpClient(f'http://127.0.0.1:{port}')
+    login = urllib.parse.urlencode({'username': ADMIN[0], 'password': ADMIN[1]}).encode()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        ['gunicorn', '-w', str(args.workers), '-b', f'127.0.0.1:{port}', '--log-level', 'warning'],
+        cwd=HERE, env=env,
+    )
+    try:
+        timings = {'listening': wait_until(lambda: listening(port), started, args.timeout)}
+        timings['first_page'] = wait_until(lambda: client.request('GET', '/login')[0] == 200, started, args.timeout)
+        timings['login'] = wait_until(
+            lambda: login_ok(*client.request('POST', '/login', login, 'application/x-www-form-urlencoded')),
+            started, args.timeout)
+    finally:
+        server.terminate()
+        server.wait()
+    return timings
+
+
+def summarize(samples):
+    return {name: {'median_ms': round(statistics.median(s[name] for s in samples) * 1000, 1),
+                   'max_ms': round(max(s[name] for s in samples) * 1000, 1)}
+            for name in samples[0]}
+
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix='attendance-startup-')
+    env = dict(os.environ, GUNICORN_PRELOAD='1' if args.preload == 'on' else '0',
+               GUNICORN_THREADS=str(args.threads), GEOCODER='stub', DATABASE_URL='')
+
+    imports = []
+    for i in range(args.runs):
+        run_env = dict(env, DATABASE_PATH=os.path.join(tmp, f'import-{i}.db'),
+                       UPLOAD_FOLDER=os.path.join(tmp, f'import-{i}'))
+        imports.append(dict(zip(('import_app', 'interpreter_total'), time_import(run_env))))
+
+    scenarios = {'empty_database': [], 'ready_database': []}
+    ready_env = dict(env, DATABASE_PATH=os.path.join(tmp, 'ready.db'), UPLOAD_FOLDER=os.path.join(tmp, 'ready'))
+    start_once(args, ready_env)  # Set it up once; later runs find it ready
+    for i in range(args.runs):
+        scenarios['empty_database'].append(start_once(args, dict(
+            env, DATABASE_PATH=os.path.join(tmp, f'empty-{i}.db'), UPLOAD_FOLDER=os.path.join(tmp, f'empty-{i}'))))
+        scenarios['ready_database'].append(start_once(args, ready_env))
+
+    report = {
+        'workers': args.workers,
+        'threads': args.threads,
+        'preload': args.preload,
+        'runs': args.runs,
+        'import': summarize(imports),
+        'results': {name: summarize(samples) for name, samples in scenarios.items()},
+    }
+    print(json.dumps(report, indent=2))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=32, help='threads per gthread worker')
+    parser.add_argument('--preload', choices=('on', 'off'), default='on',
+                        help='set up in the gunicorn master before forking (on) or in each worker (off)')
+    parser.add_argument('--runs', type=int, default=5, help='starts per scenario')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for a start')
+    parser.add_argument('--save', metavar='FILE', help='write the report as JSON')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""One-time startup work: schema, migrations and the default admin.
+
+Every process runs Bootstrap.ensure() before its first request (or once in
+the gunicorn master when the app is preloaded, see gunicorn.conf.py). The
+readiness check is a couple of reads, so once the database is set up a new
+worker is ready straight away. Otherwise the setup runs under an exclusive
+lock file, so workers starting together on one host take turns and the
+ones that come second find it done; on PostgreSQL the migrations are
+additionally serialized by the database itself.
+"""
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines: no cross-process lock
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path):
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Bootstrap:
+    def __init__(self, app=None, folders=()):
+        self.folders = list(folders)
+        self.setup_func = None
+        self.ready_func = None
+        self.done = False
+        self._lock = threading.Lock()
+        self.stats = {'ran_setup': False, 'seconds': None}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        if app.config.get('DATABASE_URL'):
+            self.lock_path = os.path.join(tempfile.gettempdir(), 'attendance-bootstrap.lock')
+        else:
+            self.lock_path = os.path.abspath(app.config['DATABASE']) + '.bootstrap.lock'
+        app.extensions['bootstrap'] = self
+        # Registered first so it runs ahead of every other before_request hook
+        app.before_request(self.ensure)
+
+    def setup(self, f):
+        """Decorator: the idempotent setup function."""
+        self.setup_func = f
+        return f
+
+    def ready(self, f):
+        """Decorator: returns True when setup has nothing left to do."""
+        self.ready_func = f
+        return f
+
+    def ensure(self, force=False):
+        """Run the setup unless this process or the database already has."""
+        if self.done and not force:
+            return
+        with self._lock:
+            if self.done and not force:
+                return
+            started = time.perf_counter()
+            for folder in self.folders:
+                os.makedirs(folder, exist_ok=True)
+            with self.app.app_context():
+                if force or not self.ready_func():
+                    with file_lock(self.lock_path):
+                        if force or not self.ready_func():
+                            self.setup_func()
+                            self.stats['ran_setup'] = True
+            self.stats['seconds'] = round(time.perf_counter() - started, 4)
+            self.done = True
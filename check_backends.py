@@ -0,0 +1,292 @@
+"""Run the same attendance scenario on SQLite and on PostgreSQL.
+
+Each backend gets a fresh database (a temp SQLite file; a throwaway schema
+in the PostgreSQL database given with --database-url) and the app is driven
+through the Flask test client: schema setup run twice, users (one at a
+time and imported in bulk), punches, offline sync with a retried batch,
+sites, reports, payroll, rollups, the image worker and photo
+fingerprints. The S3 image store is also run against an in-memory fake
+client, so it is checked without boto3 or a bucket. The script exits with status 1 if a step fails on either
+backend, if the two backends answer differently, or if their indexes
+differ.
+
+    python check_backends.py                                   # SQLite only
+    python check_backends.py --database-url postgresql://localhost/attendance
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from PIL import Image
+
+
+def photo(color):
+    buf = io.BytesIO()
+    Image.new('RGB', (64, 48), color).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+def scenario():
+    """Drive the app once; returns {step: comparable result}."""
+    import app as attendance_app
+    from db import dialect, get_db
+
+    app = attendance_app.app
+    results = {}
+    with app.app_context():
+        attendance_app.init_db()
+        attendance_app.init_db()  # Migrations must be idempotent
+        conn = get_db()
+        if dialect(conn) == 'postgres':
+            sql = "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND indexname LIKE 'idx_%'"
+        else:
+            sql = "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'"
+        results['indexes'] = sorted(row[0] for row in conn.execute(sql))
+        results['migrations'] = [row['version'] for row in
+                                 conn.execute('SELECT version FROM schema_migrations ORDER BY version')]
+
+    admin = app.test_client()
+    admin.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    for name in ('w1', 'w2', 'w1'):
+        response = admin.post('/admin/add_user', data={
+            'username': name, 'email': f'{name}@check.local', 'password': 'pw', 'location_enabled': 'on'
+        }, follow_redirects=True)
+    results['duplicate_user_rejected'] = b'already exists' in response.data
+    imported = admin.post('/api/admin/users/import', json={'users': [
+        {'username': 'w3', 'email': 'w3@check.local', 'password': 'pw', 'location_enabled': 'no'},
+        {'username': 'w2', 'email': 'other@check.local', 'password': 'pw'},
+        {'username': 'w4', 'email': 'w4@check.local', 'password': 'pw', 'role': 'boss'},
+    ]}).get_json()
+    results['user_import'] = [(row['username'], row['status'], row['message']) for row in imported['results']]
+    updated = admin.post('/api/admin/users/bulk', json={'updates': [
+        {'username': 'w3', 'role': 'admin', 'location_enabled': True}, {'username': 'nobody', 'role': 'user'},
+    ]}).get_json()
+    results['user_bulk_update'] = [(row['status'], row['message']) for row in updated['results']]
+    results['users'] = [u['username'] for u in admin.get('/api/admin/users').get_json()['users']]
+
+    site = admin.post('/admin/sites', json={'name': 'Yard', 'latitude': 19.07, 'longitude': 72.87,
+                                            'radius_m': 300}).get_json()
+    results['site_created'] = site['success']
+
+    worker = app.test_client()
+    worker.post('/login', data={'username': 'w1', 'password': 'pw'})
+    checkin = worker.post('/api/checkin', content_type='multipart/form-data', data={
+        'front_image': (io.BytesIO(photo((200, 0, 0))), 'f.jpg'),
+        'rear_image': (io.BytesIO(photo((0, 200, 0))), 'r.jpg'),
+        'latitude': '19.0705', 'longitude': '72.8705', 'city': 'Mumbai', 'full_address': 'Yard gate',
+    }).get_json()
+    results['checkin'] = checkin
+    results['bad_photo_checkin'] = worker.post('/api/checkin', json={
+        'front_image': 'data:image/jpeg;base64,not base64!', 'latitude': 19.07, 'longitude': 72.87,
+    }).status_code
+    results['checkout'] = worker.post('/api/checkout', content_type='multipart/form-data', data={
+        'checkout_front_image': (io.BytesIO(photo((0, 0, 200))), 'f.jpg'),
+        'checkout_latitude': '19.2', 'checkout_longitude': '72.9',
+    }).get_json()
+
+    now_ms = int(datetime.now().timestamp() * 1000)
+    batch = {'punches': [
+        # Replays the check-in photo from two minutes earlier
+        {'key': 'check-sync-1', 'kind': 'checkin', 'captured_at': now_ms - 120000,
+         'front_image': 'data:image/jpeg;base64,' + base64.b64encode(photo((200, 0, 0))).decode()},
+        {'key': 'check-sync-2', 'kind': 'checkout', 'captured_at': now_ms - 60000},
+    ]}
+    first = worker.post('/api/sync', json=batch).get_json()
+    retry = worker.post('/api/sync', json=batch).get_json()
+    results['sync'] = [r['status'] for r in first['results']]
+    results['sync_retry'] = [r['status'] for r in retry['results']]
+
+    records = admin.get('/api/admin/attendance?limit=1').get_json()
+    page_two = admin.get(f"/api/admin/attendance?limit=1&cursor={records['next_cursor']}").get_json()
+    results['attendance'] = [
+        {key: record[key] for key in ('username', 'status', 'city', 'checkin_off_site', 'checkout_off_site')}
+        for record in records['records'] + page_two['records']
+    ]
+    results['city_filter'] = len(admin.get('/api/admin/attendance?city=mum').get_json()['records'])
+
+    month = datetime.now().strftime('%Y-%m')
+    summary = admin.get(f'/admin/monthly_summary?month={month}').get_json()
+    results['monthly_summary'] = [{key: row[key] for key in ('username', 'days_worked', 'shifts', 'open_shifts')}
+                                  for row in summary['users']]
+    stats = admin.get('/api/admin/stats').get_json()['stats']
+    results['day_stats'] = {key: stats[key] for key in ('workers_present', 'open_shifts', 'sites')}
+    today = datetime.now().strftime('%Y-%m-%d')
+    report = admin.get(f'/admin/export_report?start_date={today}&end_date={today}&format=csv').get_data(as_text=True)
+    results['report_rows'] = len(report.strip().splitlines())
+    payroll = admin.get(f'/admin/payroll?start={today}&end={today}').get_json()
+    results['payroll'] = {
+        'users': [(row['username'], row['shifts'], row['stale_shifts'], row['open_shifts']) for row in payroll['users']],
+        'sites': sorted((row['site_name'], row['workers']) for row in payroll['sites']),
+    }
+
+    with app.app_context():
+        attendance_app.image_worker.run_pending()
+        # The background worker thread may still be finishing a job it claimed
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and get_db().execute(
+                "SELECT COUNT(*) FROM image_jobs WHERE status = 'running'").fetchone()[0]:
+            time.sleep(0.05)
+        jobs = get_db().execute('SELECT kind, status FROM image_jobs ORDER BY id').fetchall()
+        results['image_jobs'] = sorted({(row['kind'], row['status']) for row in jobs})
+    results['photo_matches'] = [
+        {key: match[key] for key in ('username', 'matched_username', 'phash_distance', 'dhash_distance')}
+        for match in admin.get('/admin/photo_matches').get_json()['matches']
+    ]
+    results['retention'] = sorted(admin.get('/admin/retention').get_json()['photos'].items())
+    results['dashboards'] = [admin.get('/admin/dashboard').status_code, worker.get('/user/dashboard').status_code]
+    return results
+
+
+class FakeS3Client:
+    """The slice of the boto3 S3 client that S3ImageStore uses, kept in memory."""
+
+    class NotFound(Exception):
+        response = {'Error': {'Code': '404'}}
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.puts += 1
+        self.objects[Bucket, Key] = (Body if isinstance(Body, bytes) else Body.read(), ContentType)
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.NotFound(Key)
+        return {'Body': io.BytesIO(self.objects[Bucket, Key][0])}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.NotFound(Key)
+        return {'ContentType': self.objects[Bucket, Key][1]}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://{Params['Bucket']}.s3.test/{Params['Key']}?expires={ExpiresIn}"
+
+
+def check_s3_store(tmp):
+    """Run S3ImageStore against FakeS3Client; returns a list of problems."""
+    from image_store import S3ImageStore
+
+    client = FakeS3Client()
+    store = S3ImageStore(client, 'photos', prefix='attendance/')
+    data = photo((10, 20, 30))
+    problems = []
+    key = store.put_bytes(data)
+    if store.put_bytes(data) != key or client.puts != 1:
+        problems.append('the same photo was uploaded twice')
+    src = os.path.join(tmp, 'upload.jpg')
+    with open(src, 'wb') as f:
+        f.write(data)
+    if store.put_file(src) != key or os.path.exists(src) or client.puts != 1:
+        problems.append('put_file did not reuse the stored photo and remove its temp file')
+    if ('photos', 'attendance/' + key) not in client.objects:
+        problems.append('object not stored under the prefix')
+    with store.open(key) as f:
+        if f.read() != data:
+            problems.append('open returned different bytes')
+    location = store.send(key).headers['Location']
+    if not location.startswith('https://photos.s3.test/attendance/'):
+        problems.append(f'unexpected presigned URL {location}')
+    store.delete(key)
+    if store.exists(key):
+        problems.append('photo still exists after delete')
+    try:
+        store.open('../escape.jpg')
+        problems.append('invalid key accepted')
+    except ValueError:
+        pass
+    return problems
+
+
+def run_backend(env):
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario'],
+                               env=dict(os.environ, **env), capture_output=True, text=True)
+    if completed.returncode != 0:
+        return None, completed.stderr.strip().splitlines()[-1:] or ['exited with no output']
+    return json.loads(completed.stdout.strip().splitlines()[-1]), None
+
+
+def create_schema(url):
+    """Create a throwaway schema; returns its name and a URL pinned to it."""
+    name = f'check_{uuid.uuid4().hex[:8]}'
+    _admin_execute(url, f'CREATE SCHEMA {name}')
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query) + [('options', f'-csearch_path={name}')]
+    return name, urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def _admin_execute(url, sql):
+    import psycopg2
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    conn.cursor().execute(sql)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', help='PostgreSQL URL; a throwaway schema is created and dropped in it')
+    parser.add_argument('--scenario', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        print(json.dumps(scenario(), default=list))
+        return
+
+    tmp = tempfile.mkdtemp(prefix='attendance-backends-')
+    base = {'UPLOAD_FOLDER': os.path.join(tmp, 'uploads'), 'ARCHIVE_FOLDER': os.path.join(tmp, 'archive'),
+            'GEOCODER': 'stub', 'DATABASE_URL': ''}
+    backends = {'sqlite': dict(base, DATABASE_PATH=os.path.join(tmp, 'attendance.db'))}
+    schema = None
+    if args.database_url:
+        schema, pg_url = create_schema(args.database_url)
+        backends['postgres'] = dict(base, DATABASE_URL=pg_url, UPLOAD_FOLDER=os.path.join(tmp, 'uploads-pg'))
+
+    outcomes = {}
+    failed = False
+    problems = check_s3_store(tmp)
+    for problem in problems:
+        failed = True
+        print(f's3 store: FAILED - {problem}')
+    if not problems:
+        print('s3 store: fake client round trip passed')
+    try:
+        for name, env in backends.items():
+            outcomes[name], error = run_backend(env)
+            if error:
+                failed = True
+                print(f'{name}: FAILED - {error[0]}')
+            else:
+                print(f'{name}: ran {len(outcomes[name])} steps')
+    finally:
+        if schema:
+            _admin_execute(args.database_url, f'DROP SCHEMA {schema} CASCADE')
+
+    if not failed and len(outcomes) == 2:
+        for step in outcomes['sqlite']:
+            if outcomes['sqlite'][step] != outcomes['postgres'].get(step):
+                failed = True
+                print(f'\nMISMATCH in {step}:')
+                print('    sqlite:  ', outcomes['sqlite'][step])
+                print('    postgres:', outcomes['postgres'].get(step))
+    if failed:
+        sys.exit(1)
+    print('Backends agree' if len(outcomes) == 2 else 'SQLite scenario passed (no --database-url given)')
+
+
+if __name__ == '__main__':
+    main()
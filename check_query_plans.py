@@ -0,0 +1,155 @@
+"""Query plan audit for the attendance table.
+
+Seeds a throwaway database with a realistic volume of attendance rows, drives
+every read/write route through the Flask test client while recording the SQL
+each one runs, and checks EXPLAIN QUERY PLAN for every statement. Exits with
+status 1 if any of them falls back to a full scan of the attendance table.
+
+    python check_query_plans.py --users 500 --days 200
+"""
+import argparse
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+from PIL import Image
+from werkzeug.security import generate_password_hash
+
+from db import get_db
+
+# Tables that must never be read with a full scan from a request
+AUDITED_TABLES = ('attendance',)
+TABLE_SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?$')
+
+
+def seed(conn, users, days):
+    conn.executemany(
+        'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+        [(f'worker{i}', f'worker{i}@audit.local', 'x') for i in range(users)]
+    )
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users WHERE role = 'user'")]
+    start = datetime(2024, 1, 1, 8, 0)
+    rows = []
+    for day in range(days):
+        for user_id in user_ids:
+            check_in = start + timedelta(days=day, minutes=random.randint(0, 90))
+            check_out = check_in + timedelta(hours=8, minutes=random.randint(0, 120))
+            rows.append((user_id, check_in.strftime('%Y-%m-%d %H:%M:%S'),
+                         check_out.strftime('%Y-%m-%d %H:%M:%S'), 'checked_out'))
+    conn.executemany(
+        'INSERT INTO attendance (user_id, check_in_time, check_out_time, status) VALUES (?, ?, ?, ?)',
+        rows
+    )
+    conn.execute('ANALYZE')
+    conn.commit()
+    return len(rows)
+
+
+def drive_routes(app):
+    """Hit every route that touches attendance, as an admin and as a worker."""
+    buf = io.BytesIO()
+    Image.new('RGB', (64, 48)).save(buf, 'JPEG')
+    photo = buf.getvalue()
+
+    admin = app.test_client()
+    admin.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    admin.get('/admin/dashboard')
+    admin.get('/admin/export_report?start_date=2024-03-01&end_date=2024-03-31')
+    admin.get('/admin/export_report?start_date=2024-03-01&end_date=2024-03-31&format=csv').get_data()
+    page = admin.get('/api/admin/attendance?limit=50').get_json()
+    admin.get(f"/api/admin/attendance?limit=50&cursor={page['next_cursor']}")
+    admin.get('/api/admin/attendance?user_id=2&status=checked_out&start_date=2024-02-01&end_date=2024-02-29')
+    admin.get('/api/admin/attendance?status=checked_in')
+    admin.get('/admin/payroll?start=2024-01-01&end=2024-12-31')
+    admin.get('/api/admin/users?after_id=100')
+    admin.post('/admin/toggle_location/2')
+
+    worker = app.test_client()
+    with app.app_context():
+        conn = get_db()
+        conn.execute("UPDATE users SET password_hash = ? WHERE username = 'worker0'",
+                     (generate_password_hash('audit'),))
+        conn.commit()
+    worker.post('/login', data={'username': 'worker0', 'password': 'audit'})
+    worker.get('/user/dashboard')
+    worker.get('/user/checkin')
+    worker.post('/api/checkin', content_type='multipart/form-data',
+                data={'front_image': (io.BytesIO(photo), 'f.jpg'), 'rear_image': (io.BytesIO(photo), 'r.jpg')})
+    worker.get('/user/checkout')
+    worker.post('/api/checkout', content_type='multipart/form-data',
+                data={'checkout_front_image': (io.BytesIO(photo), 'f.jpg')})
+    now_ms = int(datetime.now().timestamp() * 1000)
+    worker.post('/api/sync', json={'punches': [
+        {'key': 'audit-sync-1', 'kind': 'checkin', 'captured_at': now_ms - 60000},
+        {'key': 'audit-sync-2', 'kind': 'checkout', 'captured_at': now_ms},
+    ]})
+
+
+def audit(conn, statements):
+    failures = []
+    seen = set()
+    for sql in statements:
+        normalized = ' '.join(sql.split())
+        verb = normalized.split(' ', 1)[0].upper()
+        if verb not in ('SELECT', 'UPDATE', 'DELETE') or normalized in seen:
+            continue
+        seen.add(normalized)
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+        for detail in plan:
+            match = TABLE_SCAN.match(detail)
+            if match and (match.group(1) in AUDITED_TABLES or _alias_of(sql, match.group(1)) in AUDITED_TABLES):
+                failures.append((normalized, plan))
+    return failures, len(seen)
+
+
+def _alias_of(sql, name):
+    match = re.search(r'\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?' + re.escape(name) + r'\b', sql, re.IGNORECASE)
+    return match.group(1) if match else name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--days', type=int, default=120)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='attendance-plans-')
+    os.environ['DATABASE_PATH'] = os.path.join(tmp, 'attendance.db')
+    os.environ['UPLOAD_FOLDER'] = os.path.join(tmp, 'uploads')
+    os.environ['ARCHIVE_FOLDER'] = os.path.join(tmp, 'archive')
+    # Imported late so the app picks up the throwaway paths above
+    import app as attendance_app
+
+    app = attendance_app.app
+    statements = []
+    with app.app_context():
+        attendance_app.init_db()
+        rows = seed(get_db(), args.users, args.days)
+    print(f'Seeded {rows} attendance rows for {args.users} users')
+
+    pool = app.extensions['db_pool']
+    pool.close_all()
+    pool.on_connect.append(lambda conn: conn.set_trace_callback(statements.append))
+    drive_routes(app)
+    pool.close_all()
+    pool.on_connect.clear()
+
+    with app.app_context():
+        failures, checked = audit(get_db(), statements)
+
+    print(f'Checked {checked} distinct statements')
+    for sql, plan in failures:
+        print('\nFULL SCAN:', sql)
+        for detail in plan:
+            print('   ', detail)
+    if failures:
+        sys.exit(1)
+    print('No full scans of', ', '.join(AUDITED_TABLES))
+
+
+if __name__ == '__main__':
+    main()
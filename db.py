@@ -0,0 +1,330 @@
+"""Pooled database connections, shared per request through get_db().
+
+SQLite is the default (DATABASE, a file per deployment). With DATABASE_URL
+set the same code runs on PostgreSQL through PostgresConnection, an adapter
+exposing the subset of the sqlite3 connection API the app uses. The app's
+SQL is kept to what both accept; the adapter covers the remaining
+differences: ? placeholders, SQLite DDL types, INSERT OR IGNORE, and
+BEGIN IMMEDIATE (a transaction-scoped advisory lock, so writers that ask
+for it are serialized the way SQLite serializes them).
+"""
+import os
+import queue
+import re
+import sqlite3
+import threading
+
+from flask import current_app, g, has_request_context
+
+# Applied to every new connection. WAL lets readers keep going while a
+# check-in is being written, and busy_timeout makes writers queue up on the
+# lock instead of failing straight away with "database is locked".
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -8000),  # negative value = KiB, so ~8MB page cache
+)
+
+
+# Raised by both backends when a write breaks a UNIQUE/PRIMARY KEY constraint
+IntegrityError = sqlite3.IntegrityError
+
+# Advisory lock key standing in for SQLite's database-wide write lock
+WRITE_LOCK_KEY = 0x61747464
+# How long a request waits for a connection when DB_POOL_MAX_OPEN is set;
+# as long as a punch waits on the group commit
+SLOT_TIMEOUT = 30.0
+
+
+class ConnectionPool:
+    """Small LIFO pool of SQLite connections for one worker process.
+
+    Connections are handed out per request and returned on teardown, so a
+    sync gunicorn worker keeps reusing a single warm connection (with its
+    prepared statement cache) and a threaded worker holds at most one
+    connection per busy thread.
+    """
+
+    def __init__(self, database, max_idle=4, timeout=5.0, cached_statements=256):
+        self.database = database
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # Callables run on each new connection (tracing, instrumentation)
+        self.on_connect = []
+        # Connection class; metrics swaps in one that times statements
+        self.factory = sqlite3.Connection
+
+    dialect = 'sqlite'
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.database,
+            timeout=self.timeout,
+            # Take the write lock up front for INSERT/UPDATE/DELETE so two
+            # writers never deadlock trying to upgrade a shared lock.
+            isolation_level='IMMEDIATE',
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            factory=self.factory,
+        )
+        conn.row_factory = sqlite3.Row
+        for name, value in PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        for hook in self.on_connect:
+            hook(conn)
+        return conn
+
+    def _check_fork(self):
+        # Connections must never cross a fork (gunicorn --preload), so a
+        # child process throws away whatever it inherited from the master.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._idle = queue.LifoQueue()
+                    self._pid = os.getpid()
+
+    def acquire(self):
+        self._check_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        self._check_fork()
+        if conn.in_transaction:
+            conn.rollback()
+        if self._idle.qsize() < self.max_idle:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# SQLite DDL -> PostgreSQL; REAL is single precision there, too coarse for
+# coordinates and epoch timestamps
+DDL_TYPES = (
+    (re.compile(r'\bINTEGER PRIMARY KEY AUTOINCREMENT\b', re.I), 'SERIAL PRIMARY KEY'),
+    (re.compile(r'\bREAL\b', re.I), 'DOUBLE PRECISION'),
+)
+INSERT_OR_IGNORE = re.compile(r'^\s*INSERT\s+OR\s+IGNORE\s+INTO\b', re.I)
+LIKE = re.compile(r'\bLIKE\b', re.I)
+# String literals, which placeholder translation must leave alone
+SQL_TOKENS = re.compile(r"'(?:[^']|'')*'|[^']+")
+
+
+def to_postgres(sql):
+    """Translate one statement written for SQLite into PostgreSQL."""
+    head = sql.lstrip()[:16].upper()
+    if head.startswith('BEGIN IMMEDIATE'):
+        return f'SELECT pg_advisory_xact_lock({WRITE_LOCK_KEY})'
+    if head.startswith(('CREATE', 'ALTER')):
+        for pattern, replacement in DDL_TYPES:
+            sql = pattern.sub(replacement, sql)
+    if INSERT_OR_IGNORE.match(sql):
+        sql = INSERT_OR_IGNORE.sub('INSERT INTO', sql) + ' ON CONFLICT DO NOTHING'
+    # psycopg2 uses %s placeholders, so a literal % has to be doubled;
+    # SQLite's LIKE ignores ASCII case, PostgreSQL's ILIKE does the same
+    parts = []
+    for token in SQL_TOKENS.findall(sql.replace('%', '%%')):
+        parts.append(token if token.startswith("'") else LIKE.sub('ILIKE', token.replace('?', '%s')))
+    return ''.join(parts)
+
+
+class PostgresCursor:
+    """psycopg2 cursor with sqlite3 cursor behaviour (rows by name or index)."""
+
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self._cursor = cursor
+
+    def execute(self, sql, params=()):
+        try:
+            self._cursor.execute(to_postgres(sql), tuple(params))
+        except self.connection.driver.IntegrityError as e:
+            raise IntegrityError(str(e)) from e
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        # One round trip per page of rows instead of one per row
+        from psycopg2.extras import execute_batch
+        try:
+            execute_batch(self._cursor, to_postgres(sql), [tuple(p) for p in seq_of_params], page_size=500)
+        except self.connection.driver.IntegrityError as e:
+            raise IntegrityError(str(e)) from e
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone() if self._cursor.description else None
+
+    def fetchall(self):
+        return self._cursor.fetchall() if self._cursor.description else []
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size) if self._cursor.description else []
+
+    def __iter__(self):
+        return iter(self._cursor) if self._cursor.description else iter(())
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def lastrowid(self):
+        # Id from the sequence of the last SERIAL insert on this connection
+        return self.connection.execute('SELECT lastval()').fetchone()[0]
+
+
+class PostgresConnection:
+    """The part of sqlite3.Connection the app uses, on a psycopg2 connection."""
+
+    def __init__(self, raw, driver):
+        self.raw = raw
+        self.driver = driver
+
+    def cursor(self):
+        from psycopg2.extras import DictCursor
+        return PostgresCursor(self, self.raw.cursor(cursor_factory=DictCursor))
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.raw.close()
+
+    @property
+    def closed(self):
+        return bool(self.raw.closed)
+
+    @property
+    def in_transaction(self):
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+        return self.raw.get_transaction_status() != TRANSACTION_STATUS_IDLE
+
+
+def _as_text(value, cursor):
+    return value
+
+
+def _as_number(value, cursor):
+    # SUM() over integers is NUMERIC in PostgreSQL; sqlite3 gives int/float
+    if value is None:
+        return None
+    return float(value) if '.' in value else int(value)
+
+
+class PostgresPool(ConnectionPool):
+    """ConnectionPool for DATABASE_URL (needs psycopg2-binary).
+
+    Timestamps come back as the same 'YYYY-MM-DD HH:MM:SS' strings SQLite
+    stores, so code slicing dates out of them works on both.
+    """
+
+    dialect = 'postgres'
+
+    def __init__(self, url, max_idle=8, timeout=5.0):
+        super().__init__(url, max_idle=max_idle, timeout=timeout)
+        self.factory = PostgresConnection
+
+    def _connect(self):
+        import psycopg2
+        from psycopg2 import extensions
+        raw = psycopg2.connect(self.database, connect_timeout=int(self.timeout))
+        text = extensions.new_type((1082, 1114, 1184), 'SQLITE_TEXT', _as_text)  # date, timestamp(tz)
+        number = extensions.new_type((1700,), 'SQLITE_NUMBER', _as_number)  # numeric
+        extensions.register_type(text, raw)
+        extensions.register_type(number, raw)
+        conn = self.factory(raw, psycopg2)
+        for hook in self.on_connect:
+            hook(conn)
+        return conn
+
+    def acquire(self):
+        conn = super().acquire()
+        if conn.closed:  # Server restarted or dropped the idle connection
+            return self._connect()
+        return conn
+
+    def release(self, conn):
+        if conn.closed:
+            return
+        super().release(conn)
+
+
+def dialect(conn):
+    return 'postgres' if isinstance(conn, PostgresConnection) else 'sqlite'
+
+
+def init_app(app):
+    max_idle = app.config.get('DB_POOL_MAX_IDLE', 4)
+    if app.config.get('DATABASE_URL'):
+        app.extensions['db_pool'] = PostgresPool(app.config['DATABASE_URL'], max_idle=max_idle)
+    else:
+        app.extensions['db_pool'] = ConnectionPool(app.config['DATABASE'], max_idle=max_idle)
+    # Requests holding a connection at once (0: no limit). A thread per
+    # request bounds this already; greenlets don't, and hundreds of them
+    # would each open a connection. Background threads aren't counted, so
+    # requests waiting on them for a slot can't starve them of one.
+    max_open = app.config.get('DB_POOL_MAX_OPEN', 0)
+    app.extensions['db_slots'] = threading.BoundedSemaphore(max_open) if max_open else None
+    app.teardown_appcontext(_release_db)
+
+
+def get_db():
+    """Return the connection bound to the current app context.
+
+    Raises TimeoutError if a request waits more than SLOT_TIMEOUT seconds
+    for one of DB_POOL_MAX_OPEN connections.
+    """
+    if 'db' not in g:
+        slots = current_app.extensions['db_slots']
+        pool = current_app.extensions['db_pool']
+        if slots is not None and has_request_context():
+            if not slots.acquire(timeout=SLOT_TIMEOUT):
+                raise TimeoutError('No database connection free')
+            g.db_slot = slots
+        try:
+            g.db = pool.acquire()
+        except BaseException:
+            _release_slot()
+            raise
+    return g.db
+
+
+def _release_slot():
+    slots = g.pop('db_slot', None)
+    if slots is not None:
+        slots.release()
+
+
+def _release_db(exc=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        current_app.extensions['db_pool'].release(conn)
+    _release_slot()
@@ -0,0 +1,223 @@
+"""Server-side reverse geocoding with a spatial cache.
+
+Coordinates are snapped to a geohash cell (precision 7 is roughly a
+150m x 150m box), so everyone punching on the same site shares one cached
+address. Lookups check an in-memory LRU first, then the geocode_cache
+table, and only then call the provider - once per cell, at the cell's
+centre, so the stored address is the same for every worker on that site.
+"""
+import json
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+
+from db import get_db
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(lat, lon, precision=7):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    bits = []
+    even = True
+    while len(bits) < precision * 5:
+        rng, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits.append(1)
+            rng[0] = mid
+        else:
+            bits.append(0)
+            rng[1] = mid
+        even = not even
+    return ''.join(
+        GEOHASH_ALPHABET[int(''.join(map(str, bits[i:i + 5])), 2)]
+        for i in range(0, len(bits), 5)
+    )
+
+
+def geohash_center(cell):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in cell:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if value >> shift & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+
+class NominatimProvider:
+    """OpenStreetMap Nominatim. Their usage policy allows at most one request
+    per second per application, so calls from this process are spaced out."""
+
+    name = 'nominatim'
+
+    def __init__(self, user_agent='VSConstructionAttendance/1.0', timeout=5.0, min_interval=1.0,
+                 base_url='https://nominatim.openstreetmap.org/reverse'):
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.base_url = base_url
+        self._lock = threading.Lock()
+        self._last_call = 0.0
+
+    def reverse(self, lat, lon):
+        query = urllib.parse.urlencode({'lat': lat, 'lon': lon, 'format': 'json', 'addressdetails': 1})
+        request = urllib.request.Request(f'{self.base_url}?{query}', headers={'User-Agent': self.user_agent})
+        # Reserve the next free slot under the lock, then sleep outside it so
+        # a queue of callers waits in parallel instead of one after another
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._last_call + self.min_interval)
+            self._last_call = slot
+        if slot > now:
+            time.sleep(slot - now)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                data = json.load(response)
+        except (OSError, ValueError):
+            return None
+
+        addr = data.get('address') or {}
+        if not addr:
+            return None
+        # Same precedence the capture pages used: most specific place first
+        city = (addr.get('neighbourhood') or addr.get('suburb') or addr.get('quarter')
+                or addr.get('hamlet') or addr.get('village') or addr.get('town')
+                or addr.get('city') or addr.get('state_district') or addr.get('state')
+                or 'Location captured')
+        parts = [
+            addr.get('road'),
+            addr.get('neighbourhood') or addr.get('suburb'),
+            addr.get('village') or addr.get('town') or addr.get('city'),
+            addr.get('state_district'),
+            addr.get('state'),
+            addr.get('country'),
+        ]
+        return {'city': city, 'full_address': ', '.join(p for p in parts if p)}
+
+
+class StubProvider:
+    """Offline provider for development and tests: answers from a fixed table
+    of (lat, lon, radius_km) -> address, or with the coordinates themselves."""
+
+    name = 'stub'
+
+    def __init__(self, places=()):
+        self.places = list(places)
+        self.calls = 0
+
+    def reverse(self, lat, lon):
+        self.calls += 1
+        for place_lat, place_lon, radius_km, city, full_address in self.places:
+            # ~111km per degree is plenty accurate at site scale
+            if ((lat - place_lat) ** 2 + (lon - place_lon) ** 2) ** 0.5 * 111 <= radius_km:
+                return {'city': city, 'full_address': full_address}
+        return {'city': f'{lat:.4f}, {lon:.4f}', 'full_address': f'Lat: {lat:.5f}, Lon: {lon:.5f}'}
+
+
+class GeocodingService:
+    def __init__(self, provider, precision=7, maxsize=4096):
+        self.provider = provider
+        self.precision = precision
+        self.maxsize = maxsize
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.counters = {'memory_hits': 0, 'db_hits': 0, 'provider_calls': 0, 'provider_failures': 0,
+                         'coalesced': 0}
+
+    def lookup(self, lat, lon, remote=True):
+        """Return {'city', 'full_address', 'cell', 'source'} or None.
+
+        With remote=False only the caches are consulted, which is what the
+        punch handlers use so a check-in never waits on an external API.
+        """
+        cell = geohash(lat, lon, self.precision)
+        with self._lock:
+            cached = self._memory.get(cell)
+            if cached is not None:
+                self._memory.move_to_end(cell)
+                self.counters['memory_hits'] += 1
+                return dict(cached, cell=cell, source='memory')
+
+        conn = get_db()
+        row = conn.execute('SELECT city, full_address FROM geocode_cache WHERE cell = ?', (cell,)).fetchone()
+        if row is not None:
+            self.counters['db_hits'] += 1
+            result = {'city': row['city'], 'full_address': row['full_address']}
+            self._remember(cell, result)
+            return dict(result, cell=cell, source='database')
+
+        if not remote:
+            return None
+
+        # Single flight per cell: the first caller asks the provider, everyone
+        # else arriving for the same cell meanwhile waits for its answer
+        with self._lock:
+            flight = self._in_flight.get(cell)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[cell] = {'done': threading.Event(), 'result': None}
+            else:
+                self.counters['coalesced'] += 1
+        if not leader:
+            flight['done'].wait()
+            result = flight['result']
+            return dict(result, cell=cell, source=self.provider.name) if result else None
+        try:
+            result = self._fetch(conn, cell)
+            flight['result'] = result
+        finally:
+            with self._lock:
+                del self._in_flight[cell]
+            flight['done'].set()
+        return dict(result, cell=cell, source=self.provider.name) if result else None
+
+    def _fetch(self, conn, cell):
+        self.counters['provider_calls'] += 1
+        center_lat, center_lon = geohash_center(cell)
+        result = self.provider.reverse(center_lat, center_lon)
+        if not result:
+            self.counters['provider_failures'] += 1
+            return None
+        conn.execute('''
+            INSERT INTO geocode_cache (cell, city, full_address, provider, created_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (cell) DO UPDATE SET
+                city = excluded.city, full_address = excluded.full_address,
+                provider = excluded.provider, created_at = excluded.created_at
+        ''', (cell, result['city'], result['full_address'], self.provider.name, time.time()))
+        conn.commit()
+        self._remember(cell, result)
+        return result
+
+    def _remember(self, cell, result):
+        with self._lock:
+            self._memory[cell] = result
+            self._memory.move_to_end(cell)
+            while len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, memory_size=len(self._memory))
+
+
+def create_service(config):
+    """Build the service for GEOCODER ('nominatim' or 'stub')."""
+    if config.get('GEOCODER', 'nominatim') == 'stub':
+        provider = StubProvider()
+    else:
+        provider = NominatimProvider()
+    return GeocodingService(provider)
@@ -0,0 +1,216 @@
+"""Site geofences and punch validation.
+
+Sites are circles (centre + radius) or polygons. At startup the active
+sites are loaded into a uniform grid index: every grid cell lists the
+sites whose bounding box touches it, so resolving a punch only runs the
+exact inside-test against the one or two sites near it. When sites change
+a version stamp in cache_versions is bumped and each worker rebuilds its
+index on its next check.
+
+revalidate() re-checks stored attendance rows in bulk with NumPy.
+"""
+import json
+import math
+import threading
+import time
+
+from db import get_db
+
+EARTH_RADIUS_M = 6371000.0
+GRID_DEGREES = 0.01  # ~1.1km cells
+REVALIDATE_CHUNK = 20000
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def point_in_polygon(lat, lon, polygon):
+    """Ray casting; `polygon` is a list of [lat, lon] vertices."""
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        yi, xi = polygon[i]
+        yj, xj = polygon[j]
+        if (yi > lat) != (yj > lat) and lon < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+class Site:
+    def __init__(self, row):
+        self.id = row['id']
+        self.name = row['name']
+        self.kind = row['kind']
+        self.center_lat = row['center_lat']
+        self.center_lon = row['center_lon']
+        self.radius_m = row['radius_m']
+        self.polygon = json.loads(row['polygon']) if row['polygon'] else None
+
+    def bbox(self):
+        if self.kind == 'polygon':
+            lats = [p[0] for p in self.polygon]
+            lons = [p[1] for p in self.polygon]
+            return min(lats), min(lons), max(lats), max(lons)
+        dlat = self.radius_m / 111320.0
+        dlon = self.radius_m / (111320.0 * max(math.cos(math.radians(self.center_lat)), 0.01))
+        return self.center_lat - dlat, self.center_lon - dlon, self.center_lat + dlat, self.center_lon + dlon
+
+    def contains(self, lat, lon):
+        if self.kind == 'polygon':
+            return point_in_polygon(lat, lon, self.polygon)
+        return haversine_m(lat, lon, self.center_lat, self.center_lon) <= self.radius_m
+
+    def distance_m(self, lat, lon):
+        return haversine_m(lat, lon, self.center_lat, self.center_lon)
+
+
+class GridIndex:
+    """Uniform lat/lon grid mapping cells to the sites overlapping them."""
+
+    def __init__(self, sites, cell=GRID_DEGREES):
+        self.cell = cell
+        self.sites = list(sites)
+        self.cells = {}
+        for site in self.sites:
+            min_lat, min_lon, max_lat, max_lon = site.bbox()
+            for i in range(self._key(min_lat), self._key(max_lat) + 1):
+                for j in range(self._key(min_lon), self._key(max_lon) + 1):
+                    self.cells.setdefault((i, j), []).append(site)
+
+    def _key(self, value):
+        return math.floor(value / self.cell)
+
+    def resolve(self, lat, lon):
+        """Return the site containing the point (nearest centre wins), or None."""
+        candidates = self.cells.get((self._key(lat), self._key(lon)), ())
+        matches = [site for site in candidates if site.contains(lat, lon)]
+        if not matches:
+            return None
+        return min(matches, key=lambda site: site.distance_m(lat, lon))
+
+
+class GeofenceEngine:
+    VERSION_NAME = 'sites'
+
+    def __init__(self, version_check_interval=5.0):
+        self.version_check_interval = version_check_interval
+        self._index = None
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def index(self):
+        now = time.monotonic()
+        if self._index is not None and now - self._checked_at < self.version_check_interval:
+            return self._index
+        conn = get_db()
+        row = conn.execute('SELECT version FROM cache_versions WHERE name = ?', (self.VERSION_NAME,)).fetchone()
+        version = row['version'] if row else None
+        with self._lock:
+            self._checked_at = now
+            if self._index is None or version != self._version:
+                sites = [Site(r) for r in conn.execute('SELECT * FROM sites WHERE active = 1')]
+                self._index = GridIndex(sites)
+                self._version = version
+            return self._index
+
+    def check(self, lat, lon):
+        """Return (site_id, off_site) for a punch.
+
+        Both are None when the punch has no coordinates or no sites are set
+        up, since there is nothing to validate against.
+        """
+        if lat is None or lon is None or (lat == 0 and lon == 0):
+            return None, None
+        index = self.index()
+        if not index.sites:
+            return None, None
+        site = index.resolve(lat, lon)
+        return (site.id, 0) if site else (None, 1)
+
+    def sites_changed(self, conn):
+        """Bump the version so every worker rebuilds; call inside the write's transaction."""
+        conn.execute('UPDATE cache_versions SET version = version + 1 WHERE name = ?', (self.VERSION_NAME,))
+        with self._lock:
+            self._index = None
+
+
+def _resolve_batch(np, sites, lat, lon):
+    """Vectorized site resolution for arrays of points; -1 means no site."""
+    site_ids = np.full(lat.shape, -1, dtype=np.int64)
+    best_distance = np.full(lat.shape, np.inf)
+    lat_r = np.radians(lat)
+    lon_r = np.radians(lon)
+    for site in sites:
+        center_lat = math.radians(site.center_lat)
+        center_lon = math.radians(site.center_lon)
+        a = (np.sin((lat_r - center_lat) / 2) ** 2
+             + np.cos(lat_r) * math.cos(center_lat) * np.sin((lon_r - center_lon) / 2) ** 2)
+        distance = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+        if site.kind == 'polygon':
+            inside = np.zeros(lat.shape, dtype=bool)
+            vertices = site.polygon
+            j = len(vertices) - 1
+            for i in range(len(vertices)):
+                yi, xi = vertices[i]
+                yj, xj = vertices[j]
+                if yi != yj:
+                    crosses = ((yi > lat) != (yj > lat)) & (lon < (xj - xi) * (lat - yi) / (yj - yi) + xi)
+                    inside ^= crosses
+                j = i
+        else:
+            inside = distance <= site.radius_m
+        better = inside & (distance < best_distance)
+        site_ids[better] = site.id
+        best_distance[better] = distance[better]
+    return site_ids
+
+
+def revalidate(conn, start_date=None, end_date=None):
+    """Recompute site_id/off_site for stored punches. Returns (rows, off_site)."""
+    import numpy as np
+
+    sites = [Site(r) for r in conn.execute('SELECT * FROM sites WHERE active = 1')]
+    if not sites:
+        return 0, 0
+
+    conditions = []
+    params = []
+    if start_date:
+        conditions.append('check_in_time >= ?')
+        params.append(start_date)
+    if end_date:
+        conditions.append('check_in_time < ?')
+        params.append(end_date)
+    where = ('AND ' + ' AND '.join(conditions)) if conditions else ''
+
+    total = off_site = 0
+    for prefix in ('checkin', 'checkout'):
+        cursor = conn.execute(f'''
+            SELECT id, {prefix}_latitude, {prefix}_longitude FROM attendance
+            WHERE {prefix}_latitude IS NOT NULL AND {prefix}_longitude IS NOT NULL
+              AND NOT ({prefix}_latitude = 0 AND {prefix}_longitude = 0) {where}
+        ''', params)
+        while True:
+            rows = cursor.fetchmany(REVALIDATE_CHUNK)
+            if not rows:
+                break
+            data = np.array([tuple(r) for r in rows], dtype=np.float64)
+            site_ids = _resolve_batch(np, sites, data[:, 1], data[:, 2])
+            updates = [
+                (None if sid < 0 else int(sid), 1 if sid < 0 else 0, int(row_id))
+                for row_id, sid in zip(data[:, 0], site_ids)
+            ]
+            conn.executemany(
+                f'UPDATE attendance SET {prefix}_site_id = ?, {prefix}_off_site = ? WHERE id = ?', updates
+            )
+            total += len(updates)
+            off_site += int((site_ids < 0).sum())
+    conn.commit()
+    return total, off_site
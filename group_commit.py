@@ -0,0 +1,150 @@
+"""Group commit for the punch path.
+
+At shift change hundreds of punches arrive at once, and each used to take
+the SQLite write lock for its own transaction. Threads queued on the lock
+through busy_timeout's sleep-and-retry, so latency grew with the burst and
+most of the wall time went on waiting rather than writing.
+
+Request threads now do everything that does not need the lock (parsing,
+photo writes, geocoding/geofence lookups) in parallel, then hand their
+writes to one writer thread per process as a `work(conn)` callable. The
+writer runs whatever has queued up since its last commit in a single
+transaction, each punch inside its own savepoint so one failing punch
+doesn't take the others down, commits once and wakes the waiting requests.
+Batches form on their own under load; a lone punch commits straight away.
+"""
+import os
+import queue
+import threading
+import traceback
+
+import metrics
+from db import get_db
+
+
+class _Pending:
+    __slots__ = ('work', 'result', 'error', 'done', 'state')
+
+    def __init__(self, work):
+        self.work = work
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.state = 'queued'  # -> 'running' on the writer, or 'cancelled' by a timed-out request
+
+
+class GroupCommitWriter:
+    def __init__(self, app=None, max_batch=64, timeout=30.0):
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.enabled = True
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.counters = {'batches': 0, 'punches': 0, 'failed': 0, 'largest_batch': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('PUNCH_GROUP_COMMIT', True)
+        app.extensions['punch_writer'] = self
+
+    def run(self, work):
+        """Run `work(conn)` in the next group transaction and return its result.
+
+        `work` runs on the writer thread: it must only use the connection it
+        is given and values captured beforehand (no current_user, no request).
+        Exceptions it raises are re-raised here, with its writes rolled back.
+        If the writer hasn't started on it within `timeout`, it is withdrawn
+        and TimeoutError raised, so it never runs after the caller gave up;
+        once started, the real outcome is awaited and returned.
+        """
+        if not self.enabled:
+            conn = get_db()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(conn)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return result
+        pending = _Pending(work)
+        self._ensure_started()
+        self._queue.put(pending)
+        with metrics.span('punch.group_commit'):
+            if not pending.done.wait(self.timeout):
+                if self._transition(pending, 'queued', 'cancelled'):
+                    raise TimeoutError('Punch was not committed in time')
+                pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def stats(self):
+        return dict(self.counters, enabled=self.enabled, queued=self._queue.qsize())
+
+    def _transition(self, pending, before, after):
+        with self._state_lock:
+            if pending.state != before:
+                return False
+            pending.state = after
+            return True
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()  # Never inherit another process's waiters
+            self._thread = threading.Thread(target=self._run, name='punch-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.app.app_context():
+                    self._commit(get_db(), batch)
+            except Exception as e:
+                traceback.print_exc()
+                for pending in batch:
+                    if pending.error is None:
+                        pending.error = e
+            for pending in batch:
+                pending.done.set()
+
+    def _commit(self, conn, batch):
+        # Requests that timed out while queued have withdrawn their work
+        batch = [pending for pending in batch if self._transition(pending, 'queued', 'running')]
+        if not batch:
+            return
+        with metrics.span('punch.batch'):
+            conn.execute('BEGIN IMMEDIATE')
+            for index, pending in enumerate(batch):
+                conn.execute(f'SAVEPOINT punch_{index}')
+                try:
+                    pending.result = pending.work(conn)
+                except Exception as e:
+                    conn.execute(f'ROLLBACK TO SAVEPOINT punch_{index}')
+                    pending.error = e
+                    self.counters['failed'] += 1
+                conn.execute(f'RELEASE SAVEPOINT punch_{index}')
+            try:
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        self.counters['batches'] += 1
+        self.counters['punches'] += len(batch)
+        self.counters['largest_batch'] = max(self.counters['largest_batch'], len(batch))
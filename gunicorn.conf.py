@@ -0,0 +1,34 @@
+# Picked up by gunicorn from the working directory. Threaded workers let one
+# process hold many requests at once: punches spend most of their time on
+# uploads and waiting for the group commit, and the presence streams stay
+# open; sync workers would cap both at the worker count. Streams are capped
+# at PRESENCE_MAX_SUBSCRIBERS per worker so they leave threads for punches.
+#
+# GUNICORN_WORKER_CLASS=gevent serves each request from a greenlet instead,
+# so a single worker holds hundreds of presence streams (up to
+# GUNICORN_WORKER_CONNECTIONS open connections) for the memory of a few
+# threads. It defaults to one worker: SQLite waits for another process's
+# write lock inside C, which would stall every greenlet of the waiting
+# worker. Punch bursts are faster on the threaded default (see readme).
+#
+# The app is preloaded: the master imports it and runs create_app() (schema,
+# migrations, default admin) once, then forks workers that share the
+# imported code and start serving straight away. Preloaded code is not
+# re-read on a HUP reload; restart gunicorn to deploy.
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+if worker_class == 'gevent':
+    # Before the preloaded app is imported, so the locks, queues, sleeps and
+    # sockets it creates are the cooperative ones in every worker
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()  # PostgreSQL queries yield to other greenlets too
+
+wsgi_app = 'app:create_app()'
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1 if worker_class == 'gevent' else 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
@@ -0,0 +1,117 @@
+"""Image policy: how large attendance photos may be, how they are encoded,
+and which renditions the dashboards are served.
+
+The capture pages read the policy (client_config) and downscale and encode
+each frame before upload, preferring WebP or AVIF where the browser can
+produce it. The server enforces the same limits: the background 'optimize'
+job re-encodes anything that arrives larger, in place under the same key
+(a key names the photo as uploaded, so dedupe still works), and renditions
+are rendered on first request and kept in the image store.
+
+Pillow is imported on first use, not with the app.
+"""
+import io
+from functools import cached_property
+
+# name -> longest side in pixels, encoder quality (1-100), byte budget
+TIERS = {
+    'high': {'max_dimension': 1920, 'quality': 85, 'max_bytes': 900 * 1024},
+    'standard': {'max_dimension': 1280, 'quality': 75, 'max_bytes': 400 * 1024},
+    'low': {'max_dimension': 960, 'quality': 60, 'max_bytes': 200 * 1024},
+}
+
+# Longest side of each rendition; 'thumb' keeps the thumb_ naming of the
+# thumbnails the image worker has always made
+RENDITIONS = {'thumb': 150, 'medium': 640}
+
+# Pillow format name -> (MIME type, key suffix, feature Pillow needs)
+FORMATS = {
+    'JPEG': ('image/jpeg', '.jpg', None),
+    'WEBP': ('image/webp', '.webp', 'webp'),
+    'AVIF': ('image/avif', '.avif', 'avif'),
+}
+SUFFIX_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.webp': 'WEBP', '.avif': 'AVIF'}
+
+
+def sniff(head):
+    """Pillow format name from the first bytes of a file, or None."""
+    if head[:3] == b'\xff\xd8\xff':
+        return 'JPEG'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    if head[4:12] in (b'ftypavif', b'ftypavis'):
+        return 'AVIF'
+    return None
+
+
+def format_for_key(key):
+    for suffix, fmt in SUFFIX_FORMATS.items():
+        if key.lower().endswith(suffix):
+            return fmt
+    return 'JPEG'
+
+
+def supported(fmt):
+    from PIL import features
+    feature = FORMATS[fmt][2]
+    try:
+        return feature is None or features.check(feature)
+    except ValueError:
+        return False  # Pillow too old to know the feature
+
+
+class ImagePolicy:
+    def __init__(self, tier='standard', formats=('WEBP', 'JPEG')):
+        if tier not in TIERS:
+            raise ValueError(f'Unknown image quality tier: {tier!r}')
+        self.tier = tier
+        self.max_dimension = TIERS[tier]['max_dimension']
+        self.quality = TIERS[tier]['quality']
+        self.max_bytes = TIERS[tier]['max_bytes']
+        self.requested_formats = list(formats)
+
+    @cached_property
+    def formats(self):
+        # Only accept what this server can decode again for renditions
+        return [fmt for fmt in self.requested_formats if fmt in FORMATS and supported(fmt)] or ['JPEG']
+
+    def client_config(self):
+        """Settings for the capture pages (MIME types in order of preference)."""
+        return {
+            'tier': self.tier,
+            'maxDimension': self.max_dimension,
+            'quality': self.quality / 100,
+            'formats': [FORMATS[fmt][0] for fmt in self.formats],
+        }
+
+    def suffix_for(self, head):
+        """Key suffix for an upload starting with `head`; unknown data keeps .jpg."""
+        fmt = sniff(head)
+        return FORMATS[fmt][1] if fmt in self.formats else '.jpg'
+
+    def needs_reencode(self, img, size_bytes):
+        return max(img.size) > self.max_dimension or size_bytes > self.max_bytes
+
+    def encode(self, img, fmt, max_dimension, quality=None):
+        """Orient, downscale to `max_dimension` and encode as `fmt`."""
+        from PIL import Image, ImageOps
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        img.save(output, fmt, quality=quality or self.quality)
+        return output.getvalue()
+
+    def reencode(self, img, fmt):
+        return self.encode(img, fmt, self.max_dimension)
+
+    def rendition(self, img, name, fmt):
+        return self.encode(img, fmt, RENDITIONS[name], quality=min(self.quality, 80))
+
+
+def create_policy(config):
+    """Build the policy from IMAGE_QUALITY_TIER and IMAGE_FORMATS (AVIF is
+    opt-in: few browsers can encode it and it is slow to render server-side)."""
+    formats = [f.strip().upper() for f in (config.get('IMAGE_FORMATS') or 'webp,jpeg').split(',') if f.strip()]
+    return ImagePolicy(config.get('IMAGE_QUALITY_TIER') or 'standard', formats)
@@ -0,0 +1,207 @@
+import os
+import threading
+import time
+import traceback
+
+from db import get_db
+
+# Jobs are rows in image_jobs so they survive a worker restart and every
+# gunicorn worker can pick up whatever is pending. Each worker process runs
+# one background thread that claims jobs one at a time.
+SCHEMA = ('''
+    CREATE TABLE IF NOT EXISTS image_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        source TEXT NOT NULL,
+        target TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        created_at REAL NOT NULL,
+        run_after REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL
+    )
+''', '''
+    CREATE INDEX IF NOT EXISTS idx_image_jobs_status ON image_jobs (status, run_after)
+''')
+STATUSES = ('pending', 'running', 'done', 'failed')
+
+
+class ImageWorker:
+    """Background worker that runs queued image jobs outside the request."""
+
+    def __init__(self, app, max_attempts=3, poll_interval=5.0, stale_after=300.0):
+        self.app = app
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.handlers = {}
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def enqueue(self, conn, kind, source, target=None, delay=0):
+        """Queue a job on `conn`; it becomes visible when the caller commits
+        and runs no sooner than `delay` seconds from now."""
+        now = time.time()
+        conn.execute(
+            'INSERT INTO image_jobs (kind, source, target, created_at, run_after) VALUES (?, ?, ?, ?, ?)',
+            (kind, source, target, now, now + delay)
+        )
+
+    def notify(self):
+        self.ensure_started()
+        self._wakeup.set()
+
+    def ensure_started(self):
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='image-worker', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.run_pending()
+            except Exception:
+                traceback.print_exc()
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def run_pending(self, limit=None):
+        """Process claimable jobs until the queue is empty; returns the count."""
+        processed = 0
+        while limit is None or processed < limit:
+            job = self._claim()
+            if job is None:
+                break
+            self._process(job)
+            processed += 1
+            # Under gevent this worker is a greenlet: let requests run between jobs
+            time.sleep(0)
+        return processed
+
+    def _claim(self):
+        conn = get_db()
+        now = time.time()
+        while True:
+            job = conn.execute('''
+                SELECT id, kind, source, target, attempts FROM image_jobs
+                WHERE (status = 'pending' AND run_after <= ?)
+                   OR (status = 'running' AND started_at < ?)
+                ORDER BY id LIMIT 1
+            ''', (now, now - self.stale_after)).fetchone()
+            if job is None:
+                return None
+            # Another worker process may have claimed it in the meantime
+            claimed = conn.execute('''
+                UPDATE image_jobs SET status = 'running', started_at = ?, attempts = attempts + 1
+                WHERE id = ? AND attempts = ?
+            ''', (now, job['id'], job['attempts'])).rowcount
+            conn.commit()
+            if claimed:
+                return job
+
+    def _process(self, job):
+        conn = get_db()
+        try:
+            self.handlers[job['kind']](job['source'], job['target'])
+        except Exception as e:
+            # Drop the handler's half-done writes (and clear an aborted
+            # PostgreSQL transaction) before recording the failure
+            conn.rollback()
+            attempts = job['attempts'] + 1
+            if attempts >= self.max_attempts:
+                conn.execute(
+                    "UPDATE image_jobs SET status = 'failed', last_error = ?, finished_at = ? WHERE id = ?",
+                    (repr(e), time.time(), job['id'])
+                )
+            else:
+                # Back off 2s, 4s, ... before the next attempt
+                conn.execute(
+                    "UPDATE image_jobs SET status = 'pending', last_error = ?, run_after = ? WHERE id = ?",
+                    (repr(e), time.time() + 2 ** attempts, job['id'])
+                )
+        else:
+            conn.execute(
+                "UPDATE image_jobs SET status = 'done', last_error = NULL, finished_at = ? WHERE id = ?",
+                (time.time(), job['id'])
+            )
+        conn.commit()
+
+    def depth(self):
+        """Jobs running or due now. Two counts answered from
+        idx_image_jobs_status alone, cheap enough for every metrics scrape."""
+        conn = get_db()
+        running = conn.execute("SELECT COUNT(*) FROM image_jobs WHERE status = 'running'").fetchone()[0]
+        due = conn.execute(
+            "SELECT COUNT(*) FROM image_jobs WHERE status = 'pending' AND run_after <= ?", (time.time(),)
+        ).fetchone()[0]
+        return running + due
+
+    def stats(self, sample=500):
+        """Queue depth by status plus latency over the most recent finished jobs."""
+        conn = get_db()
+        # One index range count per status rather than a GROUP BY over the table
+        counts = {}
+        for status in STATUSES:
+            n = conn.execute('SELECT COUNT(*) FROM image_jobs WHERE status = ?', (status,)).fetchone()[0]
+            if n:
+                counts[status] = n
+        latencies = sorted(row['latency'] for row in conn.execute('''
+            SELECT finished_at - created_at AS latency FROM image_jobs
+            WHERE status = 'done' ORDER BY id DESC LIMIT ?
+        ''', (sample,)))
+        # Jobs scheduled for later (the daily retention pass) aren't backlog
+        now = time.time()
+        oldest = conn.execute('''
+            SELECT MIN(created_at) FROM image_jobs
+            WHERE status = 'running' OR (status = 'pending' AND run_after <= ?)
+        ''', (now,)).fetchone()[0]
+
+        def pct(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))], 3)
+
+        return {
+            'depth': self.depth(),
+            'by_status': counts,
+            'oldest_pending_age_s': round(now - oldest, 1) if oldest else None,
+            'latency_s': {'p50': pct(50), 'p95': pct(95), 'max': pct(100), 'sample': len(latencies)},
+        }
+
+    def purge_finished(self, conn, before, limit):
+        """Delete up to `limit` done or failed jobs that finished before the
+        epoch time `before`, oldest first; returns how many went."""
+        ids = [row['id'] for row in conn.execute(
+            'SELECT id FROM image_jobs WHERE finished_at < ? ORDER BY finished_at LIMIT ?', (before, limit)
+        )]
+        if ids:
+            conn.execute(f"DELETE FROM image_jobs WHERE id IN ({','.join('?' * len(ids))})", ids)
+            conn.commit()
+        return len(ids)
+
+    def failed_jobs(self, limit=50):
+        return [dict(row) for row in get_db().execute(
+            "SELECT id, kind, source, attempts, last_error, finished_at FROM image_jobs "
+            "WHERE status = 'failed' ORDER BY id DESC LIMIT ?", (limit,)
+        )]
+
+
+def init_app(app):
+    worker = ImageWorker(app)
+    app.extensions['image_worker'] = worker
+    # Also starts the thread after a restart so leftover jobs get drained
+    app.before_request(worker.ensure_started)
+    return worker
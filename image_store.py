@@ -0,0 +1,198 @@
+"""Content-addressed storage for attendance photos.
+
+A photo's key is the SHA-256 of its bytes, sharded two levels deep
+(``3f/a2/3fa2...e1.jpg``), so identical uploads share one object and no
+directory grows past a few hundred entries. Derived files such as
+thumbnails live next to their original under a predictable key (see
+thumbnail_key). Keys are what the attendance *_image_path columns store;
+rows written before this scheme keep their flat file names, which resolve
+the same way. The key is the hash of the photo as uploaded; the stored
+bytes may since have been re-encoded to the image policy (image_policy.py).
+"""
+import hashlib
+import io
+import mimetypes
+import os
+import posixpath
+import re
+import tempfile
+
+from flask import redirect, send_from_directory
+from werkzeug.exceptions import NotFound
+
+HASH_CHUNK_SIZE = 64 * 1024
+KEY_PATTERN = re.compile(r'^(?:[0-9a-f]{2}/[0-9a-f]{2}/)?[\w.-]+$')
+
+# Not every platform's mime.types knows the newer image formats
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+
+def content_key(digest, suffix='.jpg'):
+    return f'{digest[:2]}/{digest[2:4]}/{digest}{suffix}'
+
+
+def thumbnail_key(key, prefix='thumb_'):
+    directory, name = posixpath.split(key)
+    return posixpath.join(directory, prefix + name)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_type(key):
+    return mimetypes.guess_type(key)[0] or 'image/jpeg'
+
+
+def valid_key(key):
+    return bool(key) and '..' not in key and KEY_PATTERN.match(key) is not None
+
+
+class LocalImageStore:
+    """Stores photos under a local directory (the upload folder)."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key):
+        if not valid_key(key):
+            raise ValueError(f'Invalid image key: {key!r}')
+        return os.path.join(self.root, key)
+
+    def _atomic_move(self, src, key):
+        dest = self._path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(src, dest)
+
+    def put_file(self, src, suffix='.jpg'):
+        """Move the file at `src` into the store and return its key.
+
+        `src` is consumed: it is renamed into place, or removed if an
+        identical photo is already stored. It must be on the same
+        filesystem as the store (the upload temp files are).
+        """
+        key = content_key(hash_file(src), suffix)
+        if self.exists(key):
+            os.remove(src)
+        else:
+            self._atomic_move(src, key)
+        return key
+
+    def put_bytes(self, data, suffix='.jpg'):
+        key = content_key(hashlib.sha256(data).hexdigest(), suffix)
+        if not self.exists(key):
+            self.write(key, data)
+        return key
+
+    def write(self, key, data):
+        """Write `data` under an explicit key, atomically (temp file + rename)."""
+        dest = self._path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.write-', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, dest)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def send(self, key):
+        if not valid_key(key):
+            raise NotFound()
+        return send_from_directory(self.root, key, max_age=31536000)
+
+
+class S3ImageStore:
+    """Stores photos in an S3-compatible bucket (AWS S3, MinIO, R2...).
+
+    `client` is a boto3 S3 client or anything with the same put_object /
+    get_object / head_object / delete_object / generate_presigned_url
+    methods, so a local MinIO container can stand in for S3.
+    """
+
+    def __init__(self, client, bucket, prefix='', url_expiry=3600):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url_expiry = url_expiry
+
+    def _object(self, key):
+        if not valid_key(key):
+            raise ValueError(f'Invalid image key: {key!r}')
+        return self.prefix + key
+
+    def put_file(self, src, suffix='.jpg'):
+        key = content_key(hash_file(src), suffix)
+        try:
+            if not self.exists(key):
+                with open(src, 'rb') as f:
+                    self.client.put_object(Bucket=self.bucket, Key=self._object(key), Body=f,
+                                           ContentType=content_type(key))
+        finally:
+            os.remove(src)
+        return key
+
+    def put_bytes(self, data, suffix='.jpg'):
+        key = content_key(hashlib.sha256(data).hexdigest(), suffix)
+        if not self.exists(key):
+            self.write(key, data)
+        return key
+
+    def write(self, key, data):
+        # Single PUTs are atomic in S3: readers see the old object or the new one
+        self.client.put_object(Bucket=self.bucket, Key=self._object(key), Body=data,
+                               ContentType=content_type(key))
+
+    def open(self, key):
+        response = self.client.get_object(Bucket=self.bucket, Key=self._object(key))
+        return io.BytesIO(response['Body'].read())
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object(key))
+            return True
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object(key))
+        return True
+
+    def send(self, key):
+        if not valid_key(key):
+            raise NotFound()
+        return redirect(self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self._object(key)},
+            ExpiresIn=self.url_expiry
+        ))
+
+
+def create_store(config):
+    """Build the store selected by IMAGE_STORE ('local' or 's3')."""
+    if config.get('IMAGE_STORE', 'local') == 's3':
+        import boto3
+        client = boto3.client('s3', endpoint_url=config.get('S3_ENDPOINT_URL'))
+        return S3ImageStore(client, config['S3_BUCKET'], config.get('S3_PREFIX', ''))
+    return LocalImageStore(config['UPLOAD_FOLDER'])
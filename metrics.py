@@ -0,0 +1,266 @@
+"""Request timing, hot-path spans and an opt-in sampling profiler.
+
+Every request is timed into a histogram, and the hot paths inside it are
+wrapped in spans (SQLite statements and commits, photo decode/write,
+thumbnailing, template rendering). Both are served in the Prometheus text
+format at /metrics, and the spans of each request go out in its
+Server-Timing header so a slow punch can be read straight from the browser's
+network tab.
+
+Metrics are kept per worker process, like the other in-process caches;
+Prometheus scrapes each worker and sums them.
+
+The profiler samples the request thread's stack every PROFILE_INTERVAL
+seconds and writes collapsed stacks ("frame;frame;frame count", the input
+format of flamegraph.pl and speedscope) to PROFILE_DIR. It runs for every
+PROFILE_EVERY_N-th request, or for an admin request sent with the header
+X-Profile: 1.
+"""
+import bisect
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, template_rendered, before_render_template
+
+import db
+
+# Seconds; tuned for a request path where 5ms is fast and 5s is an outage
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted(((labels, ([*counts], total, n)) for labels, (counts, total, n) in self._series.items()),
+                           key=lambda item: item[0])
+        for labels, (counts, total, n) in items:
+            label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in zip(self.labelnames, labels))
+            prefix = label_text + ',' if label_text else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {n}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{label_text}}} {n}')
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUESTS = Histogram('http_request_duration_seconds', 'Time spent handling a request.',
+                     ('endpoint', 'method', 'status'))
+SPANS = Histogram('app_span_duration_seconds', 'Time spent in instrumented sections of the code.', ('span',))
+
+# name -> callable returning a number, rendered as gauges on /metrics
+_gauges = {}
+
+
+def gauge(name, help_text):
+    """Decorator registering a function whose return value is exported as a gauge."""
+    def register(fn):
+        _gauges[name] = (help_text, fn)
+        return fn
+    return register
+
+
+def observe_span(name, seconds):
+    SPANS.observe(seconds, name)
+    if has_request_context():
+        spans = g.setdefault('metric_spans', {})
+        total, count = spans.get(name, (0.0, 0))
+        spans[name] = (total + seconds, count + 1)
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block as `name` (also fine outside a request)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_span(name, time.perf_counter() - start)
+
+
+class TimedStatements:
+    """Mixin recording a span for each statement and commit of a connection.
+
+    Waiting for the write lock happens inside the first INSERT/UPDATE of a
+    transaction (isolation_level='IMMEDIATE'), so it shows up in db.execute.
+    """
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            observe_span('db.execute', time.perf_counter() - start)
+
+    def executemany(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args, **kwargs)
+        finally:
+            observe_span('db.executemany', time.perf_counter() - start)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            observe_span('db.commit', time.perf_counter() - start)
+
+
+class TimedConnection(TimedStatements, sqlite3.Connection):
+    pass
+
+
+class TimedPostgresConnection(TimedStatements, db.PostgresConnection):
+    pass
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples one thread's stack until stopped; see collapsed()."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class Metrics:
+    def __init__(self, app=None, can_profile=None):
+        self.can_profile = can_profile or (lambda: False)
+        self._request_count = 0
+        self._profile_count = 0
+        self._count_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.profile_every = int(app.config.get('PROFILE_EVERY_N') or 0)
+        self.profile_interval = float(app.config.get('PROFILE_INTERVAL') or 0.005)
+        self.profile_dir = app.config.get('PROFILE_DIR') or 'profiles'
+        pool = app.extensions['db_pool']
+        pool.factory = TimedPostgresConnection if pool.dialect == 'postgres' else TimedConnection
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+
+    def _should_profile(self):
+        if request.headers.get('X-Profile') == '1' and self.can_profile():
+            return True
+        if self.profile_every <= 0:
+            return False
+        with self._count_lock:
+            self._request_count += 1
+            return self._request_count % self.profile_every == 0
+
+    def _before_request(self):
+        g.metric_start = time.perf_counter()
+        g.metric_spans = {}
+        if self._should_profile():
+            g.profiler = SamplingProfiler(threading.get_ident(), self.profile_interval)
+            g.profiler.start()
+
+    def _after_request(self, response):
+        if 'metric_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.metric_start
+        REQUESTS.observe(elapsed, request.endpoint or 'unmatched', request.method, str(response.status_code))
+        timings = [f'{name.replace(".", "-")};dur={total * 1000:.2f};desc="{count}x"'
+                   for name, (total, count) in g.metric_spans.items()]
+        timings.append(f'total;dur={elapsed * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+            response.headers['X-Profile-File'] = self._write_profile(profiler)
+        return response
+
+    def _teardown_request(self, exc=None):
+        # A request that raised never reaches after_request
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+
+    def _write_profile(self, profiler):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        # Requests to one endpoint in the same second need their own files
+        with self._count_lock:
+            self._profile_count += 1
+            seq = self._profile_count
+        name = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{seq}-{request.endpoint or "unmatched"}.folded'
+        path = os.path.join(self.profile_dir, name)
+        with open(path, 'w') as f:
+            f.write(profiler.collapsed())
+        return name
+
+    def _render_started(self, sender, template, context, **extra):
+        g.setdefault('render_starts', []).append(time.perf_counter())
+
+    def _render_finished(self, sender, template, context, **extra):
+        starts = g.get('render_starts')
+        if starts:
+            observe_span('render', time.perf_counter() - starts.pop())
+
+    def render(self):
+        lines = REQUESTS.render() + SPANS.render()
+        for name, (help_text, fn) in sorted(_gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if value is None:
+                continue
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,218 @@
+"""Versioned schema changes applied on top of the base tables in init_db.
+
+Each migration runs once, in order, and is recorded in schema_migrations.
+Append new entries to MIGRATIONS; never edit one that has shipped.
+"""
+from datetime import datetime
+
+from db import dialect
+
+MIGRATIONS = [
+    (1, 'attendance indexes', [
+        # checkin/checkout guards and the api_checkout UPDATE only ever look
+        # for a user's open shift, which is a tiny slice of the table.
+        """CREATE INDEX IF NOT EXISTS idx_attendance_open_by_user
+           ON attendance (user_id) WHERE status = 'checked_in'""",
+        # User dashboard history (newest first, per user)
+        """CREATE INDEX IF NOT EXISTS idx_attendance_user_time
+           ON attendance (user_id, check_in_time)""",
+        # Admin dashboard recent list and report date ranges
+        """CREATE INDEX IF NOT EXISTS idx_attendance_check_in_time
+           ON attendance (check_in_time)""",
+    ]),
+    (2, 'cache version stamps', [
+        # Bumped by writers so every worker's in-process caches notice
+        """CREATE TABLE IF NOT EXISTS cache_versions (
+               name TEXT PRIMARY KEY,
+               version INTEGER NOT NULL DEFAULT 0
+           )""",
+        "INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('users', 0)",
+    ]),
+    (3, 'daily attendance summary', [
+        # One row per user per IST work day, maintained by the punch handlers
+        # (see rollup.py). Run 'flask --app app backfill-summary' after this
+        # migration to fill it from existing attendance.
+        """CREATE TABLE IF NOT EXISTS daily_attendance_summary (
+               user_id INTEGER NOT NULL,
+               work_date TEXT NOT NULL,
+               shifts INTEGER NOT NULL DEFAULT 0,
+               worked_seconds INTEGER NOT NULL DEFAULT 0,
+               first_in TIMESTAMP,
+               last_out TIMESTAMP,
+               city TEXT,
+               open_shift INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (user_id, work_date),
+               FOREIGN KEY (user_id) REFERENCES users (id)
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_daily_summary_date
+           ON daily_attendance_summary (work_date)""",
+    ]),
+    (4, 'geocode cache', [
+        # Reverse geocoding results per geohash cell (see geocoding.py)
+        """CREATE TABLE IF NOT EXISTS geocode_cache (
+               cell TEXT PRIMARY KEY,
+               city TEXT,
+               full_address TEXT,
+               provider TEXT,
+               created_at REAL NOT NULL
+           )""",
+    ]),
+    (5, 'site geofences', [
+        # Work sites punches are validated against (see geofence.py). kind is
+        # 'radius' (centre + radius_m) or 'polygon' (JSON list of [lat, lon]).
+        """CREATE TABLE IF NOT EXISTS sites (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               name TEXT NOT NULL,
+               kind TEXT NOT NULL DEFAULT 'radius',
+               center_lat REAL NOT NULL,
+               center_lon REAL NOT NULL,
+               radius_m REAL,
+               polygon TEXT,
+               active INTEGER NOT NULL DEFAULT 1,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )""",
+        "INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('sites', 0)",
+        # NULL site/off_site means the punch had no location or no sites existed
+        "ALTER TABLE attendance ADD COLUMN checkin_site_id INTEGER REFERENCES sites (id)",
+        "ALTER TABLE attendance ADD COLUMN checkin_off_site INTEGER",
+        "ALTER TABLE attendance ADD COLUMN checkout_site_id INTEGER REFERENCES sites (id)",
+        "ALTER TABLE attendance ADD COLUMN checkout_off_site INTEGER",
+    ]),
+    (6, 'punch sync receipts', [
+        # One row per punch uploaded through /api/sync, keyed by the client's
+        # idempotency key, so a retried upload gets the original outcome back
+        # instead of recording the punch twice.
+        """CREATE TABLE IF NOT EXISTS punch_receipts (
+               user_id INTEGER NOT NULL,
+               idempotency_key TEXT NOT NULL,
+               kind TEXT NOT NULL,
+               captured_at TIMESTAMP NOT NULL,
+               result TEXT NOT NULL,
+               message TEXT,
+               received_at TIMESTAMP NOT NULL,
+               PRIMARY KEY (user_id, idempotency_key),
+               FOREIGN KEY (user_id) REFERENCES users (id)
+           )""",
+    ]),
+    (7, 'retention ledger', [
+        # Photo keys by capture time and how much of them is left (see
+        # retention.py: 0 = original + renditions, 1 = renditions, 2 = gone)
+        """CREATE TABLE IF NOT EXISTS image_retention (
+               key TEXT PRIMARY KEY,
+               captured_at TIMESTAMP NOT NULL,
+               stage INTEGER NOT NULL DEFAULT 0,
+               orphaned INTEGER NOT NULL DEFAULT 0
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_image_retention_stage
+           ON image_retention (stage, captured_at)""",
+        """CREATE INDEX IF NOT EXISTS idx_image_retention_orphaned
+           ON image_retention (key) WHERE orphaned = 1 AND stage < 2""",
+        # Watermarks and resumable steps of the retention job
+        """CREATE TABLE IF NOT EXISTS retention_state (
+               name TEXT PRIMARY KEY,
+               value TEXT,
+               updated_at REAL NOT NULL
+           )""",
+    ]),
+    (8, 'presence stamp', [
+        # Bumped by the punch handlers so every worker's live board reloads
+        "INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('presence', 0)",
+    ]),
+    (9, 'photo fingerprints', [
+        # Perceptual hashes of punch photos (hex), one row per image key
+        """CREATE TABLE IF NOT EXISTS image_fingerprints (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               key TEXT NOT NULL UNIQUE,
+               user_id INTEGER NOT NULL,
+               phash TEXT NOT NULL,
+               dhash TEXT NOT NULL,
+               captured_at TIMESTAMP NOT NULL
+           )""",
+        # Topping up a worker's in-memory BK-tree reads only their newer rows
+        """CREATE INDEX IF NOT EXISTS idx_image_fingerprints_user
+           ON image_fingerprints (user_id, id)""",
+        # Punch photos that repeat an earlier one; a photo is its key plus
+        # who punched it when (matched_key = key: identical bytes)
+        """CREATE TABLE IF NOT EXISTS photo_matches (
+               key TEXT NOT NULL,
+               user_id INTEGER NOT NULL,
+               captured_at TIMESTAMP NOT NULL,
+               matched_key TEXT NOT NULL,
+               matched_user_id INTEGER NOT NULL,
+               matched_captured_at TIMESTAMP NOT NULL,
+               phash_distance INTEGER NOT NULL,
+               dhash_distance INTEGER NOT NULL,
+               PRIMARY KEY (key, user_id, captured_at)
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_photo_matches_captured
+           ON photo_matches (captured_at)""",
+        "INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('fingerprints', 0)",
+    ]),
+    (10, 'check-in time covering index', [
+        # Replaces idx_attendance_check_in_time. The payroll report reads
+        # every shift of up to a year by check-in time; with all its columns
+        # in the index that is one ordered index read instead of a table
+        # lookup per shift (see payroll.py). id right after check_in_time
+        # keeps "ORDER BY check_in_time, id" (admin paging, exports) an
+        # index walk, and one index on check_in_time is one write per punch.
+        """CREATE INDEX IF NOT EXISTS idx_attendance_check_in_covering
+           ON attendance (check_in_time, id, user_id, checkin_site_id, check_out_time)""",
+        'DROP INDEX IF EXISTS idx_attendance_check_in_time',
+    ]),
+    (11, 'finished image job index', [
+        # Only done and failed jobs have finished_at; retention deletes them
+        # oldest first once they are IMAGE_JOBS_KEEP_DAYS old
+        """CREATE INDEX IF NOT EXISTS idx_image_jobs_finished
+           ON image_jobs (finished_at) WHERE finished_at IS NOT NULL""",
+    ]),
+    (12, 'punch receipt age index', [
+        # Retention deletes sync receipts oldest first by received_at
+        """CREATE INDEX IF NOT EXISTS idx_punch_receipts_received
+           ON punch_receipts (received_at)""",
+    ]),
+]
+
+
+def pending_versions(conn):
+    """Versions not applied yet, read without taking the write lock."""
+    if dialect(conn) == 'postgres':
+        sql = 'SELECT to_regclass(?) IS NOT NULL'
+    else:
+        sql = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?"
+    applied = set()
+    if conn.execute(sql, ('schema_migrations',)).fetchone()[0]:
+        applied = {row['version'] for row in conn.execute('SELECT version FROM schema_migrations')}
+    return [version for version, _, _ in MIGRATIONS if version not in applied]
+
+
+def apply_migrations(conn):
+    """Run every migration newer than the recorded version; returns the names applied."""
+    if not pending_versions(conn):
+        return []  # Up to date; skip taking the write lock once per migration
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL
+        )
+    ''')
+    conn.commit()
+    applied = []
+    for version, name, statements in MIGRATIONS:
+        # Hold the write lock for the whole migration so it applies atomically
+        # and concurrent workers starting up don't both run it.
+        conn.execute('BEGIN IMMEDIATE')
+        if conn.execute('SELECT 1 FROM schema_migrations WHERE version = ?', (version,)).fetchone():
+            conn.rollback()
+            continue
+        for statement in statements:
+            conn.execute(statement)
+        conn.execute(
+            'INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)',
+            (version, name, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        # Refresh planner statistics so new indexes get picked up
+        conn.execute('ANALYZE')
+        conn.commit()
+        applied.append(name)
+    return applied
@@ -0,0 +1,329 @@
+"""Payroll hours from attendance: regular, overtime and night hours.
+
+Punch times are stored as IST wall-clock strings, so they are used as-is:
+a day or a week is an IST day or week (weeks start on Monday). The engine
+loads the shifts of a period into NumPy arrays and works on whole columns
+at once instead of row by row:
+
+- A shift is credited from check-in to check-out, or to now while it is
+  still open. A shift longer than `stale_after_hours` (left open, or closed
+  days later by the checkout that closes every open shift) is treated as a
+  forgotten checkout and credited by the stale policy instead: 'standard'
+  credits `standard_shift_hours`, 'cap' credits `stale_after_hours` and
+  'unpaid' credits nothing. The rows themselves are not changed.
+- Shifts are split at IST week boundaries, so a Sunday night shift counts
+  its hours after midnight towards the next week.
+- Hours beyond `weekly_hours` in a week are overtime, taken in time order:
+  the shifts that push a worker past the limit carry the overtime, which
+  is how it is attributed to sites.
+- Night hours are the part of a shift inside the nightly window
+  (22:00-06:00 by default), reported alongside the split above.
+
+Only the live attendance table is read; months moved out by retention.py
+(RETAIN_HOT_ROWS_DAYS, off by default) are not included.
+"""
+import sqlite3
+from datetime import datetime, timedelta
+
+from db import dialect
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+STALE_POLICIES = ('standard', 'cap', 'unpaid')
+MAX_WEEKS = 60  # per report; a year of history plus some slack
+DAY = 86400
+WEEK = 7 * DAY
+# Day 0 of the epoch (1970-01-01) was a Thursday; weeks start on Monday
+WEEK_OFFSET = 3 * DAY
+
+
+def week_bounds(start_date, end_date):
+    """Monday of `start_date`'s week and the Monday after `end_date`'s week."""
+    try:
+        start = datetime.strptime(start_date, '%Y-%m-%d')
+        end = datetime.strptime(end_date, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError('Dates must be YYYY-MM-DD') from None
+    if end < start:
+        raise ValueError('End date is before start date')
+    start -= timedelta(days=start.weekday())
+    end += timedelta(days=7 - end.weekday())
+    return start, end
+
+
+def _night_before(t, night_start, night_end):
+    """Night seconds between the epoch and each `t` (a vector), for a nightly
+    window from hour `night_start` to hour `night_end` (may wrap midnight)."""
+    import numpy as np
+    start, end = night_start * 3600, night_end * 3600
+    days, rest = np.divmod(t, DAY)
+    if start > end:  # e.g. 22:00-06:00: [0, end) and [start, DAY) of each day
+        per_day = end + DAY - start
+        within = np.minimum(rest, end) + np.maximum(rest - start, 0)
+    else:
+        per_day = end - start
+        within = np.clip(rest, start, end) - start
+    return days * per_day + within
+
+
+def _group_sums(groups, count, *columns):
+    import numpy as np
+    return [np.bincount(groups, weights=column, minlength=count).astype('int64') for column in columns]
+
+
+class PayrollEngine:
+    def __init__(self, weekly_hours=48, stale_after_hours=16, stale_policy='standard',
+                 standard_shift_hours=8, night_start=22, night_end=6):
+        if stale_policy not in STALE_POLICIES:
+            raise ValueError(f"Stale shift policy must be one of {', '.join(STALE_POLICIES)}")
+        self.weekly_hours = weekly_hours
+        self.stale_after_hours = stale_after_hours
+        self.stale_policy = stale_policy
+        self.standard_shift_hours = standard_shift_hours
+        self.night_start = night_start
+        self.night_end = night_end
+
+    def policy(self):
+        return {
+            'weekly_hours': self.weekly_hours,
+            'stale_after_hours': self.stale_after_hours,
+            'stale_policy': self.stale_policy,
+            'standard_shift_hours': self.standard_shift_hours,
+            'night_hours': f'{self.night_start:02d}:00-{self.night_end:02d}:00',
+        }
+
+    def stale_credit(self):
+        """Seconds credited for a shift treated as a forgotten checkout."""
+        return {'standard': self.standard_shift_hours, 'cap': self.stale_after_hours,
+                'unpaid': 0}[self.stale_policy] * 3600
+
+    def load(self, conn, period_start, period_end):
+        """Shifts that can overlap [period_start, period_end), as int64 columns.
+
+        Times are epoch seconds (the IST wall clock read as UTC, -1 for an
+        open shift) and a shift at no site has site_id -1. The database
+        converts the times and returns each column as one comma-separated
+        aggregate, which NumPy parses in a single pass: no row object or
+        time string is built per shift. All five aggregates see the rows in
+        the same order. Shifts checked in up to stale_after_hours before the
+        period are included for the hours they run into it. The query is
+        answered from idx_attendance_check_in_covering alone.
+        """
+        import numpy as np
+        if dialect(conn) == 'postgres':
+            epoch, aggregate = 'EXTRACT(EPOCH FROM {})::bigint', "string_agg(({})::text, ',')"
+        else:
+            # unixepoch() is SQLite 3.38+ and parses faster than strftime
+            epoch = 'unixepoch({})' if sqlite3.sqlite_version_info >= (3, 38) else "strftime('%s', {})"
+            aggregate = "group_concat({}, ',')"
+        columns = ('id', 'user_id', 'COALESCE(checkin_site_id, -1)', epoch.format('check_in_time'),
+                   f"COALESCE({epoch.format('check_out_time')}, -1)")
+        lookback = period_start - timedelta(hours=max(self.stale_after_hours, self.standard_shift_hours))
+        values = conn.execute(f'''
+            SELECT {', '.join(aggregate.format(column) for column in columns)}
+            FROM attendance
+            WHERE check_in_time >= ? AND check_in_time < ?
+        ''', (lookback.strftime(TIME_FORMAT), period_end.strftime(TIME_FORMAT))).fetchone()
+        return {
+            name: np.fromstring(value, dtype='int64', sep=',') if value else np.empty(0, dtype='int64')
+            for name, value in zip(('id', 'user_id', 'site_id', 'check_in', 'check_out'), values)
+        }
+
+    def compute(self, shifts, period_start, period_end, now):
+        """Hours per user-week and per site from `shifts` (see load()).
+
+        Returns tables of NumPy columns: 'weeks' (one row per user and week
+        with any shift), 'users' (their totals), 'sites' (one row per site,
+        -1 for punches at no site) and 'stale' (the shifts credited by the
+        stale policy).
+        """
+        import numpy as np
+        shift_ids, user_ids, site_ids, check_in, check_out = (
+            shifts[name] for name in ('id', 'user_id', 'site_id', 'check_in', 'check_out'))
+        first = int(np.datetime64(period_start, 's').astype('int64'))
+        last = int(np.datetime64(period_end, 's').astype('int64'))
+        now = int(np.datetime64(now, 's').astype('int64'))
+
+        # Credited interval per shift
+        is_open = check_out < 0
+        ended = np.where(is_open, now, check_out)
+        stale = ended - check_in > self.stale_after_hours * 3600
+        credited_end = np.where(stale, check_in + self.stale_credit(), ended)
+        credited_end = np.maximum(credited_end, check_in)  # check-out before check-in: nothing
+
+        # Clip to the period; keep shifts with hours in it or checked in during it
+        in_period = (check_in >= first) & (check_in < last)
+        start = np.maximum(check_in, first)
+        end = np.minimum(credited_end, last)
+        keep = (end > start) | in_period
+        shift_ids, user_ids, site_ids, check_in, check_out = (
+            column[keep] for column in (shift_ids, user_ids, site_ids, check_in, check_out))
+        start, end, stale, is_open, in_period, credited_end = (
+            column[keep] for column in (start, end, stale, is_open, in_period, credited_end))
+        end = np.maximum(end, start)
+
+        # Split at week boundaries: one piece per shift and week it touches
+        first_week = (start + WEEK_OFFSET) // WEEK
+        last_week = (np.maximum(end - 1, start) + WEEK_OFFSET) // WEEK
+        pieces = last_week - first_week + 1
+        shift = np.repeat(np.arange(len(start)), pieces)
+        nth = np.arange(len(shift)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        week = first_week[shift] + nth
+        piece_start = np.maximum(start[shift], week * WEEK - WEEK_OFFSET)
+        piece_end = np.minimum(end[shift], (week + 1) * WEEK - WEEK_OFFSET)
+        seconds = np.maximum(piece_end - piece_start, 0)
+        night = (_night_before(piece_end, self.night_start, self.night_end)
+                 - _night_before(piece_start, self.night_start, self.night_end))
+        night = np.where(seconds > 0, night, 0)
+        # Shift counts go to the week the shift was checked in
+        counted = (nth == 0) & in_period[shift]
+
+        # Group pieces by user and week, in time order within each group
+        order = np.lexsort((piece_start, week, user_ids[shift]))
+        shift, week, piece_start = shift[order], week[order], piece_start[order]
+        seconds, night, counted = seconds[order], night[order], counted[order]
+        piece_user = user_ids[shift]
+        new_group = np.empty(len(order), dtype=bool)
+        new_group[:1] = True
+        new_group[1:] = (piece_user[1:] != piece_user[:-1]) | (week[1:] != week[:-1])
+        group = np.cumsum(new_group) - 1
+        groups = int(group[-1]) + 1 if len(group) else 0
+
+        # Overtime: whatever runs past the weekly limit, in time order
+        limit = self.weekly_hours * 3600
+        running = np.cumsum(seconds)
+        group_base = (running - seconds)[new_group]
+        worked_after = running - group_base[group]
+        worked_before = worked_after - seconds
+        overtime = np.maximum(worked_after - limit, 0) - np.maximum(worked_before - limit, 0)
+
+        hours, overtime_sum, night_sum = _group_sums(group, groups, seconds, overtime, night)
+        shift_count, stale_count, open_count = _group_sums(
+            group, groups, counted, counted & stale[shift], counted & is_open[shift] & ~stale[shift])
+        weeks = {
+            'user_id': piece_user[new_group],
+            'week': week[new_group],
+            'seconds': hours,
+            'overtime': overtime_sum,
+            'night': night_sum,
+            'shifts': shift_count,
+            'stale_shifts': stale_count,
+            'open_shifts': open_count,
+        }
+        user_keys, user_group = np.unique(weeks['user_id'], return_inverse=True)
+        users = dict(zip(
+            ('seconds', 'overtime', 'night', 'shifts', 'stale_shifts', 'open_shifts'),
+            _group_sums(user_group, len(user_keys), hours, overtime_sum, night_sum,
+                        shift_count, stale_count, open_count)))
+        users.update(user_id=user_keys, weeks=np.bincount(user_group, minlength=len(user_keys)))
+
+        piece_site = site_ids[shift]
+        site_keys, site_group = np.unique(piece_site, return_inverse=True)
+        site_seconds, site_overtime, site_night = _group_sums(
+            site_group, len(site_keys), seconds, overtime, night)
+        # Distinct (site, user) pairs, packed into one integer each
+        span = int(piece_user.max(initial=0)) + 1
+        pairs = np.unique(site_group * span + piece_user)
+        site_workers = np.bincount(pairs // span, minlength=len(site_keys))
+        sites = {
+            'site_id': site_keys,
+            'workers': site_workers,
+            'seconds': site_seconds,
+            'overtime': site_overtime,
+            'night': site_night,
+        }
+
+        flagged = stale & in_period
+        stale_shifts = {
+            'id': shift_ids[flagged],
+            'user_id': user_ids[flagged],
+            'check_in': check_in[flagged],
+            'check_out': check_out[flagged],
+            'credited': credited_end[flagged] - check_in[flagged],
+        }
+        return {'weeks': weeks, 'users': users, 'sites': sites, 'stale': stale_shifts}
+
+    def report(self, conn, start_date, end_date, now):
+        """Payroll for the whole IST weeks covering start_date..end_date (YYYY-MM-DD).
+
+        `now` is the current IST wall-clock time (naive), used for open shifts.
+        Raises ValueError for bad dates or a period over MAX_WEEKS.
+        """
+        period_start, period_end = week_bounds(start_date, end_date)
+        if (period_end - period_start).days > MAX_WEEKS * 7:
+            raise ValueError(f'At most {MAX_WEEKS} weeks per report')
+        import numpy as np
+        result = self.compute(self.load(conn, period_start, period_end), period_start, period_end, now)
+
+        usernames = {row['id']: row['username'] for row in conn.execute('SELECT id, username FROM users')}
+        site_names = {row['id']: row['name'] for row in conn.execute('SELECT id, name FROM sites')}
+
+        def hours(seconds):
+            return np.round(seconds / 3600, 2).tolist()
+
+        def times(seconds):
+            stamps = (seconds.astype('datetime64[s]')).astype(str)
+            return [None if value < 0 else stamp.replace('T', ' ') for value, stamp in zip(seconds, stamps)]
+
+        def hour_columns(table):
+            return {
+                'hours': hours(table['seconds']),
+                'regular_hours': hours(table['seconds'] - table['overtime']),
+                'overtime_hours': hours(table['overtime']),
+                'night_hours': hours(table['night']),
+            }
+
+        def rows(columns):
+            names = list(columns)
+            return [dict(zip(names, values)) for values in zip(*columns.values())]
+
+        weeks = result['weeks']
+        week_user_ids = weeks['user_id'].tolist()
+        week_rows = rows(dict(
+            user_id=week_user_ids,
+            username=[usernames.get(user_id) for user_id in week_user_ids],
+            week_start=(weeks['week'] * 7 - 3).astype('datetime64[D]').astype(str).tolist(),
+            **hour_columns(weeks),
+            shifts=weeks['shifts'].tolist(),
+            stale_shifts=weeks['stale_shifts'].tolist(),
+            open_shifts=weeks['open_shifts'].tolist(),
+        ))
+
+        users = result['users']
+        user_ids = users['user_id'].tolist()
+        user_rows = sorted(rows(dict(
+            user_id=user_ids,
+            username=[usernames.get(user_id) for user_id in user_ids],
+            weeks=users['weeks'].tolist(),
+            **hour_columns(users),
+            shifts=users['shifts'].tolist(),
+            stale_shifts=users['stale_shifts'].tolist(),
+            open_shifts=users['open_shifts'].tolist(),
+        )), key=lambda row: row['username'] or '')
+
+        sites = result['sites']
+        site_ids = [None if site_id < 0 else site_id for site_id in sites['site_id'].tolist()]
+        site_rows = rows(dict(
+            site_id=site_ids,
+            site_name=[site_names.get(site_id, 'No site') for site_id in site_ids],
+            workers=sites['workers'].tolist(),
+            **hour_columns(sites),
+        ))
+
+        stale = result['stale']
+        stale_rows = sorted(rows(dict(
+            id=stale['id'].tolist(),
+            username=[usernames.get(user_id) for user_id in stale['user_id'].tolist()],
+            check_in_time=times(stale['check_in']),
+            check_out_time=times(stale['check_out']),
+            credited_hours=hours(stale['credited']),
+        )), key=lambda row: row['check_in_time'])
+
+        return {
+            'start': period_start.strftime('%Y-%m-%d'),
+            'end': (period_end - timedelta(days=1)).strftime('%Y-%m-%d'),
+            'policy': self.policy(),
+            'users': user_rows,
+            'weeks': week_rows,
+            'sites': site_rows,
+            'stale_shifts': stale_rows,
+        }
@@ -0,0 +1,261 @@
+"""Perceptual photo fingerprints for spotting replayed punch photos.
+
+The image worker gives every punch photo two 64-bit hashes: a pHash (signs
+of the low 8x8 frequencies of a 32x32 DCT) and a dHash (brightness steps
+across a 9x8 thumbnail). A photo re-saved from the gallery, re-encoded or
+scaled keeps both within a few bits of the original, while two separate
+captures of the same spot rarely do. A new photo is a near-duplicate of an
+earlier one by the same worker when both distances are within the
+configured limits; identical bytes share a content-hash key and are caught
+without hashing at all.
+
+Each worker's fingerprints are searched through a BK-tree, a metric tree
+over Hamming distance: a lookup only descends into branches whose edge
+distance lies within the search radius of the query, so it touches a small
+fraction of a long history instead of comparing against every photo. Trees
+are built per process on first use and topped up from the rows added since
+(fingerprints are append-only); deleting all records bumps the
+'fingerprints' stamp in cache_versions and every worker drops its trees.
+
+NumPy and Pillow are imported by the hashing functions, on first use.
+"""
+import io
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+JOB_KIND = 'fingerprint'
+HASH_SIZE = 8
+DCT_SIZE = 32
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(n):
+    import numpy as np
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+def _pack(bits):
+    import numpy as np
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def fingerprint(img):
+    """(phash, dhash) of a PIL image, each a 64-bit int."""
+    import numpy as np
+    from PIL import Image
+    # JPEGs are decoded straight at 1/2..1/8 scale; the hashes only need 32px
+    img.draft('L', (DCT_SIZE * 2, DCT_SIZE * 2))
+    gray = img.convert('L')
+    pixels = np.asarray(gray.resize((DCT_SIZE, DCT_SIZE), Image.Resampling.BOX), dtype=np.float64)
+    dct = _dct_matrix(DCT_SIZE)
+    low = (dct @ pixels @ dct.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    phash = _pack(low > np.median(low[1:]))  # DC term left out of the median
+    steps = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX), dtype=np.int16)
+    dhash = _pack(steps[:, 1:] > steps[:, :-1])
+    return phash, dhash
+
+
+def fingerprint_bytes(data):
+    """fingerprint() of an encoded image, or None if it can't be decoded.
+
+    Module-level so the backfill can run it in a process pool.
+    """
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return fingerprint(img)
+    except (OSError, ValueError):
+        return None
+
+
+def job_target(user_id, captured_at):
+    return f'{user_id}|{captured_at}'
+
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes under Hamming distance."""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        node = (value, item, {})
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value, radius):
+        """[(distance, item)] for every entry within `radius`, nearest first."""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_value, item, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= radius:
+                found.append((distance, item))
+            # Triangle inequality: anything under edge d is d away from this node
+            for edge, child in children.items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        found.sort(key=lambda match: match[0])
+        return found
+
+
+class PhotoFingerprints:
+    VERSION_NAME = 'fingerprints'
+
+    def __init__(self, store, sources, phash_distance=6, dhash_distance=10, max_users=512):
+        """`sources(key)` lists keys to hash a photo from, best first (the
+        original, then renditions that outlive it under retention)."""
+        self.store = store
+        self.sources = sources
+        self.phash_distance = phash_distance
+        self.dhash_distance = dhash_distance
+        self.max_users = max_users
+        self._trees = OrderedDict()  # user_id -> [BKTree, last fingerprint id]
+        self._version = None
+        self._lock = threading.Lock()
+        self.counters = {'hashed': 0, 'unreadable': 0, 'matches': 0, 'tree_loads': 0, 'lookups': 0}
+
+    # -- image worker ---------------------------------------------------
+
+    def run_job(self, source, target):
+        """Image-worker handler: fingerprint `source` for the punch in `target`."""
+        from db import get_db
+        conn = get_db()
+        user_id, captured_at = target.split('|', 1)
+        hashes = None
+        if not self.known(conn, source):
+            hashes = self.hash_key(source)
+            if hashes is None:
+                return  # Photo and renditions gone; nothing to compare
+        self.record(conn, source, int(user_id), captured_at, hashes)
+
+    def read(self, key):
+        """Bytes of the first readable source for `key`, or None."""
+        for source in self.sources(key):
+            if self.store.exists(source):
+                with self.store.open(source) as f:
+                    return f.read()
+        return None
+
+    def hash_key(self, key):
+        data = self.read(key)
+        hashes = fingerprint_bytes(data) if data is not None else None
+        self.counters['hashed' if hashes else 'unreadable'] += 1
+        return hashes
+
+    def known(self, conn, key):
+        return conn.execute('SELECT 1 FROM image_fingerprints WHERE key = ?', (key,)).fetchone() is not None
+
+    # -- matching -------------------------------------------------------
+
+    def record(self, conn, key, user_id, captured_at, hashes):
+        """Store a punch photo's fingerprint and flag the earlier photo it
+        repeats, on the caller's transaction; returns the match or None.
+
+        A photo is identified by its key plus who punched it when, since
+        identical bytes punched twice share one key. `hashes` may be None
+        when the key is already fingerprinted.
+        """
+        existing = conn.execute(
+            'SELECT user_id, captured_at FROM image_fingerprints WHERE key = ?', (key,)
+        ).fetchone()
+        if existing:
+            if existing['user_id'] == user_id and str(existing['captured_at']) == captured_at:
+                return None  # The punch this key was first fingerprinted for
+            # Byte-identical to a photo already punched, by anyone
+            match = (key, existing['user_id'], str(existing['captured_at']), 0, 0)
+        else:
+            phash, dhash = hashes
+            match = None
+            for distance, (other_key, other_dhash, other_time) in self._tree(conn, user_id).search(
+                    phash, self.phash_distance):
+                steps = hamming(dhash, other_dhash)
+                if steps <= self.dhash_distance:
+                    match = (other_key, user_id, other_time, distance, steps)
+                    break  # Nearest first
+            conn.execute('''
+                INSERT INTO image_fingerprints (key, user_id, phash, dhash, captured_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (key, user_id, f'{phash:016x}', f'{dhash:016x}', captured_at))
+        if match is None:
+            return None
+        conn.execute('''
+            INSERT INTO photo_matches (key, user_id, captured_at, matched_key, matched_user_id,
+                                       matched_captured_at, phash_distance, dhash_distance)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (key, user_id, captured_at) DO NOTHING
+        ''', (key, user_id, captured_at) + match)
+        self.counters['matches'] += 1
+        return match
+
+    def matches_for(self, conn, photos):
+        """{(key, user_id, captured_at): match row} for the given punch photos that repeat an earlier one."""
+        photos = set(photos)
+        keys = list({key for key, _, _ in photos})
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            for row in conn.execute(f'''
+                SELECT * FROM photo_matches WHERE key IN ({','.join('?' * len(chunk))})
+            ''', chunk):
+                photo = (row['key'], row['user_id'], str(row['captured_at']))
+                if photo in photos:
+                    found[photo] = dict(row)
+        return found
+
+    def reset(self, conn):
+        """Forget every fingerprint (all attendance was deleted)."""
+        conn.execute('DELETE FROM photo_matches')
+        conn.execute('DELETE FROM image_fingerprints')
+        conn.execute('UPDATE cache_versions SET version = version + 1 WHERE name = ?', (self.VERSION_NAME,))
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, users=len(self._trees),
+                        indexed=sum(entry[0].size for entry in self._trees.values()))
+
+    def _tree(self, conn, user_id):
+        """The worker's BK-tree, topped up with fingerprints added since it was built."""
+        row = conn.execute('SELECT version FROM cache_versions WHERE name = ?', (self.VERSION_NAME,)).fetchone()
+        version = row['version'] if row else 0
+        with self._lock:
+            if version != self._version:
+                self._trees.clear()
+                self._version = version
+            entry = self._trees.get(user_id)
+            if entry is None:
+                entry = self._trees[user_id] = [BKTree(), 0]
+                self.counters['tree_loads'] += 1
+            self._trees.move_to_end(user_id)
+            while len(self._trees) > self.max_users:
+                self._trees.popitem(last=False)
+            tree, last_id = entry
+            for fp in conn.execute('''
+                SELECT id, key, phash, dhash, captured_at FROM image_fingerprints
+                WHERE user_id = ? AND id > ? ORDER BY id
+            ''', (user_id, last_id)):
+                tree.add(int(fp['phash'], 16), (fp['key'], int(fp['dhash'], 16), str(fp['captured_at'])))
+                entry[1] = fp['id']
+            self.counters['lookups'] += 1
+            return tree
@@ -0,0 +1,198 @@
+"""Live "who is checked in now" board for the admin dashboard.
+
+Each worker process keeps the open shifts in memory and pushes changes to
+admin browsers over server-sent events. Punch handlers bump the 'presence'
+stamp in cache_versions inside their transaction; one broker thread per
+process re-reads that stamp every `poll_interval` seconds while anyone is
+subscribed, reloads the open shifts only when it moved, and fans the
+difference out to every subscriber's queue. A punch handled by this process
+wakes the broker straight away. Database load is the same for one open tab
+as for hundreds, and nothing at all when no one is watching.
+
+Streams hold their connection open, and under gthread each one holds a
+worker thread for as long as the tab is open. At most `max_subscribers`
+streams are served per process (PRESENCE_MAX_SUBSCRIBERS); past that the
+stream answers 503 and the dashboard polls the snapshot instead, so open
+dashboards can't take every thread away from punches. Under the gevent
+worker a stream is a greenlet blocked on its queue, and the default cap is
+half the worker's connections (500), so one worker serves hundreds of tabs.
+"""
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+from db import get_db
+
+
+class PresenceBoard:
+    VERSION_NAME = 'presence'
+
+    def __init__(self, app=None, poll_interval=1.0, heartbeat=15.0, max_queue=256, max_subscribers=8):
+        self.poll_interval = poll_interval
+        self.heartbeat = heartbeat
+        self.max_queue = max_queue
+        self.max_subscribers = max_subscribers
+        self._present = {}  # user_id -> entry shown on the board
+        self._version = None  # stamp the board was last loaded at
+        self._seq = 0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.counters = {'reloads': 0, 'events': 0, 'dropped_subscribers': 0, 'refused_subscribers': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_subscribers = app.config.get('PRESENCE_MAX_SUBSCRIBERS', self.max_subscribers)
+        app.extensions['presence'] = self
+
+    # -- writers --------------------------------------------------------
+
+    def changed(self, conn):
+        """Mark the board stale; call inside the punch's transaction."""
+        conn.execute('UPDATE cache_versions SET version = version + 1 WHERE name = ?', (self.VERSION_NAME,))
+
+    def notify(self):
+        """Wake this process's broker after a punch commits."""
+        if self._subscribers:
+            self._wakeup.set()
+
+    # -- readers --------------------------------------------------------
+
+    def snapshot(self):
+        """(seq, entries), brought up to date first (one stamp read if nothing moved)."""
+        self.refresh()
+        with self._lock:
+            return self._seq, sorted(self._present.values(), key=lambda e: e['since'])
+
+    def subscribe(self):
+        """A queue for a new stream, or None if this process already serves
+        `max_subscribers` of them. Pass it to stream(), and to unsubscribe()
+        when the response closes."""
+        subscriber = queue.Queue(self.max_queue)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                self.counters['refused_subscribers'] += 1
+                return None
+            self._subscribers.add(subscriber)
+        self._ensure_started()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stream(self, subscriber, snapshot):
+        """Server-sent events: `snapshot` (taken with snapshot() after
+        subscribing), then changes as they happen.
+
+        Runs after the request's app context is gone, so it holds no
+        database connection while it waits.
+        """
+        try:
+            seq, entries = snapshot
+            yield _event('snapshot', {'workers': entries}, seq)
+            while True:
+                try:
+                    event = subscriber.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ': keepalive\n\n'  # Keeps proxies from closing an idle stream
+                    continue
+                if event is None:
+                    return  # Fell too far behind; EventSource reconnects for a fresh snapshot
+                if event[2] > seq:
+                    yield _event(*event)
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, subscribers=len(self._subscribers), max_subscribers=self.max_subscribers,
+                        present=len(self._present), seq=self._seq)
+
+    # -- broker ---------------------------------------------------------
+
+    def refresh(self):
+        """Reload the open shifts if the stamp moved and publish the difference."""
+        conn = get_db()
+        row = conn.execute('SELECT version FROM cache_versions WHERE name = ?', (self.VERSION_NAME,)).fetchone()
+        version = row['version'] if row else 0
+        if version == self._version:
+            return
+        present = {}
+        for shift in conn.execute('''
+            SELECT a.user_id, u.username, a.check_in_time, a.city, a.checkin_off_site
+            FROM attendance a
+            JOIN users u ON a.user_id = u.id
+            WHERE a.status = 'checked_in'
+        '''):
+            entry = present.get(shift['user_id'])
+            if entry is None or shift['check_in_time'] > entry['latest']:
+                # The newest open shift says where they are, the oldest since when
+                present[shift['user_id']] = {
+                    'user_id': shift['user_id'], 'username': shift['username'],
+                    'since': entry['since'] if entry else shift['check_in_time'],
+                    'latest': shift['check_in_time'], 'city': shift['city'],
+                    'off_site': bool(shift['checkin_off_site']),
+                }
+            else:
+                entry['since'] = min(entry['since'], shift['check_in_time'])
+        with self._lock:
+            events = []
+            for user_id, entry in present.items():
+                if self._present.get(user_id) != entry:
+                    events.append(('present', entry))
+            for user_id in self._present.keys() - present.keys():
+                events.append(('left', {'user_id': user_id}))
+            self._present = present
+            self._version = version
+            self.counters['reloads'] += 1
+            for kind, data in events:
+                self._seq += 1
+                self._publish((kind, data, self._seq))
+
+    def _publish(self, event):
+        self.counters['events'] += 1
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # A stalled tab must not hold events for everyone else
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait(None)
+                self._subscribers.discard(subscriber)
+                self.counters['dropped_subscribers'] += 1
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='presence-broker', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            if not self._subscribers:
+                continue  # Nobody watching; the next snapshot catches up
+            try:
+                with self.app.app_context():
+                    self.refresh()
+            except Exception:
+                traceback.print_exc()
+                time.sleep(self.poll_interval)
+
+
+def _event(kind, data, seq):
+    return f'id: {seq}\nevent: {kind}\ndata: {json.dumps(data)}\n\n'
@@ -0,0 +1,406 @@
+"""Retention: how long photos and attendance rows stay hot.
+
+Three independent windows, in days (0 keeps forever):
+
+* originals  - full-size photos; after this only the renditions are kept
+* renditions - thumb/medium renditions; after this the photo is gone
+* hot rows   - attendance rows older than this move out of the live table
+               into one gzipped SQLite file per month under ARCHIVE_FOLDER,
+               so the hot table (and every query on it) stays the same size
+               however many years of history pile up. Off by default: the
+               reports, payroll and the admin attendance API only read the
+               live table, so archived months drop out of them
+
+Photo keys are tracked in image_retention as each punch stores them
+(track()), and swept up from attendance in id order once a row is
+ENROLL_AFTER_DAYS old, which covers rows written before tracking was on; a
+shared key keeps its newest capture time. Work is done by the
+'retention' image-worker job in bounded passes: each pass handles one batch
+of photos or one month of rows and queues the next pass straight away, or
+tomorrow's once there is nothing left to do.
+
+The bookkeeping tables are trimmed in the same batches: image_retention
+rows of purged photos once they are past the renditions window, sync
+receipts once they are `receipts_days` old (RETAIN_RECEIPTS_DAYS, 30 by
+default; a retried sync batch older than that is long past the 7-day
+backdating limit anyway), and done or failed image jobs once they are
+`jobs_days` old (IMAGE_JOBS_KEEP_DAYS, 30 by default).
+
+Rows are archived in three resumable steps: copy the month into a staging
+SQLite file, delete those ids from attendance in small transactions, then
+compress the staging file into place.
+"""
+import gzip
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+IMAGE_COLUMNS = ('front_image_path', 'rear_image_path', 'checkout_front_image_path', 'checkout_rear_image_path')
+JOB_KIND = 'retention'
+ENROLL_AFTER_DAYS = 2
+
+# image_retention.stage
+STAGE_FULL = 0
+STAGE_RENDITIONS = 1
+STAGE_PURGED = 2
+
+
+class RetentionEngine:
+    def __init__(self, store, worker, rendition_keys, ensure_renditions, archive_folder='archive',
+                 originals_days=90, renditions_days=730, hot_rows_days=0, jobs_days=30,
+                 receipts_days=30, batch_size=500, interval=86400.0):
+        self.store = store
+        self.worker = worker
+        self.rendition_keys = rendition_keys
+        self.ensure_renditions = ensure_renditions
+        self.archive_folder = archive_folder
+        self.originals_days = originals_days
+        self.renditions_days = renditions_days
+        self.hot_rows_days = hot_rows_days
+        self.jobs_days = jobs_days
+        self.receipts_days = receipts_days
+        self.batch_size = batch_size
+        self.interval = interval
+
+    def policy(self):
+        return {'originals_days': self.originals_days, 'renditions_days': self.renditions_days,
+                'hot_rows_days': self.hot_rows_days, 'jobs_days': self.jobs_days,
+                'receipts_days': self.receipts_days, 'batch_size': self.batch_size}
+
+    def _cutoff(self, days, now):
+        return (now - timedelta(days=days)).strftime(TIME_FORMAT) if days else None
+
+    # -- scheduling -----------------------------------------------------
+
+    def ensure_scheduled(self, conn):
+        """Queue a pass unless one is already pending (called from init_db)."""
+        pending = conn.execute(
+            "SELECT 1 FROM image_jobs WHERE kind = ? AND status IN ('pending', 'running')", (JOB_KIND,)
+        ).fetchone()
+        if not pending:
+            self.worker.enqueue(conn, JOB_KIND, 'policy')
+            conn.commit()
+
+    def schedule(self, conn, delay=0):
+        """Make sure a pass runs within `delay` seconds, keeping at most one
+        pending; the caller commits."""
+        run_after = time.time() + delay
+        row = conn.execute(
+            "SELECT id, run_after FROM image_jobs WHERE kind = ? AND status = 'pending' ORDER BY run_after LIMIT 1",
+            (JOB_KIND,)
+        ).fetchone()
+        if row is None:
+            self.worker.enqueue(conn, JOB_KIND, 'policy', delay=delay)
+        elif row['run_after'] > run_after:
+            conn.execute('UPDATE image_jobs SET run_after = ? WHERE id = ?', (run_after, row['id']))
+
+    def run_job(self, source, target):
+        """Image-worker handler: one bounded pass, then schedule the next."""
+        from db import get_db
+        conn = get_db()
+        more = self.run_pass(conn)
+        self.schedule(conn, 0 if more else self.interval)
+        conn.commit()
+
+    def run_pass(self, conn, now=None):
+        """Do one bounded unit of work; returns True if more is waiting."""
+        now = now or datetime.now()
+        for step in (self._resume_archive, self._purge_orphans, self._enroll, self._purge_images,
+                     self._forget_purged, self._purge_receipts, self._purge_jobs, self._archive_month):
+            if step(conn, now):
+                return True
+        return False
+
+    # -- photos ---------------------------------------------------------
+
+    def track(self, conn, keys):
+        """Enroll (key, captured_at) pairs as a punch stores them; the caller
+        commits. Catches photos added to a row the sweep has already passed,
+        like a checkout days after the check-in."""
+        if self.originals_days or self.renditions_days or self.hot_rows_days:
+            enroll_keys(conn, keys)
+
+    def _enroll(self, conn, now):
+        """Record the photo keys of rows whose shift is over, in id order."""
+        if not (self.originals_days or self.renditions_days or self.hot_rows_days):
+            return False
+        upto = self._cutoff(ENROLL_AFTER_DAYS, now)
+        mark = int(get_state(conn, 'enrolled_upto') or 0)
+        rows = conn.execute(f'''
+            SELECT id, check_in_time, {', '.join(IMAGE_COLUMNS)} FROM attendance
+            WHERE id > ? ORDER BY id LIMIT ?
+        ''', (mark, self.batch_size)).fetchall()
+        # Stop at the first row still too young (ids follow punch order;
+        # rows synced late or imported with old times go straight through)
+        ready = list(itertools.takewhile(lambda row: (row['check_in_time'] or '') < upto, rows))
+        if not ready:
+            return False
+        enroll_keys(conn, [(row[column], row['check_in_time']) for row in ready for column in IMAGE_COLUMNS
+                           if row[column]])
+        set_state(conn, 'enrolled_upto', str(ready[-1]['id']))
+        conn.commit()
+        return len(ready) == self.batch_size
+
+    def _purge_orphans(self, conn, now):
+        """Remove photos whose rows were deleted (delete_all_records)."""
+        keys = [row['key'] for row in conn.execute(
+            'SELECT key FROM image_retention WHERE orphaned = 1 AND stage < 2 LIMIT ?',
+            (self.batch_size,)
+        )]
+        for key in keys:
+            self._delete(key, include_original=True, include_renditions=True)
+        return self._mark(conn, keys, STAGE_PURGED)
+
+    def _purge_images(self, conn, now):
+        renditions_cutoff = self._cutoff(self.renditions_days, now)
+        if renditions_cutoff:
+            keys = [row['key'] for row in conn.execute(
+                'SELECT key FROM image_retention WHERE stage < ? AND captured_at < ? LIMIT ?',
+                (STAGE_PURGED, renditions_cutoff, self.batch_size)
+            )]
+            for key in keys:
+                self._delete(key, include_original=True, include_renditions=True)
+            if self._mark(conn, keys, STAGE_PURGED):
+                return True
+
+        originals_cutoff = self._cutoff(self.originals_days, now)
+        if originals_cutoff:
+            keys = [row['key'] for row in conn.execute(
+                'SELECT key FROM image_retention WHERE stage = ? AND captured_at < ? LIMIT ?',
+                (STAGE_FULL, originals_cutoff, self.batch_size)
+            )]
+            for key in keys:
+                # Render what the dashboards show before the original goes
+                try:
+                    self.ensure_renditions(key)
+                except (ValueError, OSError):
+                    pass  # Original already missing; nothing to render from
+                self._delete(key, include_original=True, include_renditions=False)
+            if self._mark(conn, keys, STAGE_RENDITIONS):
+                return True
+        return False
+
+    def _forget_purged(self, conn, now):
+        """Drop the ledger rows of photos that are gone and past the renditions
+        window; a later upload of the same photo enrolls it afresh."""
+        cutoff = self._cutoff(self.renditions_days, now)
+        if not cutoff:
+            return False
+        keys = [row['key'] for row in conn.execute(
+            'SELECT key FROM image_retention WHERE stage = ? AND captured_at < ? LIMIT ?',
+            (STAGE_PURGED, cutoff, self.batch_size)
+        )]
+        if not keys:
+            return False
+        conn.execute(f"DELETE FROM image_retention WHERE key IN ({','.join('?' * len(keys))})", keys)
+        conn.commit()
+        return len(keys) == self.batch_size
+
+    def _delete(self, key, include_original, include_renditions):
+        targets = ([key] if include_original else []) + (self.rendition_keys(key) if include_renditions else [])
+        for target in targets:
+            try:
+                self.store.delete(target)
+            except ValueError:
+                pass  # Not a valid store key (hand-edited row)
+
+    def _mark(self, conn, keys, stage):
+        if not keys:
+            return False
+        conn.executemany('UPDATE image_retention SET stage = ? WHERE key = ?', [(stage, key) for key in keys])
+        conn.commit()
+        return len(keys) == self.batch_size
+
+    # -- receipts and jobs ---------------------------------------------
+
+    def _purge_receipts(self, conn, now):
+        """Delete a batch of sync receipts older than receipts_days."""
+        cutoff = self._cutoff(self.receipts_days, now)
+        if not cutoff:
+            return False
+        receipts = [(row['user_id'], row['idempotency_key']) for row in conn.execute(
+            'SELECT user_id, idempotency_key FROM punch_receipts WHERE received_at < ? ORDER BY received_at LIMIT ?',
+            (cutoff, self.batch_size)
+        )]
+        if not receipts:
+            return False
+        conn.executemany('DELETE FROM punch_receipts WHERE user_id = ? AND idempotency_key = ?', receipts)
+        conn.commit()
+        return len(receipts) == self.batch_size
+
+
+    def _purge_jobs(self, conn, now):
+        """Delete a batch of finished image jobs older than jobs_days."""
+        if not self.jobs_days:
+            return False
+        before = (now - timedelta(days=self.jobs_days)).timestamp()
+        return self.worker.purge_finished(conn, before, self.batch_size) == self.batch_size
+
+    # -- rows -----------------------------------------------------------
+
+    def _archive_month(self, conn, now):
+        cutoff = self._cutoff(self.hot_rows_days, now)
+        if not cutoff:
+            return False
+        row = conn.execute("SELECT MIN(check_in_time) AS t FROM attendance WHERE status = 'checked_out'").fetchone()
+        if not row['t']:
+            return False
+        month = row['t'][:7]
+        month_end = next_month(month)
+        # Only whole months, and only once their photos have been enrolled
+        if month_end > cutoff:
+            return False
+        last_id = conn.execute('''
+            SELECT MAX(id) AS id FROM attendance
+            WHERE check_in_time >= ? AND check_in_time < ? AND status = 'checked_out'
+        ''', (month + '-01', month_end)).fetchone()['id']
+        if last_id > int(get_state(conn, 'enrolled_upto') or 0):
+            return False
+
+        os.makedirs(self.archive_folder, exist_ok=True)
+        staging = os.path.join(self.archive_folder, f'.attendance-{month}.sqlite')
+        if os.path.exists(staging):
+            os.remove(staging)  # Left over from a copy that never got recorded
+        archive = sqlite3.connect(staging)
+        # Column names from an empty result (id lookup, works on either backend)
+        columns = [d[0] for d in conn.execute('SELECT * FROM attendance WHERE id = 0').description]
+        archive.execute(f"CREATE TABLE attendance ({', '.join(columns)}, username)")
+        # Open shifts stay hot until they are closed (or auto-closed)
+        cursor = conn.execute(f'''
+            SELECT {', '.join('a.' + c for c in columns)}, u.username FROM attendance a
+            LEFT JOIN users u ON a.user_id = u.id
+            WHERE a.check_in_time >= ? AND a.check_in_time < ? AND a.status = 'checked_out'
+        ''', (month + '-01', month_end))
+        copied = 0
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                break
+            archive.executemany(f"INSERT INTO attendance VALUES ({', '.join('?' * (len(columns) + 1))})",
+                                [tuple(r) for r in rows])
+            copied += len(rows)
+        archive.commit()
+        archive.close()
+        if not copied:
+            os.remove(staging)
+            return False
+        set_state(conn, 'archive_in_progress', json.dumps({'month': month, 'staging': staging}))
+        conn.commit()
+        self._resume_archive(conn, now)
+        return True
+
+    def _resume_archive(self, conn, now):
+        """Finish an archive whose rows are copied but maybe not yet deleted."""
+        state = get_state(conn, 'archive_in_progress')
+        if not state:
+            return False
+        state = json.loads(state)
+        staging = state['staging']
+        if os.path.exists(staging):
+            archive = sqlite3.connect(staging)
+            ids = [r[0] for r in archive.execute('SELECT id FROM attendance')]
+            archive.close()
+            for i in range(0, len(ids), self.batch_size):
+                batch = ids[i:i + self.batch_size]
+                # Small transactions so punches never wait long on the lock
+                conn.execute(f"DELETE FROM attendance WHERE id IN ({','.join('?' * len(batch))})", batch)
+                conn.commit()
+            self._compress(staging, state['month'])
+        # Summaries of archived days have no live rows to be rebuilt from
+        set_state(conn, 'archived_before', max(get_state(conn, 'archived_before') or '', next_month(state['month'])))
+        set_state(conn, 'archive_in_progress', None)
+        conn.commit()
+        return True
+
+    def _compress(self, staging, month):
+        part = 1
+        while True:
+            name = f'attendance-{month}.sqlite.gz' if part == 1 else f'attendance-{month}.{part}.sqlite.gz'
+            final = os.path.join(self.archive_folder, name)
+            if not os.path.exists(final):
+                break
+            part += 1
+        fd, tmp = tempfile.mkstemp(dir=self.archive_folder, prefix='.archive-', suffix='.part')
+        with open(staging, 'rb') as src, os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp, final)
+        os.remove(staging)
+
+    # -- status ---------------------------------------------------------
+
+    def status(self, conn):
+        stages = {row['stage']: row['n'] for row in conn.execute(
+            'SELECT stage, COUNT(*) AS n FROM image_retention GROUP BY stage'
+        )}
+        archives = []
+        if os.path.isdir(self.archive_folder):
+            for name in sorted(os.listdir(self.archive_folder)):
+                if name.endswith('.sqlite.gz'):
+                    path = os.path.join(self.archive_folder, name)
+                    archives.append({'file': name, 'bytes': os.path.getsize(path)})
+        return {
+            'policy': self.policy(),
+            'photos': {'full': stages.get(STAGE_FULL, 0), 'renditions_only': stages.get(STAGE_RENDITIONS, 0),
+                       'purged': stages.get(STAGE_PURGED, 0)},
+            'enrolled_upto': get_state(conn, 'enrolled_upto'),
+            'archive_in_progress': get_state(conn, 'archive_in_progress'),
+            'archived_before': get_state(conn, 'archived_before'),
+            'archives': archives,
+        }
+
+
+def next_month(month):
+    first = datetime.strptime(month, '%Y-%m')
+    return (first + timedelta(days=32)).replace(day=1).strftime('%Y-%m-%d')
+
+
+def enroll_keys(conn, keys, orphaned=0):
+    """Track (key, captured_at) pairs; a key shared by several rows keeps the newest time."""
+    conn.executemany('''
+        INSERT INTO image_retention (key, captured_at, stage, orphaned) VALUES (?, ?, 0, ?)
+        ON CONFLICT (key) DO UPDATE SET
+            -- Re-uploaded since it was purged: the photo is back in full
+            stage = CASE WHEN excluded.captured_at > image_retention.captured_at THEN 0 ELSE image_retention.stage END,
+            captured_at = CASE WHEN excluded.captured_at > image_retention.captured_at
+                               THEN excluded.captured_at ELSE image_retention.captured_at END,
+            orphaned = excluded.orphaned
+    ''', [(key, captured_at, orphaned) for key, captured_at in keys])
+
+
+def get_state(conn, name):
+    row = conn.execute('SELECT value FROM retention_state WHERE name = ?', (name,)).fetchone()
+    return row['value'] if row else None
+
+
+def set_state(conn, name, value):
+    conn.execute('''
+        INSERT INTO retention_state (name, value, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+    ''', (name, value, time.time()))
+
+
+def archived_rows(archive_folder, month):
+    """Yield the archived attendance rows of a YYYY-MM month, oldest first."""
+    if not os.path.isdir(archive_folder):
+        return
+    names = [n for n in os.listdir(archive_folder)
+             if n.startswith(f'attendance-{month}.') and n.endswith('.sqlite.gz')]
+    # attendance-M.sqlite.gz, then attendance-M.2.sqlite.gz, ...
+    names.sort(key=lambda n: int(n.split('.')[1]) if n.split('.')[1].isdigit() else 1)
+    for name in names:
+        with tempfile.NamedTemporaryFile(suffix='.sqlite') as tmp:
+            with gzip.open(os.path.join(archive_folder, name), 'rb') as src:
+                shutil.copyfileobj(src, tmp)
+            tmp.flush()
+            conn = sqlite3.connect(tmp.name)
+            conn.row_factory = sqlite3.Row
+            try:
+                yield from (dict(row) for row in conn.execute('SELECT * FROM attendance ORDER BY check_in_time, id'))
+            finally:
+                conn.close()
@@ -0,0 +1,150 @@
+"""Per-user, per-day attendance rollup (daily_attendance_summary).
+
+A shift belongs to the IST date it was checked in on. The punch handlers
+call refresh_days() for the days they touched, which recomputes those
+summary rows from attendance; backfill() rebuilds the table from history.
+"""
+from datetime import datetime, timedelta
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+BACKFILL_BATCH = 1000
+
+UPSERT_SQL = '''
+    INSERT INTO daily_attendance_summary
+        (user_id, work_date, shifts, worked_seconds, first_in, last_out, city, open_shift)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, work_date) DO UPDATE SET
+        shifts = excluded.shifts,
+        worked_seconds = excluded.worked_seconds,
+        first_in = excluded.first_in,
+        last_out = excluded.last_out,
+        city = excluded.city,
+        open_shift = excluded.open_shift
+'''
+
+
+def next_day(work_date):
+    return (datetime.strptime(work_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def summarize_day(user_id, work_date, shifts):
+    """Build one summary row from a user's shifts on one day, oldest first."""
+    worked = 0
+    last_out = None
+    open_shift = 0
+    for shift in shifts:
+        if shift['check_out_time']:
+            try:
+                checkin = datetime.strptime(shift['check_in_time'], TIME_FORMAT)
+                checkout = datetime.strptime(shift['check_out_time'], TIME_FORMAT)
+                worked += max(0, int((checkout - checkin).total_seconds()))
+            except ValueError:
+                pass
+            last_out = max(last_out or shift['check_out_time'], shift['check_out_time'])
+        if shift['status'] == 'checked_in':
+            open_shift = 1
+    return (user_id, work_date, len(shifts), worked, shifts[0]['check_in_time'],
+            last_out, shifts[0]['city'], open_shift)
+
+
+def refresh_days(conn, user_id, work_dates):
+    """Recompute the summary rows for `user_id` on each of `work_dates`.
+
+    Runs on the caller's connection, inside the punch's transaction.
+    """
+    for work_date in set(work_dates):
+        shifts = conn.execute('''
+            SELECT check_in_time, check_out_time, city, status FROM attendance
+            WHERE user_id = ? AND check_in_time >= ? AND check_in_time < ?
+            ORDER BY check_in_time
+        ''', (user_id, work_date, next_day(work_date))).fetchall()
+        if shifts:
+            conn.execute(UPSERT_SQL, summarize_day(user_id, work_date, shifts))
+        else:
+            conn.execute('DELETE FROM daily_attendance_summary WHERE user_id = ? AND work_date = ?',
+                         (user_id, work_date))
+
+
+def backfill(conn, start_date=None, end_date=None):
+    """Rebuild the summary from attendance, optionally for a date range
+    (inclusive YYYY-MM-DD bounds). Returns the number of summary rows written."""
+    conditions = []
+    params = []
+    summary_conditions = []
+    summary_params = []
+    if start_date:
+        conditions.append('check_in_time >= ?')
+        params.append(start_date)
+        summary_conditions.append('work_date >= ?')
+        summary_params.append(start_date)
+    if end_date:
+        conditions.append('check_in_time < ?')
+        params.append(next_day(end_date))
+        summary_conditions.append('work_date <= ?')
+        summary_params.append(end_date)
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    summary_where = ('WHERE ' + ' AND '.join(summary_conditions)) if summary_conditions else ''
+
+    conn.execute(f'DELETE FROM daily_attendance_summary {summary_where}', summary_params)
+
+    cursor = conn.execute(f'''
+        SELECT user_id, check_in_time, check_out_time, city, status FROM attendance
+        {where}
+        ORDER BY user_id, check_in_time
+    ''', params)
+    written = 0
+    batch = []
+    key = None
+    shifts = []
+    for row in cursor:
+        row_key = (row['user_id'], row['check_in_time'][:10])
+        if row_key != key:
+            if shifts:
+                batch.append(summarize_day(key[0], key[1], shifts))
+            key, shifts = row_key, []
+        shifts.append(row)
+        if len(batch) >= BACKFILL_BATCH:
+            conn.executemany(UPSERT_SQL, batch)
+            written += len(batch)
+            batch = []
+    if shifts:
+        batch.append(summarize_day(key[0], key[1], shifts))
+    conn.executemany(UPSERT_SQL, batch)
+    written += len(batch)
+    conn.commit()
+    return written
+
+
+def monthly_summary(conn, month):
+    """Payroll view for a YYYY-MM month: one row per user with any attendance."""
+    first = datetime.strptime(month, '%Y-%m')
+    first_day = first.strftime('%Y-%m-%d')
+    next_month = (first + timedelta(days=32)).replace(day=1).strftime('%Y-%m-%d')
+    rows = conn.execute('''
+        SELECT s.user_id, u.username,
+               COUNT(*) AS days_worked,
+               SUM(s.shifts) AS shifts,
+               SUM(s.worked_seconds) AS worked_seconds,
+               SUM(s.open_shift) AS open_shifts,
+               MIN(s.first_in) AS first_in,
+               MAX(s.last_out) AS last_out
+        FROM daily_attendance_summary s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.work_date >= ? AND s.work_date < ?
+        GROUP BY s.user_id, u.username
+        ORDER BY u.username
+    ''', (first_day, next_month)).fetchall()
+    return [dict(row, hours_worked=round(row['worked_seconds'] / 3600, 2)) for row in rows]
+
+
+def day_stats(conn, work_date):
+    """Headline numbers for one day, for the admin dashboard."""
+    row = conn.execute('''
+        SELECT COUNT(*) AS workers_present,
+               COALESCE(SUM(open_shift), 0) AS open_shifts,
+               COALESCE(SUM(worked_seconds), 0) AS worked_seconds,
+               COUNT(DISTINCT city) AS sites
+        FROM daily_attendance_summary
+        WHERE work_date = ?
+    ''', (work_date,)).fetchone()
+    return dict(row, work_date=work_date, hours_worked=round(row['worked_seconds'] / 3600, 2))
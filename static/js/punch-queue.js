@@ -0,0 +1,112 @@
+// Offline punch queue shared by the capture pages and the service worker.
+// Punches are stored in IndexedDB with their photos as Blobs and uploaded to
+// /api/sync in small batches; each carries a client-generated idempotency
+// key, so an upload that is retried after a dropped connection is not
+// recorded twice.
+(function (scope) {
+    const DB_NAME = 'attendance-offline';
+    const STORE = 'punches';
+    const BATCH_SIZE = 5;  // keeps each upload well under the 16MB request limit
+    const SYNC_TAG = 'punch-sync';
+
+    function openDb() {
+        return new Promise((resolve, reject) => {
+            const request = indexedDB.open(DB_NAME, 1);
+            request.onupgradeneeded = () => {
+                request.result.createObjectStore(STORE, { keyPath: 'key' });
+            };
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => reject(request.error);
+        });
+    }
+
+    async function withStore(mode, fn) {
+        const db = await openDb();
+        return new Promise((resolve, reject) => {
+            const tx = db.transaction(STORE, mode);
+            const result = fn(tx.objectStore(STORE));
+            tx.oncomplete = () => { db.close(); resolve(result && result.result); };
+            tx.onerror = () => { db.close(); reject(tx.error); };
+        });
+    }
+
+    function newKey() {
+        if (scope.crypto && scope.crypto.randomUUID) {
+            return scope.crypto.randomUUID();
+        }
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
+    }
+
+    // kind is 'checkin' or 'checkout'; fields are the same names the
+    // single-punch endpoints take; images maps field name -> Blob. userId
+    // lets the server hold back punches queued by someone else on a shared
+    // phone until they log in again.
+    async function add(kind, fields, images, userId) {
+        const punch = { key: newKey(), kind: kind, user_id: userId, captured_at: Date.now(),
+                        fields: fields, images: images };
+        await withStore('readwrite', store => store.put(punch));
+        return punch.key;
+    }
+
+    async function pending() {
+        return (await withStore('readonly', store => store.getAll())) || [];
+    }
+
+    async function remove(keys) {
+        await withStore('readwrite', store => keys.forEach(key => store.delete(key)));
+    }
+
+    async function uploadBatch(batch) {
+        const formData = new FormData();
+        const manifest = batch.map(punch => {
+            for (const [field, blob] of Object.entries(punch.images || {})) {
+                if (blob) formData.append(`${punch.key}:${field}`, blob, `${field}.jpg`);
+            }
+            const entry = { key: punch.key, kind: punch.kind, user_id: punch.user_id, captured_at: punch.captured_at };
+            for (const [name, value] of Object.entries(punch.fields || {})) {
+                if (value !== null && value !== undefined) entry[name] = value;
+            }
+            return entry;
+        });
+        formData.append('punches', JSON.stringify(manifest));
+        const response = await fetch('/api/sync', { method: 'POST', body: formData, credentials: 'same-origin' });
+        if (!response.ok || response.redirected) {
+            throw new Error(`Sync failed with HTTP ${response.status}`);
+        }
+        return (await response.json()).results;
+    }
+
+    // Upload everything queued. Punches the server settled (applied,
+    // duplicate or rejected) are dropped from the queue; deferred ones and
+    // anything hit by a network error stay queued for the next attempt.
+    const SETTLED = ['applied', 'duplicate', 'rejected'];
+    let flushing = null;
+    function flush() {
+        if (!flushing) {
+            flushing = (async () => {
+                const results = [];
+                const queued = (await pending()).sort((a, b) => a.captured_at - b.captured_at);
+                for (let i = 0; i < queued.length; i += BATCH_SIZE) {
+                    const batchResults = await uploadBatch(queued.slice(i, i + BATCH_SIZE));
+                    await remove(batchResults.filter(r => r && r.key && SETTLED.includes(r.status)).map(r => r.key));
+                    results.push(...batchResults);
+                }
+                return results;
+            })().finally(() => { flushing = null; });
+        }
+        return flushing;
+    }
+
+    // Ask the service worker to retry when connectivity returns (Background
+    // Sync where supported; pages also flush on the 'online' event)
+    async function requestSync() {
+        if ('serviceWorker' in navigator) {
+            const registration = await navigator.serviceWorker.ready;
+            if (registration.sync) {
+                await registration.sync.register(SYNC_TAG);
+            }
+        }
+    }
+
+    scope.PunchQueue = { add, pending, flush, requestSync, SYNC_TAG };
+})(self);
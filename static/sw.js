@@ -0,0 +1,54 @@
+// Service worker: keeps the capture pages available offline and uploads
+// queued punches when connectivity returns. Served from /sw.js so its scope
+// covers the whole app.
+importScripts('/static/js/punch-queue.js');
+
+const CACHE = 'attendance-pages-v1';
+// Only the capture pages: the dashboard shows one worker's history and the
+// phone may be shared
+const OFFLINE_PAGES = ['/user/checkin', '/user/checkout'];
+
+self.addEventListener('install', event => {
+    self.skipWaiting();
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil((async () => {
+        for (const name of await caches.keys()) {
+            if (name !== CACHE) await caches.delete(name);
+        }
+        await self.clients.claim();
+    })());
+});
+
+// Network first for the worker pages, falling back to the last copy seen
+self.addEventListener('fetch', event => {
+    const url = new URL(event.request.url);
+    if (event.request.method !== 'GET' || url.origin !== self.location.origin) {
+        return;
+    }
+    const cacheable = OFFLINE_PAGES.includes(url.pathname) || url.pathname.startsWith('/static/');
+    if (!cacheable) {
+        return;
+    }
+    event.respondWith((async () => {
+        try {
+            const response = await fetch(event.request);
+            if (response.ok && !response.redirected) {
+                const cache = await caches.open(CACHE);
+                await cache.put(event.request, response.clone());
+            }
+            return response;
+        } catch (error) {
+            const cached = await caches.match(event.request);
+            if (cached) return cached;
+            throw error;
+        }
+    })());
+});
+
+self.addEventListener('sync', event => {
+    if (event.tag === PunchQueue.SYNC_TAG) {
+        event.waitUntil(PunchQueue.flush());
+    }
+});
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+from db import get_db
+
+
+class UserCache:
+    """In-process LRU cache of user rows with a TTL, used by load_user.
+
+    Every worker process keeps its own copy. Writers bump a version stamp in
+    the cache_versions table inside their transaction; each worker re-reads
+    that stamp at most every `version_check_interval` seconds and drops its
+    whole cache when it has moved, so edits made through another worker show
+    up within that window.
+    """
+
+    NAME = 'users'
+
+    def __init__(self, maxsize=2048, ttl=300.0, version_check_interval=2.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = 0.0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'version_resets': 0}
+
+    def get(self, user_id, loader):
+        """Return the cached row for `user_id`, calling `loader(user_id)` on a miss."""
+        self._check_version()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.counters['hits'] += 1
+                return entry[1]
+            self.counters['misses'] += 1
+
+        row = loader(user_id)
+        if row is None:
+            return None
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl, row)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.counters['evictions'] += 1
+        return row
+
+    def invalidate(self, conn, user_id=None):
+        """Drop `user_id` (or everyone) here and tell the other workers.
+
+        The version bump runs on the caller's connection so it commits or
+        rolls back together with the user change itself.
+        """
+        conn.execute('UPDATE cache_versions SET version = version + 1 WHERE name = ?', (self.NAME,))
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+            self.counters['invalidations'] += 1
+
+    def _check_version(self):
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_check_interval:
+            return
+        self._version_checked_at = now
+        row = get_db().execute('SELECT version FROM cache_versions WHERE name = ?', (self.NAME,)).fetchone()
+        version = row['version'] if row else None
+        with self._lock:
+            if self._version is not None and version != self._version:
+                self._entries.clear()
+                self.counters['version_resets'] += 1
+            self._version = version
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return dict(
+                self.counters,
+                size=len(self._entries),
+                maxsize=self.maxsize,
+                hit_ratio=round(self.counters['hits'] / lookups, 4) if lookups else None,
+            )
@@ -0,0 +1,238 @@
+"""Bulk user import and batch updates for the admin API.
+
+An import validates every row first and reports on each one (created or
+rejected, with the reason), so one bad line doesn't sink a 300-person
+upload. Passwords are hashed before any lock is taken, spread over a
+process pool: werkzeug's scrypt hashing is deliberately slow (~150ms of
+CPU per password), and threads wouldn't help because it holds the GIL.
+The accepted rows are then re-checked against the users table and
+inserted with one executemany under the write lock, in a single
+transaction.
+"""
+import csv
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+ROLES = ('user', 'admin')
+MAX_ROWS = 1000  # per request; about 40s of hashing on four cores
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'on')
+FALSE_VALUES = ('0', 'false', 'no', 'n', 'off')
+
+
+def parse_csv(text):
+    """Rows of a CSV with a header line (username,email,password,role,location_enabled)."""
+    reader = csv.DictReader(io.StringIO(text.lstrip('\ufeff')))  # Excel writes a BOM
+    if reader.fieldnames is None:
+        return []
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+    return list(reader)
+
+
+def parse_flag(value):
+    """0/1 from a CSV cell or JSON value; ValueError if it isn't a yes/no."""
+    if isinstance(value, bool) or value in (0, 1):
+        return int(value)
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return 1
+    if text in FALSE_VALUES:
+        return 0
+    raise ValueError(value)
+
+
+def _in_chunks(conn, sql, values, size=500):
+    """Run `sql` (with a {} for the placeholders) over `values` in chunks."""
+    values = list(values)
+    for start in range(0, len(values), size):
+        chunk = values[start:start + size]
+        yield from conn.execute(sql.format(','.join('?' * len(chunk))), chunk)
+
+
+class PasswordHasher:
+    """generate_password_hash over a pool of worker processes.
+
+    The pool is started on first use in each process (never inherited over
+    a fork) and kept for later imports. Children are spawned rather than
+    forked because the gunicorn worker asking for them is multi-threaded.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def hash_all(self, passwords):
+        if self.max_workers == 1 or len(passwords) < 2:
+            return [generate_password_hash(password) for password in passwords]
+        chunksize = max(1, len(passwords) // (self.max_workers * 4))
+        return list(self._executor().map(generate_password_hash, passwords, chunksize=chunksize))
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+            return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+
+
+def validate_rows(rows):
+    """(accepted rows, report) where the report has an entry per input row."""
+    report = []
+    accepted = []
+    seen_usernames = {}
+    seen_emails = {}
+    for number, row in enumerate(rows, start=1):
+        entry = {'row': number, 'username': None, 'status': 'rejected', 'message': None}
+        report.append(entry)
+        if not isinstance(row, dict):
+            entry['message'] = 'Row must be an object with username, email and password'
+            continue
+        username = str(row.get('username') or '').strip()
+        email = str(row.get('email') or '').strip()
+        password = str(row.get('password') or '')
+        role = str(row.get('role') or 'user').strip().lower()
+        entry['username'] = username or None
+        if not username or not email or not password:
+            entry['message'] = 'username, email and password are required'
+        elif '@' not in email:
+            entry['message'] = 'email is not an email address'
+        elif role not in ROLES:
+            entry['message'] = f"role must be one of {', '.join(ROLES)}"
+        elif username in seen_usernames:
+            entry['message'] = f'username repeats row {seen_usernames[username]}'
+        elif email in seen_emails:
+            entry['message'] = f'email repeats row {seen_emails[email]}'
+        else:
+            try:
+                # Left out or blank: on, the same default as the users table
+                location = row.get('location_enabled')
+                location_enabled = 1 if location in (None, '') else parse_flag(location)
+            except ValueError:
+                entry['message'] = 'location_enabled must be yes/no, true/false or 1/0'
+                continue
+            seen_usernames[username] = seen_emails[email] = number
+            accepted.append({'entry': entry, 'username': username, 'email': email, 'password': password,
+                             'role': role, 'location_enabled': location_enabled})
+    return accepted, report
+
+
+def _reject_existing(conn, accepted):
+    """Drop (and report) rows whose username or email is already taken."""
+    taken_usernames = {row['username'] for row in _in_chunks(
+        conn, 'SELECT username FROM users WHERE username IN ({})', [r['username'] for r in accepted])}
+    taken_emails = {row['email'] for row in _in_chunks(
+        conn, 'SELECT email FROM users WHERE email IN ({})', [r['email'] for r in accepted])}
+    kept = []
+    for row in accepted:
+        if row['username'] in taken_usernames:
+            row['entry']['message'] = 'username already exists'
+        elif row['email'] in taken_emails:
+            row['entry']['message'] = 'email already exists'
+        else:
+            kept.append(row)
+    return kept
+
+
+def import_users(conn, rows, hasher, dry_run=False):
+    """Create users from `rows` (dicts); returns (created count, per-row report).
+
+    Leaves the transaction open for the caller to commit (or roll back).
+    """
+    accepted, report = validate_rows(rows)
+    accepted = _reject_existing(conn, accepted)
+    if dry_run:
+        for row in accepted:
+            row['entry']['status'] = 'valid'
+        return 0, report
+
+    # The slow part, done before taking the write lock
+    hashes = hasher.hash_all([row['password'] for row in accepted])
+
+    conn.execute('BEGIN IMMEDIATE')
+    # Someone may have added one of these users while we were hashing
+    accepted = _reject_existing(conn, [dict(row, password_hash=h) for row, h in zip(accepted, hashes)])
+    conn.executemany(
+        'INSERT INTO users (username, email, password_hash, role, location_enabled) VALUES (?, ?, ?, ?, ?)',
+        [(row['username'], row['email'], row['password_hash'], row['role'], row['location_enabled'])
+         for row in accepted]
+    )
+    ids = {row['username']: row['id'] for row in _in_chunks(
+        conn, 'SELECT id, username FROM users WHERE username IN ({})', [row['username'] for row in accepted])}
+    for row in accepted:
+        row['entry'].update(status='created', id=ids.get(row['username']))
+    return len(accepted), report
+
+
+def bulk_update(conn, updates, acting_user_id):
+    """Set role and/or location_enabled on many users; returns (updated count, per-row report).
+
+    Each update names the user by `id` or `username`. Leaves the
+    transaction open for the caller to commit.
+    """
+    report = []
+    pending = []
+    conn.execute('BEGIN IMMEDIATE')
+    usernames = [u['username'] for u in updates
+                 if isinstance(u, dict) and u.get('id') is None and isinstance(u.get('username'), str)]
+    ids_by_name = {row['username']: row['id'] for row in _in_chunks(
+        conn, 'SELECT id, username FROM users WHERE username IN ({})', usernames)}
+    candidate_ids = [u.get('id') for u in updates if isinstance(u, dict)] + list(ids_by_name.values())
+    existing = {row['id'] for row in _in_chunks(
+        conn, 'SELECT id FROM users WHERE id IN ({})', [i for i in candidate_ids if type(i) is int])}
+    seen = {}
+    for number, update in enumerate(updates, start=1):
+        entry = {'row': number, 'id': None, 'status': 'rejected', 'message': None}
+        report.append(entry)
+        if not isinstance(update, dict):
+            entry['message'] = 'Update must be an object'
+            continue
+        user_id = update.get('id')
+        # bool is an int subclass, and a list or dict id can't be looked up
+        if user_id is not None and type(user_id) is not int:
+            entry['message'] = 'id must be an integer'
+            continue
+        if user_id is None:
+            username = update.get('username')
+            if username is not None and not isinstance(username, str):
+                entry['message'] = 'username must be text'
+                continue
+            user_id = ids_by_name.get(username)
+        entry['id'] = user_id
+        role = update.get('role')
+        location = update.get('location_enabled')
+        if user_id not in existing:
+            entry['message'] = 'user not found'
+        elif user_id in seen:
+            entry['message'] = f'user repeats row {seen[user_id]}'
+        elif role is None and location is None:
+            entry['message'] = 'nothing to change: give role and/or location_enabled'
+        elif role is not None and role not in ROLES:
+            entry['message'] = f"role must be one of {', '.join(ROLES)}"
+        elif user_id == acting_user_id and role == 'user':
+            entry['message'] = 'you cannot remove your own admin role'
+        else:
+            try:
+                location = None if location is None else parse_flag(location)
+            except ValueError:
+                entry['message'] = 'location_enabled must be yes/no, true/false or 1/0'
+                continue
+            seen[user_id] = number
+            entry.update(status='updated')
+            pending.append((role, location, user_id))
+    conn.executemany('''
+        UPDATE users SET role = COALESCE(?, role), location_enabled = COALESCE(?, location_enabled)
+        WHERE id = ?
+    ''', pending)
+    return len(pending), report